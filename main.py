@@ -1,13 +1,78 @@
 #!/usr/bin/env python3
 """
 ================================================================================
-PH-Bot v6.4.0 — Client Intake & Case Management
+PH-Bot v6.5.0 — Client Intake & Case Management
 ================================================================================
 Repository: github.com/anacuero-bit/PH-Bot
-Updated:    2026-02-18
+Updated:    2026-10-17
 
 CHANGELOG:
 ----------
+v6.5.0 (2026-10-17)
+  - NEW: Connection pool for PostgreSQL + SQLite (DB_POOL_MIN/MAX), conn.close() returns to pool
+  - NEW: Pool health checks on idle connections, leak detection, wait-time metrics (/stats + log job)
+  - UPDATED: SQLite uses long-lived WAL-mode connections instead of one connect() per helper
+  - NEW: Async data-access layer — run_db() + aget_user/aupdate_user/asave_document/asave_message etc.
+  - UPDATED: All handlers and jobs await DB helpers on a bounded thread pool (no blocking the event loop)
+  - NEW: Per-update unit of work — users row + doc counts loaded once, update_user writes flushed once
+  - NEW: Write-behind message log — save_message buffered and batch-inserted (N rows / T ms), flushed on shutdown
+  - UPDATED: /stats, /funnel, /revenue render from one cached stats snapshot (single aggregated query)
+  - NEW: Versioned schema migrations (schema_version table) — startup skips applied migrations
+  - NEW: Indexes on documents, messages, users (eligible/state/country) and waitlist hot predicates
+  - NEW: Maintained capacity counter — capacity reads are O(1), reconciled against COUNT(*) every 30 min
+  - UPDATED: get_waitlist_count memoizes day/hour prefix sums (only new days/hours are hashed)
+  - NEW: waitlist.queue_position (maintained, indexed) — O(1) position lookups
+  - NEW: /waitlist <page> — paginated queue listing for admins
+  - UPDATED: /release marks the whole batch notified in one UPDATE
+  - FIX: SQLite re-joining the waitlist no longer resets the join date (upsert instead of REPLACE)
+  - NEW: ingest_document — INSERT ... RETURNING with doc count and user name in one round trip;
+         photo/file upload handlers use one connection instead of four
+  - NEW: Broadcast engine — concurrent sends paced by the outbound gateway (broadcast lane),
+         live progress message
+  - UPDATED: /broadcast, /broadcasteligible, /broadcastpaid, /broadcastcountry use the engine
+  - NEW: Persistent broadcast jobs (broadcast_jobs / broadcast_deliveries) — audience materialized
+         once at creation, every delivery checkpointed, running jobs resume after a restart
+  - NEW: /bcstatus [id], /bcpause <id>, /bcresume <id>, /bccancel <id>
+  - NEW: stream_rows() — bulk queries streamed in chunks (server-side named cursor on PostgreSQL,
+         keyset pagination on SQLite); broadcasts start sending immediately, /export memory stays flat
+  - UPDATED: Re-engagement reminders — one scheduler over users.next_reminder_at (indexed, only due rows),
+             doc counts joined in the same query, reminder_log makes each stage exactly-once,
+             sends go through the broadcast engine (concurrent, rate-limited)
+  - NEW: Admin notifications are queued and sent by a background worker pool (admin lane of the
+         outbound gateway); upload handlers and notify_admins return as soon as the user has their reply
+  - NEW: Admin digest mode (ADMIN_DIGEST_SECONDS) — notifications coalesced per window into one summary
+         plus albums of up to 10 documents; human-contact requests still go out immediately
+  - NEW: /pendientes_<id> (or /pendientes <id>) opens one document for review; used as deep link in alerts
+  - NEW: Outbound gateway (Application rate limiter) — every send/edit passes through priority lanes
+         (interactive > admin > reminders > broadcast), global + per-chat limits, RetryAfter retries
+         (TimedOut retried for edits only — a timed-out send may have been delivered),
+         per-lane latency/throughput shown in /stats
+  - NEW: Album uploads — items sharing a media_group_id are buffered briefly, saved with one
+         multi-row INSERT, answered with one reply and forwarded to admins as one album
+  - UPDATED: Claude Vision — one shared AsyncAnthropic client (keep-alive), in-flight requests capped
+             by a semaphore, per-request timeout and a circuit breaker; the event loop no longer
+             blocks while a document is being analysed
+  - NEW: Analysis cache — vision and OCR results keyed by SHA-256 of the file and by Telegram
+         file_unique_id, stored in analysis_cache behind an in-memory LRU; re-sent or forwarded
+         documents skip the download and API call; hit/miss counters in /stats
+  - UPDATED: Vision requests send a preprocessed image — EXIF auto-orient, uniform borders cropped,
+             downscaled to VISION_MAX_EDGE, re-encoded as JPEG/WebP; real media type detected
+             (PDFs go as document blocks instead of being mislabelled image/jpeg)
+  - UPDATED: OCR runs in a process pool (one worker per CPU) with a bounded queue and per-job
+             timeouts instead of inside the handler; other users' updates keep flowing meanwhile
+  - NEW: classify_document() cascade — image quality check rejects bad photos instantly, local OCR
+         keyword scoring decides confident cases, Claude Vision only below CLASSIFY_OCR_MIN_CONFIDENCE
+         or for types that need field extraction; per-stage decision rate and latency in /stats
+  - FIXED: get_doc_type_from_ai mapped vision types to codes missing from DOC_TYPES
+  - UPDATED: OCR keyword matching — one pass over accent-stripped text, whole words (plurals
+             accepted), weighted per keyword; a tie halves the confidence instead of DOC_TYPES order
+             silently deciding it
+  - NEW: Document pre-analysis queue — uploads enqueue an analysis_jobs row in the same transaction;
+         background workers run the classification cascade and fill ai_type, ai_confidence,
+         ai_analysis, extracted fields, expiry_date and issues, so /pendientes opens with results
+  - NEW: /analizar [N] — queue older, never-analysed pending documents for pre-analysis in batches
+         (not done automatically: vision calls cost money)
+
 v6.4.0 (2026-02-18)
   - NEW: Post-eligibility data collection flow (WhatsApp, email, community invites)
   - NEW: 15-question demographics questionnaire (optional, button-based)
@@ -247,26 +312,69 @@ ENV VARS:
   BANK_IBAN           Transfer IBAN
   ANTHROPIC_API_KEY   (optional, for AI escalation)
   FIELD_AGENT_IDS     comma-separated Telegram IDs (partner commands only)
+  DATABASE_URL        PostgreSQL URL (falls back to SQLite tuspapeles.db)
+  DB_POOL_MIN / DB_POOL_MAX         pooled DB connections (default 1 / 10)
+  DB_POOL_TIMEOUT                   seconds to wait for a free connection (default 10)
+  DB_POOL_HEALTHCHECK_IDLE          ping connections idle longer than N seconds (default 30)
+  DB_POOL_LEAK_SECONDS              warn when a connection is held longer than N seconds (default 60)
+  DB_EXECUTOR_WORKERS               DB worker threads for handlers (default DB_POOL_MAX, capped at it)
+  MSG_LOG_BATCH_SIZE / MSG_LOG_FLUSH_MS / MSG_LOG_QUEUE_MAX   message log batching (100 / 1000ms / 5000)
+  STATS_CACHE_TTL                   seconds admin stats snapshot is reused (default 60)
+  REMINDER_INTERVAL_MINUTES / REMINDER_BATCH_SIZE   reminder run interval and due users per batch (30 / 500)
+  OUTBOUND_RATE / OUTBOUND_PER_CHAT_RATE            outbound gateway msgs/s overall and per chat (30 / 1)
+  OUTBOUND_MAX_RETRIES / OUTBOUND_TIMEOUT_RETRIES   gateway retries on RetryAfter / TimedOut, edits only (3 / 1)
+  ALBUM_WINDOW_MS                   quiet period before an uploaded album is saved as one batch (default 1500)
+  ADMIN_NOTIFY_WORKERS / ADMIN_NOTIFY_QUEUE_MAX   admin notification workers and queue bound (4 / 2000)
+  ADMIN_DIGEST_SECONDS              >0 enables admin digest mode: one summary + albums per window (default 0 = off)
+  STREAM_CHUNK_SIZE                 rows per fetch for streamed audiences / exports (default 1000)
+  BROADCAST_CONCURRENCY / BROADCAST_PROGRESS_SECONDS   broadcast sends in flight and progress interval (20 / 15)
+  TELEGRAM_API_BASE_URL             Bot API base URL override (e.g. http://localhost:8081/bot for a fake server)
+  CLAUDE_MODEL / CLAUDE_MAX_CONCURRENCY     vision model and requests in flight (claude-sonnet-4-20250514 / 4)
+  CLAUDE_TIMEOUT_SECONDS / CLAUDE_MAX_RETRIES       per-request timeout and SDK retries (45 / 2)
+  CLAUDE_BREAKER_FAILURES / CLAUDE_BREAKER_COOLDOWN  failures that open the circuit, seconds it stays open (5 / 60)
+  ANTHROPIC_BASE_URL                API base URL override, read by the SDK (e.g. a local stub server)
+  ANALYSIS_CACHE_SIZE / ANALYSIS_CACHE_TTL_DAYS     in-memory analysis entries and days results are kept (1024 / 30)
+  VISION_MAX_EDGE / VISION_IMAGE_QUALITY / VISION_IMAGE_FORMAT   vision image long edge, quality, jpeg|webp (1568 / 85 / jpeg)
+  CLASSIFY_OCR_MIN_CONFIDENCE       OCR keyword confidence needed to skip vision (default 0.7)
+  CLASSIFY_VISION_TYPES             doc types always sent to vision for field extraction (passport,antecedentes,empadronamiento)
+  ANALYSIS_WORKERS / ANALYSIS_MAX_ATTEMPTS / ANALYSIS_POLL_SECONDS   pre-analysis workers, tries per document, idle poll (2 / 3 / 30)
+  OCR_WORKERS / OCR_QUEUE_MAX / OCR_TIMEOUT_SECONDS   OCR processes, jobs queued or running, per-job limit (usable CPUs, max 4 / 4×workers / 60)
 ================================================================================
 """
 
 import os
 import re
+import sys
 import json
 import sqlite3
 import logging
 import hashlib
+import unicodedata
+import threading
+import time
+import asyncio
+import functools
+import heapq
+import itertools
+import contextvars
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Tuple
+from datetime import date, datetime, timedelta, timezone
+from collections import OrderedDict
+from typing import Optional, Dict, List, Tuple, Callable, Awaitable, AsyncIterator
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaDocument,
+    InputMediaPhoto,
 )
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -275,6 +383,8 @@ from telegram.ext import (
     filters,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut
+from telegram.helpers import escape_markdown
 
 # Optional: OCR
 try:
@@ -291,6 +401,13 @@ try:
 except ImportError:
     IMAGE_ANALYSIS = False
 
+# Optional: image preprocessing before vision analysis (Pillow only)
+try:
+    from PIL import Image, ImageChops, ImageOps
+    IMAGE_PREPROCESS = True
+except ImportError:
+    IMAGE_PREPROCESS = False
+
 # Optional: Partner card generation (Pillow drawing + qrcode)
 try:
     from PIL import ImageDraw, ImageFont
@@ -302,7 +419,7 @@ except ImportError:
 # Optional: PostgreSQL (for Railway production)
 try:
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    from psycopg2.extras import RealDictCursor, execute_values
     POSTGRES_AVAILABLE = True
 except ImportError:
     POSTGRES_AVAILABLE = False
@@ -353,6 +470,65 @@ def _test_postgres_connection() -> bool:
 
 USE_POSTGRES = _test_postgres_connection()
 
+# Connection pool sizing (shared by PostgreSQL and SQLite)
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))            # Max seconds to wait for a free connection
+DB_POOL_HEALTHCHECK_IDLE = float(os.environ.get("DB_POOL_HEALTHCHECK_IDLE", "30"))  # Ping connections idle longer than this
+DB_POOL_LEAK_SECONDS = float(os.environ.get("DB_POOL_LEAK_SECONDS", "60"))  # Warn when a connection is held longer than this
+
+# Write-behind message log (messages table)
+MSG_LOG_BATCH_SIZE = int(os.environ.get("MSG_LOG_BATCH_SIZE", "100"))    # Flush after N buffered messages
+MSG_LOG_FLUSH_MS = int(os.environ.get("MSG_LOG_FLUSH_MS", "1000"))        # ...or after T milliseconds
+MSG_LOG_QUEUE_MAX = int(os.environ.get("MSG_LOG_QUEUE_MAX", "5000"))      # Producers wait when the buffer is full
+
+STATS_CACHE_TTL = float(os.environ.get("STATS_CACHE_TTL", "60"))  # Seconds an admin stats snapshot stays fresh
+REMINDER_INTERVAL_MINUTES = int(os.environ.get("REMINDER_INTERVAL_MINUTES", "30"))  # How often due reminders are sent
+REMINDER_BATCH_SIZE = int(os.environ.get("REMINDER_BATCH_SIZE", "500"))              # Due users handled per query
+# Outbound gateway (every Bot API send/edit goes through it)
+OUTBOUND_RATE = float(os.environ.get("OUTBOUND_RATE", "30"))                        # Messages per second, whole bot
+OUTBOUND_PER_CHAT_RATE = float(os.environ.get("OUTBOUND_PER_CHAT_RATE", "1"))      # Per private chat (burst of 3)
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))            # RetryAfter retries per request
+OUTBOUND_TIMEOUT_RETRIES = int(os.environ.get("OUTBOUND_TIMEOUT_RETRIES", "1"))    # TimedOut retries per edit
+
+ALBUM_WINDOW_MS = int(os.environ.get("ALBUM_WINDOW_MS", "1500"))  # Wait this long after the last album item
+
+# Admin notifications (background fan-out)
+ADMIN_NOTIFY_WORKERS = int(os.environ.get("ADMIN_NOTIFY_WORKERS", "4"))                        # Concurrent admin sends
+ADMIN_NOTIFY_QUEUE_MAX = int(os.environ.get("ADMIN_NOTIFY_QUEUE_MAX", "2000"))
+ADMIN_DIGEST_SECONDS = int(os.environ.get("ADMIN_DIGEST_SECONDS", "0"))  # >0: coalesce non-urgent admin alerts per window
+
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", "1000"))  # Rows per fetch when streaming bulk queries
+
+# Claude Vision (shared async client)
+CLAUDE_MODEL = os.environ.get("CLAUDE_MODEL", "claude-sonnet-4-20250514")
+CLAUDE_MAX_CONCURRENCY = int(os.environ.get("CLAUDE_MAX_CONCURRENCY", "4"))          # Vision requests in flight
+CLAUDE_TIMEOUT_SECONDS = float(os.environ.get("CLAUDE_TIMEOUT_SECONDS", "45"))      # Per request, incl. upload
+CLAUDE_MAX_RETRIES = int(os.environ.get("CLAUDE_MAX_RETRIES", "2"))                 # SDK retries (429/5xx/connect)
+CLAUDE_BREAKER_FAILURES = int(os.environ.get("CLAUDE_BREAKER_FAILURES", "5"))       # Consecutive failures to open
+CLAUDE_BREAKER_COOLDOWN = float(os.environ.get("CLAUDE_BREAKER_COOLDOWN", "60"))    # Seconds before a trial call
+VISION_MAX_EDGE = int(os.environ.get("VISION_MAX_EDGE", "1568"))                   # Longer edges gain the model nothing
+VISION_IMAGE_QUALITY = int(os.environ.get("VISION_IMAGE_QUALITY", "85"))           # Enough for small print / MRZ lines
+VISION_IMAGE_FORMAT = os.environ.get("VISION_IMAGE_FORMAT", "jpeg").lower()        # jpeg or webp
+# CPUs this process may run on (a container's cpuset, not the host's core count)
+_USABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 2)
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", str(min(4, _USABLE_CPUS))))         # Tesseract processes
+OCR_QUEUE_MAX = int(os.environ.get("OCR_QUEUE_MAX", str(4 * OCR_WORKERS)))          # Jobs queued or running
+OCR_TIMEOUT_SECONDS = float(os.environ.get("OCR_TIMEOUT_SECONDS", "60"))            # Slot wait and run time, each
+CLASSIFY_OCR_MIN_CONFIDENCE = float(os.environ.get("CLASSIFY_OCR_MIN_CONFIDENCE", "0.7"))  # Else escalate to vision
+CLASSIFY_VISION_TYPES = {t.strip() for t in os.environ.get(
+    "CLASSIFY_VISION_TYPES", "passport,antecedentes,empadronamiento").split(",") if t.strip()}  # Need name/dates
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", "2"))                    # Documents analysed at once
+ANALYSIS_MAX_ATTEMPTS = int(os.environ.get("ANALYSIS_MAX_ATTEMPTS", "3"))          # Then the job is marked failed
+ANALYSIS_POLL_SECONDS = float(os.environ.get("ANALYSIS_POLL_SECONDS", "30"))       # Idle re-check for due retries
+ANALYSIS_CACHE_SIZE = int(os.environ.get("ANALYSIS_CACHE_SIZE", "1024"))            # Results kept in memory
+ANALYSIS_CACHE_TTL_DAYS = int(os.environ.get("ANALYSIS_CACHE_TTL_DAYS", "30"))      # Results hold personal data
+
+# Broadcast engine (paced by the outbound gateway)
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "20"))        # Sends in flight at once
+BROADCAST_PROGRESS_SECONDS = float(os.environ.get("BROADCAST_PROGRESS_SECONDS", "15"))  # Admin progress update interval
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL", "")  # e.g. a local fake Bot API for load tests
+
 DEADLINE = datetime(2026, 6, 30, 23, 59, 59)
 DB_PATH = "tuspapeles.db"
 MIN_DOCS_FOR_PHASE2 = 3
@@ -1633,15 +1809,299 @@ FAQ = {
 # DATABASE
 # =============================================================================
 
-def get_connection():
-    """Get database connection (PostgreSQL if DATABASE_URL set, else SQLite)."""
+class PoolTimeout(Exception):
+    """Raised when no pooled connection frees up within DB_POOL_TIMEOUT."""
+
+
+class PooledConnection:
+    """Checked-out connection. close() hands it back to the pool instead of closing it,
+    so every helper's existing get_connection() / conn.close() pairing keeps working."""
+
+    def __init__(self, pool: "ConnectionPool", raw):
+        self._pool = pool
+        self._raw = raw
+
+    def cursor(self, *args, **kwargs):
+        return self._raw.cursor(*args, **kwargs)
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool.release(raw)
+
+    def __getattr__(self, name):
+        raw = self.__dict__.get("_raw")
+        if raw is None:
+            raise AttributeError(f"connection already returned to pool ({name})")
+        return getattr(raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __del__(self):
+        # Helper raised before conn.close(): reclaim instead of leaking the slot
+        if self.__dict__.get("_raw") is not None:
+            self._pool.stats["reclaimed"] += 1
+            try:
+                self.close()
+            except Exception:
+                pass
+
+
+class ConnectionPool:
+    """Thread-safe pool of long-lived DB connections.
+
+    - min/max size (DB_POOL_MIN / DB_POOL_MAX), LIFO reuse so hot connections stay warm
+    - callers block up to DB_POOL_TIMEOUT for a free slot, wait time is recorded
+    - connections idle longer than DB_POOL_HEALTHCHECK_IDLE are pinged before reuse
+    - checkouts held longer than DB_POOL_LEAK_SECONDS are reported by find_leaks()
+    """
+
+    def __init__(self, factory, min_size: int, max_size: int, timeout: float,
+                 healthcheck_idle: float, leak_seconds: float):
+        self._factory = factory
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self.leak_seconds = leak_seconds
+        self._cond = threading.Condition()
+        self._idle: List[Tuple[object, float]] = []   # (raw connection, idle since)
+        self._in_use: Dict[int, Tuple[float, str]] = {}  # id(raw) -> (checked out at, caller)
+        self._long_lived: set = set()  # id(raw) of checkouts held on purpose (streaming cursors)
+        self._size = 0
+        self._closed = False
+        self.stats = {
+            "acquired": 0, "waited": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0,
+            "timeouts": 0, "created": 0, "discarded": 0, "health_failures": 0,
+            "reclaimed": 0, "leaks_reported": 0,
+        }
+        for _ in range(self.min_size):
+            raw = self._factory()
+            self._size += 1
+            self.stats["created"] += 1
+            self._idle.append((raw, time.monotonic()))
+
+    def acquire(self, long_lived: bool = False) -> PooledConnection:
+        start = time.monotonic()
+        caller = self._caller_name()
+        create = False
+        waited = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("connection pool is closed")
+                if self._idle:
+                    raw, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    raw, idle_since, create = None, 0.0, True
+                    break
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    leaks = self._find_leaks_locked()
+                    raise PoolTimeout(
+                        f"no DB connection free after {self.timeout:.1f}s "
+                        f"(size={self._size}, held by: {', '.join(l['caller'] for l in leaks) or 'n/a'})"
+                    )
+                waited = True
+                self._cond.wait(remaining)
+
+        try:
+            if create:
+                raw = self._new_connection()
+            elif time.monotonic() - idle_since > self.healthcheck_idle and not self._is_healthy(raw):
+                self.stats["health_failures"] += 1
+                self._close_quietly(raw)
+                raw = self._new_connection()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        wait_ms = (time.monotonic() - start) * 1000
+        with self._cond:
+            self._in_use[id(raw)] = (time.monotonic(), caller)
+            if long_lived:
+                self._long_lived.add(id(raw))
+            self.stats["acquired"] += 1
+            if waited:
+                self.stats["waited"] += 1
+            self.stats["wait_ms_total"] += wait_ms
+            self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], wait_ms)
+        return PooledConnection(self, raw)
+
+    def release(self, raw):
+        # Never hand out a connection with a half-finished transaction
+        healthy = True
+        try:
+            raw.rollback()
+        except Exception:
+            healthy = False
+        with self._cond:
+            self._in_use.pop(id(raw), None)
+            self._long_lived.discard(id(raw))
+            if healthy and not self._closed:
+                self._idle.append((raw, time.monotonic()))
+            else:
+                self._size -= 1
+                self.stats["discarded"] += 1
+                self._close_quietly(raw)
+            self._cond.notify()
+
+    def find_leaks(self) -> List[Dict]:
+        """Checkouts held longer than leak_seconds (caller name + seconds held)."""
+        with self._cond:
+            return self._find_leaks_locked()
+
+    def snapshot(self) -> Dict:
+        with self._cond:
+            data = dict(self.stats)
+            data.update(size=self._size, idle=len(self._idle), in_use=len(self._in_use),
+                        max_size=self.max_size)
+        data["wait_ms_avg"] = data["wait_ms_total"] / data["acquired"] if data["acquired"] else 0.0
+        return data
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            for raw, _ in self._idle:
+                self._close_quietly(raw)
+            self._size -= len(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    def _find_leaks_locked(self) -> List[Dict]:
+        now = time.monotonic()
+        return [
+            {"caller": caller, "held_s": round(now - since, 1)}
+            for raw_id, (since, caller) in self._in_use.items()
+            if now - since > self.leak_seconds and raw_id not in self._long_lived
+        ]
+
+    def _new_connection(self):
+        raw = self._factory()
+        self.stats["created"] += 1
+        return raw
+
+    @staticmethod
+    def _is_healthy(raw) -> bool:
+        try:
+            if getattr(raw, "closed", 0):
+                return False
+            cur = raw.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            raw.rollback()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _caller_name() -> str:
+        # acquire() <- get_connection() <- helper
+        try:
+            return sys._getframe(3).f_code.co_name
+        except ValueError:
+            return "?"
+
+
+def _open_raw_connection():
+    """Open a new physical connection for the pool."""
     if USE_POSTGRES:
-        conn = psycopg2.connect(DATABASE_URL)
-        return conn
-    else:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
+        return psycopg2.connect(DATABASE_URL, connect_timeout=10)
+    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers proceed while a writer holds the lock; NORMAL sync is safe in WAL mode
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool() -> ConnectionPool:
+    """Return the process-wide connection pool, creating it on first use."""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(
+                    _open_raw_connection,
+                    min_size=DB_POOL_MIN,
+                    max_size=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    healthcheck_idle=DB_POOL_HEALTHCHECK_IDLE,
+                    leak_seconds=DB_POOL_LEAK_SECONDS,
+                )
+                logger.info(f"DB pool ready ({'PostgreSQL' if USE_POSTGRES else 'SQLite WAL'}, "
+                            f"min={DB_POOL_MIN}, max={DB_POOL_MAX})")
+    return _db_pool
+
+
+def close_db_pool():
+    """Close all idle pooled connections (called on shutdown)."""
+    if _db_pool is not None:
+        _db_pool.closeall()
+
+
+async def db_pool_watchdog(context: ContextTypes.DEFAULT_TYPE):
+    """Job: log pool metrics and any connection held past DB_POOL_LEAK_SECONDS."""
+    pool = get_db_pool()
+    leaks = pool.find_leaks()
+    if leaks:
+        pool.stats["leaks_reported"] += len(leaks)
+        logger.warning(f"DB pool: {len(leaks)} connection(s) held too long: {leaks}")
+    snap = pool.snapshot()
+    logger.info(
+        f"DB pool: size={snap['size']} in_use={snap['in_use']} idle={snap['idle']} "
+        f"acquired={snap['acquired']} waited={snap['waited']} "
+        f"wait_avg={snap['wait_ms_avg']:.1f}ms wait_max={snap['wait_ms_max']:.1f}ms "
+        f"timeouts={snap['timeouts']} reclaimed={snap['reclaimed']}"
+    )
+
+
+def _sql_hours_after(expr: str, hours: int) -> str:
+    """SQL expression for `expr` + N hours (expr is a column or CURRENT_TIMESTAMP)."""
+    if USE_POSTGRES:
+        return f"({expr} + INTERVAL '{int(hours)} hours')"
+    if expr == "CURRENT_TIMESTAMP":
+        expr = "'now'"
+    return f"datetime({expr}, '+{int(hours)} hours')"
+
+
+def get_connection():
+    """Check out a pooled connection (PostgreSQL if DATABASE_URL set, else SQLite).
+
+    conn.close() returns it to the pool.
+    """
+    return get_db_pool().acquire()
+
+
+def get_streaming_connection():
+    """Like get_connection(), for a checkout held for a whole stream (not reported as a leak)."""
+    return get_db_pool().acquire(long_lived=True)
 
 
 def db_param(index: int = 1) -> str:
@@ -1649,10 +2109,13 @@ def db_param(index: int = 1) -> str:
     return "%s" if USE_POSTGRES else "?"
 
 
-def init_db():
-    conn = get_connection()
-    c = conn.cursor()
+# --- Schema migrations ---
+# Each migration runs once and is recorded in schema_version. Add new ones at
+# the end of SCHEMA_MIGRATIONS with the next version number; never edit one
+# that has shipped. Statements must work on both PostgreSQL and SQLite.
 
+def _migrate_0001_baseline(conn, c):
+    """v6.4.0 schema: all tables plus the column migrations init_db used to re-run on every start."""
     if USE_POSTGRES:
         # PostgreSQL schema
         c.execute("""CREATE TABLE IF NOT EXISTS users (
@@ -1728,7 +2191,6 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )""")
         conn.commit()
-        logger.info("Database: PostgreSQL initialized")
     else:
         # SQLite schema
         c.execute("""CREATE TABLE IF NOT EXISTS users (
@@ -1803,7 +2265,6 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users(id)
         )""")
         conn.commit()
-        logger.info("Database: SQLite initialized")
 
     # Add referral columns to users table (both PostgreSQL and SQLite)
     referral_columns = [
@@ -2032,16 +2493,193 @@ def init_db():
         except Exception:
             conn.rollback()
 
+
+def _migrate_0002_hot_path_indexes(conn, c):
+    """Indexes for the predicates the bot filters and sorts on most."""
+    for stmt in (
+        # pending review queue, per-user doc counts, approved counts
+        "CREATE INDEX IF NOT EXISTS idx_documents_user_approved_uploaded ON documents(user_id, approved, uploaded_at)",
+        # per-user message history, delete_user
+        "CREATE INDEX IF NOT EXISTS idx_messages_user_created ON messages(user_id, created_at)",
+        # reminders and eligible-unpaid broadcasts
+        "CREATE INDEX IF NOT EXISTS idx_users_eligible_p2_updated ON users(eligible, phase2_paid, updated_at)",
+        # /pending payments and /recent
+        "CREATE INDEX IF NOT EXISTS idx_users_state_updated ON users(state, updated_at)",
+        # /broadcastcountry and /countries
+        "CREATE INDEX IF NOT EXISTS idx_users_country ON users(country_code)",
+        # /release and waitlist position
+        "CREATE INDEX IF NOT EXISTS idx_waitlist_notified_joined ON waitlist(notified, joined_at)",
+    ):
+        c.execute(stmt)
+
+
+def _migrate_0003_waitlist_positions(conn, c):
+    """Maintained waitlist.queue_position (1..n in join order) with an index."""
+    try:
+        c.execute("ALTER TABLE waitlist ADD COLUMN queue_position INTEGER")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+    _renumber_waitlist(c)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_waitlist_queue_position ON waitlist(queue_position)")
+
+
+def _migrate_0004_broadcast_jobs(conn, c):
+    """Persistent broadcast jobs; one deliveries row per (job, recipient)."""
+    id_col = "SERIAL PRIMARY KEY" if USE_POSTGRES else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    tid_col = "BIGINT" if USE_POSTGRES else "INTEGER"
+    c.execute(f"""CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id {id_col},
+        created_by {tid_col},
+        audience TEXT,
+        message TEXT,
+        status TEXT DEFAULT 'pending',
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )""")
+    c.execute(f"""CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        job_id INTEGER REFERENCES broadcast_jobs(id),
+        telegram_id {tid_col},
+        status TEXT DEFAULT 'pending',
+        delivered_at TIMESTAMP,
+        PRIMARY KEY (job_id, telegram_id)
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status ON broadcast_deliveries(job_id, status, telegram_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)")
+
+
+def _migrate_0005_reminder_schedule(conn, c):
+    """users.next_reminder_at (indexed) + reminder_log for exactly-once reminders per stage."""
+    try:
+        c.execute("ALTER TABLE users ADD COLUMN next_reminder_at TIMESTAMP")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+    tid_col = "BIGINT" if USE_POSTGRES else "INTEGER"
+    c.execute(f"""CREATE TABLE IF NOT EXISTS reminder_log (
+        telegram_id {tid_col},
+        stage TEXT,
+        status TEXT DEFAULT 'claimed',
+        run_id TEXT,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (telegram_id, stage)
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_reminder_log_run ON reminder_log(run_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_next_reminder ON users(next_reminder_at)")
+    # Everyone still in the funnel is due at the first stage boundary after their last activity
+    c.execute(f"""UPDATE users SET next_reminder_at = {_sql_hours_after('updated_at', REMINDER_STAGES[0][1])}
+        WHERE eligible = 1 AND phase2_paid = 0 AND next_reminder_at IS NULL""")
+
+
+def _migrate_0006_analysis_cache(conn, c):
+    """analysis_cache: document analysis results keyed by content hash, with file_unique_id lookup."""
+    c.execute("""CREATE TABLE IF NOT EXISTS analysis_cache (
+        sha256 TEXT,
+        kind TEXT,
+        file_unique_id TEXT,
+        result TEXT,
+        created_at TIMESTAMP,
+        PRIMARY KEY (sha256, kind)
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_file ON analysis_cache(file_unique_id, kind)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_created ON analysis_cache(created_at)")
+
+
+def _migrate_0007_analysis_jobs(conn, c):
+    """analysis_jobs: one pre-analysis job per document. Older documents are not queued here
+    (each may cost a vision call); /analizar queues them in bounded batches."""
+    c.execute("""CREATE TABLE IF NOT EXISTS analysis_jobs (
+        doc_id INTEGER PRIMARY KEY,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        last_error TEXT,
+        available_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status ON analysis_jobs(status, available_at)")
+
+
+def _migrate_0008_waitlist_unique_positions(conn, c):
+    """Repair duplicate positions left by concurrent joins, then make queue_position unique."""
+    _renumber_waitlist(c)
+    c.execute("DROP INDEX IF EXISTS idx_waitlist_queue_position")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_waitlist_queue_position_unique ON waitlist(queue_position)")
+
+
+SCHEMA_MIGRATIONS = [
+    (1, "baseline schema (v6.4.0)", _migrate_0001_baseline),
+    (2, "hot path indexes", _migrate_0002_hot_path_indexes),
+    (3, "waitlist queue positions", _migrate_0003_waitlist_positions),
+    (4, "broadcast jobs", _migrate_0004_broadcast_jobs),
+    (5, "reminder schedule", _migrate_0005_reminder_schedule),
+    (6, "analysis cache", _migrate_0006_analysis_cache),
+    (7, "document analysis jobs", _migrate_0007_analysis_jobs),
+    (8, "unique waitlist positions", _migrate_0008_waitlist_unique_positions),
+]
+
+
+def run_migrations(conn) -> List[int]:
+    """Apply pending SCHEMA_MIGRATIONS in order. Returns the versions applied."""
+    c = conn.cursor()
+    p = db_param()
+    c.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""")
     conn.commit()
-    conn.close()
+    c.execute("SELECT version FROM schema_version")
+    applied = {row[0] for row in c.fetchall()}
+
+    done = []
+    for version, name, migrate in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Schema migration {version}: {name}")
+        try:
+            migrate(conn, c)
+            c.execute(f"INSERT INTO schema_version (version, name) VALUES ({p}, {p})", (version, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.exception(f"Schema migration {version} failed")
+            raise
+        done.append(version)
+    return done
+
+
+def init_db():
+    conn = get_connection()
+    try:
+        applied = run_migrations(conn)
+    finally:
+        conn.close()
+    db_type = "PostgreSQL" if USE_POSTGRES else "SQLite"
+    latest = SCHEMA_MIGRATIONS[-1][0]
+    if applied:
+        logger.info(f"Database: {db_type} migrated to schema v{latest} (applied {applied})")
+    else:
+        logger.info(f"Database: {db_type} schema v{latest} up to date")
 
 
 # =============================================================================
 # CAPACITY & WAITLIST FUNCTIONS
 # =============================================================================
 
-def get_current_clients() -> int:
-    """Count users who have paid Phase 2 or higher."""
+# Capacity counter: number of users with phase2_paid = 1, loaded once and then
+# kept current by update_user()/delete_user() deltas. reconcile_capacity_counter()
+# (scheduled job) re-counts and corrects any drift.
+_capacity = {"clients": None}
+_capacity_lock = threading.Lock()
+
+
+def count_current_clients() -> int:
+    """True count of users who have paid Phase 2 or higher (table scan)."""
     conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT COUNT(*) FROM users WHERE phase2_paid = 1")
@@ -2050,6 +2688,40 @@ def get_current_clients() -> int:
     return row[0] if row else 0
 
 
+def get_current_clients() -> int:
+    """Users who have paid Phase 2 or higher (O(1) after the first call)."""
+    if _capacity["clients"] is None:
+        with _capacity_lock:
+            if _capacity["clients"] is None:
+                _capacity["clients"] = count_current_clients()
+    return _capacity["clients"]
+
+
+def adjust_current_clients(delta: int):
+    """Apply a phase2_paid change to the capacity counter."""
+    if not delta:
+        return
+    with _capacity_lock:
+        if _capacity["clients"] is not None:
+            _capacity["clients"] = max(0, _capacity["clients"] + delta)
+
+
+def reconcile_capacity_counter() -> Tuple[Optional[int], int]:
+    """Re-count phase2 clients and reset the counter. Returns (cached, actual)."""
+    actual = count_current_clients()
+    with _capacity_lock:
+        cached = _capacity["clients"]
+        _capacity["clients"] = actual
+    return cached, actual
+
+
+async def capacity_reconcile_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job: correct capacity counter drift (e.g. manual DB edits)."""
+    cached, actual = await run_db(reconcile_capacity_counter)
+    if cached is not None and cached != actual:
+        logger.warning(f"Capacity counter drift corrected: {cached} -> {actual}")
+
+
 def get_available_slots() -> int:
     return max(0, TOTAL_CAPACITY - get_current_clients())
 
@@ -2071,16 +2743,15 @@ def add_to_waitlist(telegram_id: int, name: str, country: str, docs_uploaded: in
     c = conn.cursor()
     p = db_param()
     try:
-        if USE_POSTGRES:
-            c.execute(f"""INSERT INTO waitlist (telegram_id, name, country, docs_uploaded)
-                VALUES ({p}, {p}, {p}, {p})
-                ON CONFLICT (telegram_id) DO UPDATE SET docs_uploaded = {p}""",
-                (telegram_id, name, country, docs_uploaded, docs_uploaded))
-        else:
-            c.execute(f"""INSERT OR REPLACE INTO waitlist (telegram_id, name, country, docs_uploaded)
-                VALUES ({p}, {p}, {p}, {p})""",
-                (telegram_id, name, country, docs_uploaded))
+        # New entries go to the back of the queue; re-joining keeps the original place.
+        # (WHERE 1=1 lets SQLite parse the upsert after INSERT ... SELECT.)
+        _lock_waitlist(c)
+        c.execute(f"""INSERT INTO waitlist (telegram_id, name, country, docs_uploaded, queue_position)
+            SELECT {p}, {p}, {p}, {p}, COALESCE(MAX(queue_position), 0) + 1 FROM waitlist WHERE 1=1
+            ON CONFLICT (telegram_id) DO UPDATE SET docs_uploaded = {p}""",
+            (telegram_id, name, country, docs_uploaded, docs_uploaded))
         conn.commit()
+        invalidate_admin_stats()
     except Exception as e:
         conn.rollback()
         logger.error(f"Error adding to waitlist: {e}")
@@ -2089,13 +2760,69 @@ def add_to_waitlist(telegram_id: int, name: str, country: str, docs_uploaded: in
 
 
 def get_waitlist_position(telegram_id: int) -> int:
+    """1-based place in the queue (indexed lookup of the maintained queue_position)."""
     conn = get_connection()
     c = conn.cursor()
     p = db_param()
-    c.execute(f"SELECT COUNT(*) FROM waitlist WHERE joined_at <= (SELECT joined_at FROM waitlist WHERE telegram_id = {p})", (telegram_id,))
+    c.execute(f"SELECT queue_position FROM waitlist WHERE telegram_id = {p}", (telegram_id,))
     row = c.fetchone()
     conn.close()
-    return row[0] if row else 0
+    return (row[0] or 0) if row else 0
+
+
+def _lock_waitlist(c):
+    """Serialize queue writers on PostgreSQL, so MAX(queue_position) + 1 and gap
+    closing never interleave (SQLite already has a single writer). Readers are not blocked."""
+    if USE_POSTGRES:
+        c.execute("LOCK TABLE waitlist IN SHARE ROW EXCLUSIVE MODE")
+
+
+def _close_waitlist_gap(c, position: int):
+    """Move everyone behind `position` up one place. Two passes through negative
+    values, so the unique index never sees a duplicate mid-statement."""
+    p = db_param()
+    c.execute(f"UPDATE waitlist SET queue_position = -queue_position WHERE queue_position > {p}", (position,))
+    c.execute("UPDATE waitlist SET queue_position = -queue_position - 1 WHERE queue_position < 0")
+
+
+def _renumber_waitlist(c):
+    """Compact queue_position to 1..n in join order (migrations / manual repair)."""
+    p = db_param()
+    _lock_waitlist(c)
+    c.execute("SELECT id FROM waitlist ORDER BY joined_at ASC, id ASC")
+    ids = [row[0] for row in c.fetchall()]
+    c.executemany(f"UPDATE waitlist SET queue_position = {p} WHERE id = {p}",
+                  [(-pos, wid) for pos, wid in enumerate(ids, start=1)])
+    c.execute("UPDATE waitlist SET queue_position = -queue_position WHERE queue_position < 0")
+
+
+def renumber_waitlist_positions():
+    conn = get_connection()
+    c = conn.cursor()
+    _renumber_waitlist(c)
+    conn.commit()
+    conn.close()
+
+
+def get_waitlist_page(page: int = 1, per_page: int = 20) -> Tuple[List[Dict], int]:
+    """One page of the queue in position order, plus the total. Uses the
+    position index as a keyset, not OFFSET: positions are unique and kept
+    contiguous (writers serialized by _lock_waitlist, gaps closed on delete)."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute("SELECT COUNT(*) FROM waitlist")
+    total = c.fetchone()[0]
+    start = (max(1, page) - 1) * per_page
+    c.execute(f"""SELECT queue_position, telegram_id, name, country, docs_uploaded, joined_at, notified
+        FROM waitlist WHERE queue_position > {p} ORDER BY queue_position ASC LIMIT {p}""", (start, per_page))
+    rows = [
+        {'position': r[0], 'telegram_id': r[1], 'name': r[2], 'country': r[3],
+         'docs_uploaded': r[4], 'joined_at': r[5], 'notified': bool(r[6])}
+        for r in c.fetchall()
+    ]
+    conn.close()
+    return rows, total
 
 
 def get_waitlist_stats() -> dict:
@@ -2128,22 +2855,31 @@ def get_waitlist_users(limit: int = 10, notified: bool = False) -> list:
         val = notified
     else:
         val = 1 if notified else 0
-    c.execute(f"SELECT telegram_id, name FROM waitlist WHERE notified = {p} ORDER BY joined_at ASC LIMIT {limit}", (val,))
+    c.execute(f"SELECT telegram_id, name FROM waitlist WHERE notified = {p} ORDER BY queue_position ASC LIMIT {limit}", (val,))
     rows = c.fetchall()
     conn.close()
     return [{'telegram_id': r[0], 'name': r[1]} for r in rows]
 
 
 def mark_waitlist_notified(telegram_id: int) -> None:
+    mark_waitlist_notified_bulk([telegram_id])
+
+
+def mark_waitlist_notified_bulk(telegram_ids: List[int]) -> int:
+    """Mark a whole release batch as notified in one UPDATE. Returns rows updated."""
+    if not telegram_ids:
+        return 0
     conn = get_connection()
     c = conn.cursor()
     p = db_param()
-    if USE_POSTGRES:
-        c.execute(f"UPDATE waitlist SET notified = TRUE WHERE telegram_id = {p}", (telegram_id,))
-    else:
-        c.execute(f"UPDATE waitlist SET notified = 1 WHERE telegram_id = {p}", (telegram_id,))
+    placeholders = ", ".join([p] * len(telegram_ids))
+    true_val = "TRUE" if USE_POSTGRES else "1"
+    c.execute(f"UPDATE waitlist SET notified = {true_val} WHERE telegram_id IN ({placeholders})", tuple(telegram_ids))
+    updated = c.rowcount
     conn.commit()
     conn.close()
+    invalidate_admin_stats()
+    return updated
 
 
 def is_on_waitlist(telegram_id: int) -> bool:
@@ -2156,6 +2892,229 @@ def is_on_waitlist(telegram_id: int) -> bool:
     return row is not None
 
 
+# =============================================================================
+# ADMIN STATISTICS
+# =============================================================================
+# /stats, /funnel and /revenue render from one snapshot computed in a single
+# statement (conditional aggregation over each table, cross-joined). The
+# snapshot is cached for STATS_CACHE_TTL seconds and dropped whenever a
+# payment, eligibility, document or waitlist write goes through the helpers.
+
+# update_user() fields that change a KPI
+_STATS_USER_FIELDS = {"eligible", "phase2_paid", "phase3_paid", "phase4_paid", "state"}
+
+_stats_cache: Dict = {"data": None, "at": 0.0}
+_stats_lock = threading.Lock()
+
+
+def invalidate_admin_stats():
+    """Drop the cached admin stats snapshot (next read recomputes)."""
+    _stats_cache["data"] = None
+
+
+def compute_admin_stats() -> Dict:
+    """Every admin KPI in one round-trip."""
+    true_val = "TRUE" if USE_POSTGRES else "1"
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(f"""SELECT u.*, d.*, d3.*, m.*, w.* FROM
+        (SELECT COUNT(*) AS total_users,
+            COALESCE(SUM(CASE WHEN eligible = 1 THEN 1 ELSE 0 END), 0) AS eligible,
+            COALESCE(SUM(CASE WHEN phase2_paid = 1 THEN 1 ELSE 0 END), 0) AS paid_p2,
+            COALESCE(SUM(CASE WHEN phase3_paid = 1 THEN 1 ELSE 0 END), 0) AS paid_p3,
+            COALESCE(SUM(CASE WHEN phase4_paid = 1 THEN 1 ELSE 0 END), 0) AS paid_p4
+         FROM users) u
+        CROSS JOIN
+        (SELECT COUNT(*) AS docs, COUNT(DISTINCT user_id) AS users_with_docs FROM documents) d
+        CROSS JOIN
+        (SELECT COUNT(*) AS users_3plus_docs FROM (
+            SELECT dd.user_id FROM documents dd JOIN users uu ON dd.user_id = uu.id
+            GROUP BY dd.user_id HAVING COUNT(*) >= 3) x) d3
+        CROSS JOIN
+        (SELECT COUNT(*) AS messages_in FROM messages WHERE direction = 'in') m
+        CROSS JOIN
+        (SELECT COUNT(*) AS waitlist_total,
+            COALESCE(SUM(CASE WHEN notified = {true_val} THEN 1 ELSE 0 END), 0) AS waitlist_notified,
+            COALESCE(SUM(CASE WHEN converted = {true_val} THEN 1 ELSE 0 END), 0) AS waitlist_converted
+         FROM waitlist) w""")
+    row = c.fetchone()
+    cols = [desc[0] for desc in c.description]
+    conn.close()
+    stats = {col: int(val or 0) for col, val in zip(cols, row)}
+    stats["available_slots"] = max(0, TOTAL_CAPACITY - stats["paid_p2"])
+    stats["computed_at"] = datetime.now()
+    return stats
+
+
+def get_admin_stats(max_age: float = None) -> Dict:
+    """Cached admin stats snapshot (recomputed when older than STATS_CACHE_TTL)."""
+    ttl = STATS_CACHE_TTL if max_age is None else max_age
+    with _stats_lock:
+        data = _stats_cache["data"]
+        if data is None or time.monotonic() - _stats_cache["at"] > ttl:
+            data = compute_admin_stats()
+            _stats_cache["data"] = data
+            _stats_cache["at"] = time.monotonic()
+        return data
+
+
+# =============================================================================
+# ANALYSIS CACHE
+# =============================================================================
+#
+# Vision and OCR results are content-addressed: keyed by the SHA-256 of the
+# downloaded bytes, with Telegram's file_unique_id as a second key so a re-sent
+# or forwarded file is recognised before it is downloaded. Rows live in
+# analysis_cache behind an in-process LRU. `kind` separates analysers (and
+# vision models); entries expire after ANALYSIS_CACHE_TTL_DAYS since vision
+# results contain names and addresses.
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _analysis_cache_cutoff() -> str:
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=ANALYSIS_CACHE_TTL_DAYS)
+    return cutoff.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def get_cached_analysis(kind: str, sha256: Optional[str] = None,
+                        file_unique_id: Optional[str] = None) -> Optional[Tuple[str, str]]:
+    """(sha256, result JSON) of a fresh cache row, looked up by hash or else by file_unique_id."""
+    if not sha256 and not file_unique_id:
+        return None
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    key_col, key = ("sha256", sha256) if sha256 else ("file_unique_id", file_unique_id)
+    c.execute(f"""SELECT sha256, result FROM analysis_cache
+        WHERE {key_col} = {p} AND kind = {p} AND created_at >= {p}
+        ORDER BY created_at DESC LIMIT 1""", (key, kind, _analysis_cache_cutoff()))
+    row = c.fetchone()
+    conn.close()
+    return (row[0], row[1]) if row else None
+
+
+def save_cached_analysis(kind: str, sha256: str, file_unique_id: Optional[str], result: str):
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    created_at = datetime.now(timezone.utc).replace(tzinfo=None).strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        c.execute(f"""INSERT INTO analysis_cache (sha256, kind, file_unique_id, result, created_at)
+            VALUES ({p}, {p}, {p}, {p}, {p})
+            ON CONFLICT (sha256, kind) DO UPDATE SET result = excluded.result,
+                file_unique_id = COALESCE(excluded.file_unique_id, analysis_cache.file_unique_id),
+                created_at = excluded.created_at""",
+            (sha256, kind, file_unique_id, result, created_at))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error saving analysis cache entry: {e}")
+    finally:
+        conn.close()
+
+
+def prune_analysis_cache() -> int:
+    """Delete expired cache rows. Returns the number removed."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"DELETE FROM analysis_cache WHERE created_at < {p}", (_analysis_cache_cutoff(),))
+    removed = c.rowcount
+    conn.commit()
+    conn.close()
+    return removed
+
+
+class AnalysisCache:
+    """
+    In-memory LRU in front of the analysis_cache table.
+    Results are kept as JSON strings, so every get() hands out a fresh dict.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max(0, max_entries)
+        self.ttl = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+        self._aliases: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stores": 0}
+
+    def _remember(self, kind: str, sha256: str, payload: str, file_unique_id: Optional[str] = None):
+        if not self.max_entries:
+            return
+        self._entries[(kind, sha256)] = (payload, time.monotonic() + self.ttl)
+        self._entries.move_to_end((kind, sha256))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        if file_unique_id:
+            self._aliases[(kind, file_unique_id)] = sha256
+            self._aliases.move_to_end((kind, file_unique_id))
+            while len(self._aliases) > self.max_entries:
+                self._aliases.popitem(last=False)
+
+    def _from_memory(self, kind: str, sha256: Optional[str], file_unique_id: Optional[str]) -> Optional[str]:
+        if not sha256 and file_unique_id:
+            sha256 = self._aliases.get((kind, file_unique_id))
+        entry = self._entries.get((kind, sha256)) if sha256 else None
+        if entry is None:
+            return None
+        payload, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[(kind, sha256)]
+            return None
+        self._entries.move_to_end((kind, sha256))
+        if file_unique_id:
+            self._remember(kind, sha256, payload, file_unique_id)
+        return payload
+
+    async def get(self, kind: str, sha256: Optional[str] = None,
+                  file_unique_id: Optional[str] = None) -> Optional[Dict]:
+        """
+        Cached result for a file, or None. A lookup by file_unique_id alone is a
+        pre-download probe; only lookups by hash count as misses.
+        """
+        payload = self._from_memory(kind, sha256, file_unique_id)
+        if payload is not None:
+            self.stats["memory_hits"] += 1
+            return json.loads(payload)
+        try:
+            row = await run_db(get_cached_analysis, kind, sha256, file_unique_id)
+        except Exception as e:
+            logger.warning(f"Analysis cache lookup failed: {e}")
+            row = None
+        if row is None:
+            if sha256:
+                self.stats["misses"] += 1
+            return None
+        digest, payload = row
+        self._remember(kind, digest, payload, file_unique_id)
+        self.stats["db_hits"] += 1
+        return json.loads(payload)
+
+    async def put(self, kind: str, sha256: str, file_unique_id: Optional[str], result: Dict):
+        payload = json.dumps(result, ensure_ascii=False, default=str)
+        self._remember(kind, sha256, payload, file_unique_id)
+        self.stats["stores"] += 1
+        await run_db(save_cached_analysis, kind, sha256, file_unique_id, payload)
+
+    def snapshot(self) -> Dict:
+        hits = self.stats["memory_hits"] + self.stats["db_hits"]
+        lookups = hits + self.stats["misses"]
+        return dict(self.stats, entries=len(self._entries),
+                    hit_rate=hits / lookups if lookups else 0.0)
+
+
+analysis_cache = AnalysisCache(ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL_DAYS * 86400)
+
+
+async def analysis_cache_prune_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job: drop analysis results older than ANALYSIS_CACHE_TTL_DAYS."""
+    removed = await run_db(prune_analysis_cache)
+    if removed:
+        logger.info(f"Analysis cache: pruned {removed} expired entries")
+
+
 # =============================================================================
 # CLAUDE VISION API DOCUMENT ANALYSIS
 # =============================================================================
@@ -2183,10 +3142,192 @@ def extract_json_from_response(text: str) -> str:
     return text.strip()
 
 
-async def analyze_document_with_claude(image_bytes: bytes) -> Dict:
+_MEDIA_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF", "application/pdf"),
+)
+
+
+def sniff_media_type(data: bytes) -> Optional[str]:
+    """Media type from the file's magic bytes (None if unrecognised)."""
+    for signature, media_type in _MEDIA_SIGNATURES:
+        if data.startswith(signature):
+            return media_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def _crop_uniform_border(image):
+    """Trim a near-uniform frame (table, scanner bed) around the document; keep the image if little would remain."""
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    diff = ImageChops.difference(image, background).convert("L").point(lambda v: 255 if v > 24 else 0)
+    bbox = diff.getbbox()
+    if not bbox:
+        return image
+    w, h = image.size
+    cw, ch = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    if cw * ch < 0.3 * w * h or (cw, ch) == (w, h):
+        return image
+    return image.crop(bbox)
+
+
+def prepare_vision_image(data: bytes) -> Tuple[bytes, str]:
+    """
+    Shrink an upload to what the vision model can use: auto-orient (EXIF),
+    crop uniform borders, downscale to VISION_MAX_EDGE and re-encode.
+    Returns (payload, media_type). PDFs and files Pillow cannot read are
+    passed through with their detected type; the original is kept when
+    re-encoding would not make it smaller.
+    """
+    media_type = sniff_media_type(data)
+    if media_type == "application/pdf" or not IMAGE_PREPROCESS:
+        return data, media_type or "image/jpeg"
+    try:
+        image = Image.open(BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            flat = Image.new("RGB", image.size, (255, 255, 255))
+            flat.paste(image, mask=image.getchannel("A"))
+            image = flat
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        original_size = image.size
+        image = _crop_uniform_border(image)
+        image.thumbnail((VISION_MAX_EDGE, VISION_MAX_EDGE), Image.LANCZOS)
+
+        out = BytesIO()
+        if VISION_IMAGE_FORMAT == "webp":
+            image.save(out, "WEBP", quality=VISION_IMAGE_QUALITY, method=4)
+            out_type = "image/webp"
+        else:
+            image.save(out, "JPEG", quality=VISION_IMAGE_QUALITY, optimize=True, progressive=True)
+            out_type = "image/jpeg"
+        encoded = out.getvalue()
+        if (len(encoded) >= len(data) and image.size == original_size
+                and media_type in ("image/jpeg", "image/png", "image/webp", "image/gif")):
+            return data, media_type
+        return encoded, out_type
+    except Exception as e:
+        logger.warning(f"Vision preprocessing failed, sending original: {e}")
+        return data, media_type or "image/jpeg"
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+    closed: calls pass. After `threshold` failures in a row it opens and
+    rejects calls for `cooldown` seconds, then lets a single trial call through
+    (half-open); its outcome closes or re-opens the circuit. A trial that ends
+    without an outcome (cancelled, or failed before reaching the service) must
+    be handed back with abandon_trial(), or no further trial is ever allowed.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def abandon_trial(self):
+        self._trial = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.threshold:
+            if self.opened_at is None or self._trial:
+                logger.warning(f"Circuit opened after {self.failures} consecutive failures "
+                               f"(retry in {self.cooldown:.0f}s)")
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+
+_claude_client = None
+_claude_semaphore = asyncio.Semaphore(max(1, CLAUDE_MAX_CONCURRENCY))
+claude_breaker = CircuitBreaker(CLAUDE_BREAKER_FAILURES, CLAUDE_BREAKER_COOLDOWN)
+claude_stats = {"calls": 0, "failures": 0, "rejected": 0, "in_flight": 0, "latency_total": 0.0,
+                "bytes_received": 0, "bytes_sent": 0}
+
+
+def get_claude_client():
+    """Process-wide AsyncAnthropic client; its connection pool keeps connections alive between calls."""
+    global _claude_client
+    if _claude_client is None:
+        _claude_client = anthropic.AsyncAnthropic(
+            api_key=ANTHROPIC_API_KEY,
+            timeout=CLAUDE_TIMEOUT_SECONDS,
+            max_retries=CLAUDE_MAX_RETRIES,
+        )
+    return _claude_client
+
+
+async def close_claude_client():
+    global _claude_client
+    if _claude_client is not None:
+        try:
+            await _claude_client.close()
+        except Exception as e:
+            logger.warning(f"Claude client close failed: {e}")
+        _claude_client = None
+
+
+def claude_snapshot() -> Dict:
+    """Vision call counters for /stats."""
+    done = claude_stats["calls"]
+    return {
+        "calls": done,
+        "failures": claude_stats["failures"],
+        "rejected": claude_stats["rejected"],
+        "in_flight": claude_stats["in_flight"],
+        "latency_avg": claude_stats["latency_total"] / done if done else 0.0,
+        "circuit": claude_breaker.state,
+        "bytes_received": claude_stats["bytes_received"],
+        "bytes_sent": claude_stats["bytes_sent"],
+    }
+
+
+def _is_claude_service_failure(exc: Exception) -> bool:
+    """Timeouts, connection errors, 429 and 5xx count against the breaker; bad requests do not."""
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return True
+
+
+async def analyze_document_with_claude(image_bytes: bytes, file_unique_id: Optional[str] = None) -> Dict:
     """
     Analyze a document image using Claude Vision API.
     Returns structured analysis with type, confidence, and extracted data.
+    Successful analyses are cached by content hash (and file_unique_id when given).
     """
     if not ANTHROPIC_AVAILABLE or not ANTHROPIC_API_KEY:
         logger.warning("Claude Vision API not available: ANTHROPIC_AVAILABLE=%s, API_KEY set=%s",
@@ -2198,19 +3339,33 @@ async def analyze_document_with_claude(image_bytes: bytes) -> Dict:
             "confidence": 0.0,
         }
 
-    response_text = ""
-    try:
-        logger.info("DEBUG: Creating Anthropic client (key length=%d, starts_with=%s)",
-                     len(ANTHROPIC_API_KEY), ANTHROPIC_API_KEY[:8] + "..." if len(ANTHROPIC_API_KEY) > 8 else "SHORT")
-        client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+    digest = content_hash(image_bytes)
+    cache_kind = f"vision:{CLAUDE_MODEL}"
+    cached = await analysis_cache.get(cache_kind, sha256=digest, file_unique_id=file_unique_id)
+    if cached is not None:
+        logger.info("Claude Vision analysis served from cache (%s)", digest[:12])
+        return cached
 
-        # Encode image to base64
-        image_base64 = base64.b64encode(image_bytes).decode("utf-8")
-        logger.info("DEBUG: Sending image to Claude Vision API (%d bytes, base64 length=%d)",
-                     len(image_bytes), len(image_base64))
+    trial = claude_breaker.state == "half-open"
+    if not claude_breaker.allow():
+        claude_stats["rejected"] += 1
+        return {
+            "success": False,
+            "error": "Claude Vision temporarily unavailable (circuit open)",
+            "type": "unknown",
+            "confidence": 0.0,
+        }
 
-        # Determine media type (assume JPEG for photos from Telegram)
-        media_type = "image/jpeg"
+    response_text = ""
+    try:
+        # Orient, crop, downscale and re-encode off the event loop
+        payload, media_type = await asyncio.get_running_loop().run_in_executor(
+            None, prepare_vision_image, image_bytes)
+        claude_stats["bytes_received"] += len(image_bytes)
+        claude_stats["bytes_sent"] += len(payload)
+        image_base64 = base64.b64encode(payload).decode("utf-8")
+        logger.info("Sending %s to Claude Vision API (%d -> %d bytes)",
+                    media_type, len(image_bytes), len(payload))
 
         prompt = """Analiza este documento y devuelve SOLO un objeto JSON válido, sin texto adicional ni bloques de código:
 
@@ -2248,15 +3403,15 @@ Problemas comunes a detectar:
 - No se ve el nombre claramente
 - No se ve la fecha claramente"""
 
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
+        request = dict(
+            model=CLAUDE_MODEL,
             max_tokens=1024,
             messages=[
                 {
                     "role": "user",
                     "content": [
                         {
-                            "type": "image",
+                            "type": "document" if media_type == "application/pdf" else "image",
                             "source": {
                                 "type": "base64",
                                 "media_type": media_type,
@@ -2271,6 +3426,26 @@ Problemas comunes a detectar:
                 }
             ],
         )
+        async with _claude_semaphore:
+            claude_stats["in_flight"] += 1
+            started = time.monotonic()
+            try:
+                # The SDK timeout covers each attempt; wait_for bounds the whole call incl. retries
+                message = await asyncio.wait_for(
+                    get_claude_client().messages.create(**request),
+                    CLAUDE_TIMEOUT_SECONDS * (CLAUDE_MAX_RETRIES + 1) + 5)
+            except Exception as e:
+                claude_stats["failures"] += 1
+                if _is_claude_service_failure(e):
+                    claude_breaker.record_failure()
+                else:
+                    claude_breaker.record_success()
+                raise
+            finally:
+                claude_stats["in_flight"] -= 1
+            claude_stats["calls"] += 1
+            claude_stats["latency_total"] += time.monotonic() - started
+        claude_breaker.record_success()
 
         # Parse the response
         logger.info("DEBUG: API response received. stop_reason=%s, content_blocks=%d",
@@ -2320,6 +3495,10 @@ Problemas comunes a detectar:
         logger.info("Claude Vision analysis: type=%s, confidence=%.2f, name=%s",
                      analysis.get('type'), analysis['confidence'],
                      analysis.get('extracted_name', 'N/A'))
+        try:
+            await analysis_cache.put(cache_kind, digest, file_unique_id, analysis)
+        except Exception as e:
+            logger.warning(f"Analysis cache store failed: {e}")
         return analysis
 
     except json.JSONDecodeError as e:
@@ -2333,7 +3512,7 @@ Problemas comunes a detectar:
             "raw_response": response_text,
         }
     except Exception as e:
-        logger.error(f"Claude Vision API error: {e}")
+        logger.error(f"Claude Vision API error: {type(e).__name__}: {e}")
         logger.error(f"Response text: {response_text[:500] if response_text else 'empty'}")
         return {
             "success": False,
@@ -2341,6 +3520,10 @@ Problemas comunes a detectar:
             "type": "unknown",
             "confidence": 0.0,
         }
+    finally:
+        if trial:
+            # No-op once the trial recorded its outcome; frees the slot after a cancellation
+            claude_breaker.abandon_trial()
 
 
 def get_doc_type_from_ai(ai_type: str) -> str:
@@ -2349,10 +3532,10 @@ def get_doc_type_from_ai(ai_type: str) -> str:
         "passport": "passport",
         "nie": "nie",
         "dni": "dni",
-        "utility_bill": "utility",
-        "bank_statement": "bank",
-        "rental_contract": "rent",
-        "work_contract": "work",
+        "utility_bill": "utility_bill",
+        "bank_statement": "bank_statement",
+        "rental_contract": "rental",
+        "work_contract": "work_informal",
         "antecedentes": "antecedentes",
         "empadronamiento": "empadronamiento",
         "other": "other",
@@ -2381,7 +3564,26 @@ def get_user(tid: int) -> Optional[Dict]:
     return result
 
 
-def create_user(tid: int, first_name: str) -> Dict:
+def get_user_snapshot(tid: int) -> Tuple[Optional[Dict], int, int]:
+    """Users row plus total/approved document counts in a single round-trip."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"""SELECT u.*,
+        (SELECT COUNT(*) FROM documents d WHERE d.user_id = u.id) AS snapshot_doc_count,
+        (SELECT COUNT(*) FROM documents d WHERE d.user_id = u.id AND d.approved = 1) AS snapshot_approved_count
+        FROM users u WHERE u.telegram_id = {p}""", (tid,))
+    row = c.fetchone()
+    result = _row_to_dict(row, c)
+    conn.close()
+    if result is None:
+        return None, 0, 0
+    dc = result.pop("snapshot_doc_count") or 0
+    approved = result.pop("snapshot_approved_count") or 0
+    return result, int(dc), int(approved)
+
+
+def create_user(tid: int, first_name: str) -> Dict:
     conn = get_connection()
     c = conn.cursor()
     p = db_param()
@@ -2398,21 +3600,46 @@ def update_user(tid: int, **kw):
     conn = get_connection()
     c = conn.cursor()
     p = db_param()
-    fields = ", ".join(f"{k} = {p}" for k in kw)
-    vals = list(kw.values()) + [tid]
-    c.execute(f"UPDATE users SET {fields}, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = {p}", vals)
-    conn.commit()
-    conn.close()
+    old_paid = None
+    try:
+        if "phase2_paid" in kw:
+            # Lock the row while reading the previous value, so two concurrent
+            # updates cannot both count the same transition in the capacity counter
+            if USE_POSTGRES:
+                c.execute(f"SELECT phase2_paid FROM users WHERE telegram_id = {p} FOR UPDATE", (tid,))
+            else:
+                c.execute("BEGIN IMMEDIATE")
+                c.execute(f"SELECT phase2_paid FROM users WHERE telegram_id = {p}", (tid,))
+            row = c.fetchone()
+            old_paid = (row[0] or 0) if row else None
+        fields = ", ".join(f"{k} = {p}" for k in kw)
+        vals = list(kw.values()) + [tid]
+        # Any activity restarts the reminder ladder from its first stage
+        c.execute(f"""UPDATE users SET {fields}, updated_at = CURRENT_TIMESTAMP,
+            next_reminder_at = {_sql_hours_after('CURRENT_TIMESTAMP', REMINDER_STAGES[0][1])}
+            WHERE telegram_id = {p}""", vals)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if old_paid is not None:
+        adjust_current_clients((1 if kw["phase2_paid"] == 1 else 0) - (1 if old_paid == 1 else 0))
+    if _STATS_USER_FIELDS.intersection(kw):
+        invalidate_admin_stats()
 
 
 def delete_user(tid: int):
     conn = get_connection()
     c = conn.cursor()
     p = db_param()
-    c.execute(f"SELECT id FROM users WHERE telegram_id = {p}", (tid,))
+    c.execute(f"SELECT id, phase2_paid FROM users WHERE telegram_id = {p}", (tid,))
     row = c.fetchone()
+    was_paid = bool(row and row[1] == 1)
     if row:
         uid = row[0]
+        c.execute(f"DELETE FROM analysis_jobs WHERE doc_id IN (SELECT id FROM documents WHERE user_id = {p})", (uid,))
         c.execute(f"DELETE FROM documents WHERE user_id = {p}", (uid,))
         c.execute(f"DELETE FROM cases WHERE user_id = {p}", (uid,))
         c.execute(f"DELETE FROM messages WHERE user_id = {p}", (uid,))
@@ -2430,189 +3657,1842 @@ def delete_user(tid: int):
         except Exception:
             pass
         try:
-            c.execute(f"DELETE FROM waitlist WHERE telegram_id = {p}", (tid,))
+            c.execute(f"DELETE FROM reminder_log WHERE telegram_id = {p}", (tid,))
+        except Exception:
+            pass
+        try:
+            _lock_waitlist(c)
+            c.execute(f"DELETE FROM waitlist WHERE telegram_id = {p} RETURNING queue_position", (tid,))
+            removed = c.fetchone()
+            if removed and removed[0]:
+                _close_waitlist_gap(c, removed[0])
         except Exception:
             pass
         c.execute(f"DELETE FROM users WHERE id = {p}", (uid,))
     conn.commit()
     conn.close()
+    if was_paid:
+        adjust_current_clients(-1)
+
+
+def delete_user_docs_and_cases(tid: int):
+    """Delete a user's documents and cases but keep the account and message history."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"SELECT id FROM users WHERE telegram_id = {p}", (tid,))
+    row = c.fetchone()
+    if row:
+        uid = row[0]
+        c.execute(f"DELETE FROM analysis_jobs WHERE doc_id IN (SELECT id FROM documents WHERE user_id = {p})", (uid,))
+        c.execute(f"DELETE FROM documents WHERE user_id = {p}", (uid,))
+        c.execute(f"DELETE FROM cases WHERE user_id = {p}", (uid,))
+    conn.commit()
+    conn.close()
+
+
+def get_doc_count(tid: int) -> int:
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"SELECT COUNT(*) FROM documents d JOIN users u ON d.user_id=u.id WHERE u.telegram_id={p}", (tid,))
+    n = c.fetchone()[0]
+    conn.close()
+    return n
+
+
+def get_approved_doc_count(tid: int) -> int:
+    """Count only approved documents for a user."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"SELECT COUNT(*) FROM documents d JOIN users u ON d.user_id=u.id WHERE u.telegram_id={p} AND d.approved=1", (tid,))
+    n = c.fetchone()[0]
+    conn.close()
+    return n
+
+
+def get_pending_documents(limit: int = 20) -> List[Dict]:
+    """Get documents pending admin review (approved=0)."""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT d.*, u.telegram_id, u.first_name
+        FROM documents d
+        JOIN users u ON d.user_id = u.id
+        WHERE d.approved = 0
+        ORDER BY d.uploaded_at DESC
+        LIMIT {limit}
+    """)
+    rows = c.fetchall()
+    result = [_row_to_dict(r, c) for r in rows]
+    conn.close()
+    return result
+
+
+def get_pending_document(doc_id: int) -> Optional[Dict]:
+    """One document in the same shape as get_pending_documents()."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"""
+        SELECT d.*, u.telegram_id, u.first_name
+        FROM documents d
+        JOIN users u ON d.user_id = u.id
+        WHERE d.id = {p}
+    """, (doc_id,))
+    row = c.fetchone()
+    result = _row_to_dict(row, c) if row else None
+    conn.close()
+    return result
+
+
+def update_document_approval(doc_id: int, approved: int) -> bool:
+    """Update document approval status. approved: 1=approved, -1=rejected"""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"UPDATE documents SET approved={p} WHERE id={p}", (approved, doc_id))
+    affected = c.rowcount
+    conn.commit()
+    conn.close()
+    invalidate_admin_stats()
+    return affected > 0
+
+
+def get_document_by_id(doc_id: int) -> Optional[Dict]:
+    """Get a document by its ID."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"""
+        SELECT d.*, u.telegram_id, u.first_name
+        FROM documents d
+        JOIN users u ON d.user_id = u.id
+        WHERE d.id = {p}
+    """, (doc_id,))
+    row = c.fetchone()
+    result = _row_to_dict(row, c)
+    conn.close()
+    return result
+
+
+def get_user_docs(tid: int) -> List[Dict]:
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"SELECT d.* FROM documents d JOIN users u ON d.user_id=u.id WHERE u.telegram_id={p} ORDER BY d.uploaded_at DESC", (tid,))
+    rows = c.fetchall()
+    result = [_row_to_dict(r, c) for r in rows]
+    conn.close()
+    return result
+
+
+def get_user_doc_by_type(tid: int, doc_type: str) -> Optional[Dict]:
+    """Get a user's existing document of a specific type, if any."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(
+        f"SELECT d.* FROM documents d JOIN users u ON d.user_id=u.id "
+        f"WHERE u.telegram_id={p} AND d.doc_type={p} ORDER BY d.uploaded_at DESC LIMIT 1",
+        (tid, doc_type))
+    row = c.fetchone()
+    result = _row_to_dict(row, c)
+    conn.close()
+    return result
+
+
+def delete_document(doc_id: int):
+    """Delete a document by ID."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"DELETE FROM analysis_jobs WHERE doc_id={p}", (doc_id,))
+    c.execute(f"DELETE FROM documents WHERE id={p}", (doc_id,))
+    conn.commit()
+    conn.close()
+
+
+def save_document(
+    tid: int,
+    doc_type: str,
+    file_id: str,
+    ocr_text: str = "",
+    detected_type: str = "",
+    score: int = 0,
+    notes: str = "",
+    ai_analysis: str = "",
+    ai_confidence: float = 0.0,
+    ai_type: str = "",
+    extracted_name: str = "",
+    extracted_address: str = "",
+    extracted_date: str = "",
+    approved: int = 0,
+    document_country: str = "",
+    expiry_date: str = "",
+    issues: str = "",
+) -> int:
+    """Save document and return the document ID."""
+    result = ingest_document(
+        tid, doc_type, file_id, ocr_text=ocr_text, detected_type=detected_type, score=score,
+        notes=notes, ai_analysis=ai_analysis, ai_confidence=ai_confidence, ai_type=ai_type,
+        extracted_name=extracted_name, extracted_address=extracted_address,
+        extracted_date=extracted_date, approved=approved, document_country=document_country,
+        expiry_date=expiry_date, issues=issues)
+    return result['doc_id'] if result else None
+
+
+_DOCUMENT_INSERT_COLUMNS = (
+    "doc_type, file_id, ocr_text, detected_type, validation_score, validation_notes, "
+    "ai_analysis, ai_confidence, ai_type, extracted_name, extracted_address, extracted_date, "
+    "approved, document_country, expiry_date, issues"
+)
+
+
+def ingest_document(
+    tid: int,
+    doc_type: str,
+    file_id: str,
+    ocr_text: str = "",
+    detected_type: str = "",
+    score: int = 0,
+    notes: str = "",
+    ai_analysis: str = "",
+    ai_confidence: float = 0.0,
+    ai_type: str = "",
+    extracted_name: str = "",
+    extracted_address: str = "",
+    extracted_date: str = "",
+    approved: int = 0,
+    document_country: str = "",
+    expiry_date: str = "",
+    issues: str = "",
+    enqueue_analysis: bool = False,
+) -> Optional[Dict]:
+    """Insert a document and read back what the upload handlers need, on one connection.
+
+    Returns {doc_id, doc_count, approved_count, first_name, full_name}, or None
+    if the user does not exist. PostgreSQL does it in a single statement
+    (data-modifying CTE); SQLite uses INSERT ... RETURNING plus one SELECT in
+    the same transaction. With enqueue_analysis an analysis_jobs row is added
+    in the same transaction.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    values = (doc_type, file_id, ocr_text, detected_type, score, notes,
+              ai_analysis, ai_confidence, ai_type, extracted_name, extracted_address, extracted_date,
+              approved, document_country, expiry_date, issues)
+    placeholders = ", ".join([p] * len(values))
+    try:
+        if USE_POSTGRES:
+            # The CTE's INSERT is not visible to the sibling subqueries (same
+            # snapshot), so the new row is added to the counts explicitly.
+            c.execute(f"""WITH u AS (
+                    SELECT id, first_name, full_name FROM users WHERE telegram_id = {p}
+                ), ins AS (
+                    INSERT INTO documents (user_id, {_DOCUMENT_INSERT_COLUMNS})
+                    SELECT u.id, {placeholders} FROM u
+                    RETURNING id, user_id, approved
+                ){", job AS (INSERT INTO analysis_jobs (doc_id) SELECT id FROM ins)" if enqueue_analysis else ""}
+                SELECT ins.id,
+                    (SELECT COUNT(*) FROM documents d WHERE d.user_id = ins.user_id) + 1,
+                    (SELECT COUNT(*) FROM documents d WHERE d.user_id = ins.user_id AND d.approved = 1)
+                        + CASE WHEN ins.approved = 1 THEN 1 ELSE 0 END,
+                    u.first_name, u.full_name
+                FROM ins JOIN u ON u.id = ins.user_id""",
+                (tid,) + values)
+            row = c.fetchone()
+        else:
+            c.execute(f"""INSERT INTO documents (user_id, {_DOCUMENT_INSERT_COLUMNS})
+                SELECT id, {placeholders} FROM users WHERE telegram_id = {p}
+                RETURNING id, user_id""",
+                values + (tid,))
+            inserted = c.fetchone()
+            row = None
+            if inserted and enqueue_analysis:
+                c.execute(f"INSERT INTO analysis_jobs (doc_id) VALUES ({p})", (inserted[0],))
+            if inserted:
+                c.execute(f"""SELECT {p},
+                        (SELECT COUNT(*) FROM documents WHERE user_id = u.id),
+                        (SELECT COUNT(*) FROM documents WHERE user_id = u.id AND approved = 1),
+                        u.first_name, u.full_name
+                    FROM users u WHERE u.id = {p}""",
+                    (inserted[0], inserted[1]))
+                row = c.fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if not row:
+        return None
+    return {
+        'doc_id': row[0],
+        'doc_count': row[1],
+        'approved_count': row[2],
+        'first_name': row[3],
+        'full_name': row[4],
+    }
+
+
+_DOCUMENT_BATCH_FIELDS = ("doc_type", "file_id", "ocr_text", "detected_type", "score", "notes")
+
+
+def ingest_documents(tid: int, docs: List[Dict], enqueue_analysis: bool = False) -> Optional[Dict]:
+    """Insert several pending-review documents for one user with a single multi-row
+    INSERT ... RETURNING, then read doc counts and the user's name in the same
+    transaction. Returns {doc_ids, doc_count, approved_count, first_name, full_name}
+    or None if the user does not exist. `docs` items carry _DOCUMENT_BATCH_FIELDS.
+    With enqueue_analysis one analysis_jobs row per document is added as well.
+    """
+    if not docs:
+        return None
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    try:
+        c.execute(f"SELECT id, first_name, full_name FROM users WHERE telegram_id = {p}", (tid,))
+        user = c.fetchone()
+        if not user:
+            return None
+        uid = user[0]
+        row_sql = f"({p}, {p}, {p}, {p}, {p}, {p}, {p}, 0)"
+        params = []
+        for d in docs:
+            params.extend([uid] + [d.get(f, "") for f in _DOCUMENT_BATCH_FIELDS])
+        c.execute(f"""INSERT INTO documents (user_id, doc_type, file_id, ocr_text, detected_type,
+                validation_score, validation_notes, approved)
+            VALUES {", ".join([row_sql] * len(docs))}
+            RETURNING id""", tuple(params))
+        doc_ids = sorted(r[0] for r in c.fetchall())
+        if enqueue_analysis:
+            c.execute(f"INSERT INTO analysis_jobs (doc_id) VALUES {', '.join([f'({p})'] * len(doc_ids))}",
+                      tuple(doc_ids))
+        c.execute(f"""SELECT COUNT(*), COALESCE(SUM(CASE WHEN approved = 1 THEN 1 ELSE 0 END), 0)
+            FROM documents WHERE user_id = {p}""", (uid,))
+        counts = c.fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return {
+        'doc_ids': doc_ids,
+        'doc_count': counts[0],
+        'approved_count': counts[1],
+        'first_name': user[1],
+        'full_name': user[2],
+    }
+
+
+def save_message(tid: int, direction: str, content: str, intent: str = ""):
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"""INSERT INTO messages (user_id, direction, content, intent)
+        SELECT id, {p}, {p}, {p} FROM users WHERE telegram_id = {p}""",
+        (direction, content[:500], intent, tid))
+    conn.commit()
+    conn.close()
+
+
+def save_messages_batch(rows: List[Tuple]):
+    """Insert many (telegram_id, direction, content, intent, created_at) rows in one statement."""
+    if not rows:
+        return
+    conn = get_connection()
+    c = conn.cursor()
+    if USE_POSTGRES:
+        execute_values(c, """INSERT INTO messages (user_id, direction, content, intent, created_at)
+            SELECT u.id, v.direction, v.content, v.intent, v.created_at
+            FROM (VALUES %s) AS v(telegram_id, direction, content, intent, created_at)
+            JOIN users u ON u.telegram_id = v.telegram_id""", rows,
+            template="(%s, %s, %s, %s, %s::timestamp)")  # VALUES would type the string column as text
+    else:
+        c.executemany("""INSERT INTO messages (user_id, direction, content, intent, created_at)
+            SELECT id, ?, ?, ?, ? FROM users WHERE telegram_id = ?""",
+            [(d, content, intent, ts, tid) for tid, d, content, intent, ts in rows])
+    conn.commit()
+    conn.close()
+
+
+def get_or_create_case(tid: int) -> Dict:
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"SELECT c.* FROM cases c JOIN users u ON c.user_id=u.id WHERE u.telegram_id={p}", (tid,))
+    case = c.fetchone()
+    if not case:
+        import random
+        cn = f"PH-2026-{random.randint(1000, 9999)}"
+        c.execute(f"INSERT INTO cases (user_id, case_number) SELECT id, {p} FROM users WHERE telegram_id={p}", (cn, tid))
+        conn.commit()
+        c.execute(f"SELECT * FROM cases WHERE case_number={p}", (cn,))
+        case = c.fetchone()
+    result = _row_to_dict(case, c)
+    conn.close()
+    return result
+
+
+# =============================================================================
+# ASYNC DATA ACCESS
+# =============================================================================
+# Every DB helper above is blocking (psycopg2 / sqlite3). Handlers await them
+# through a bounded thread pool so one slow query never stalls run_polling.
+# The pool is no larger than the connection pool, so worker threads never queue
+# on get_connection().
+
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX)))
+_db_executor = ThreadPoolExecutor(
+    max_workers=max(1, min(DB_EXECUTOR_WORKERS, DB_POOL_MAX)),
+    thread_name_prefix="db",
+)
+
+
+async def _run_blocking(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking DB helper on the DB thread pool and await its result.
+
+    Inside an update, pending update_user writes are flushed first so the helper
+    reads its own writes, and helpers that rewrite users/documents drop the cache.
+    """
+    uow = _current_uow.get()
+    if uow is not None and uow.pending:
+        await uow.flush()
+    result = await _run_blocking(fn, *args, **kwargs)
+    if uow is not None and getattr(fn, "__name__", "") in _UOW_INVALIDATING_HELPERS:
+        uow.invalidate()
+    return result
+
+
+# --- Per-update unit of work ---
+# One UnitOfWork lives for the duration of Application.process_update (see
+# PHApplication). It loads each users row + doc counts once, serves later reads
+# from memory and coalesces update_user() calls into one UPDATE at the end.
+# Writes to _UOW_WRITE_THROUGH_FIELDS (payment, phase, consent) are flushed at
+# once, so a handler never confirms a change that is not yet stored. Background
+# tasks started during an update get a fresh contextvars.Context() so they do
+# not inherit the update's unit of work.
+
+_current_uow: "contextvars.ContextVar[Optional[UnitOfWork]]" = contextvars.ContextVar("ph_bot_uow", default=None)
+
+# Helpers that write users/documents/cases behind the cache's back
+_UOW_INVALIDATING_HELPERS = {
+    "delete_user", "delete_user_docs_and_cases", "delete_document", "update_document_approval",
+    "apply_referral_code_to_user", "apply_institutional_referral", "apply_friend_discount",
+    "credit_referrer", "credit_institutional_partner", "unlock_referrer_tier",
+    "update_referrer_progress", "db_execute",
+}
+
+
+# update_user() fields that are persisted immediately instead of at the end of the update
+_UOW_WRITE_THROUGH_FIELDS = {
+    "current_phase", "eligible", "expediente_ready", "phase2_paid", "phase3_paid", "phase4_paid",
+    "marketing_consent", "research_consent",
+}
+
+
+class UnitOfWork:
+    """Request-scoped identity map for users rows, doc counts and cases."""
+
+    def __init__(self):
+        self.users: Dict[int, Optional[Dict]] = {}
+        self.doc_counts: Dict[int, List[int]] = {}   # tid -> [total, approved]
+        self.cases: Dict[int, Dict] = {}
+        self.pending: Dict[int, Dict] = {}
+
+    async def get_user(self, tid: int) -> Optional[Dict]:
+        if tid not in self.users:
+            user, dc, approved = await _run_blocking(get_user_snapshot, tid)
+            self.users[tid] = user
+            self.doc_counts[tid] = [dc, approved]
+        user = self.users[tid]
+        return dict(user) if user is not None else None
+
+    async def doc_counts_for(self, tid: int) -> List[int]:
+        if tid not in self.doc_counts:
+            await self.get_user(tid)
+        return self.doc_counts[tid]
+
+    def update_user(self, tid: int, **kw):
+        if not kw:
+            return
+        self.pending.setdefault(tid, {}).update(kw)
+        if self.users.get(tid) is not None:
+            self.users[tid].update(kw)
+
+    def remember_user(self, tid: int, user: Optional[Dict]):
+        self.users[tid] = dict(user) if user is not None else None
+        self.doc_counts.setdefault(tid, [0, 0])
+
+    def invalidate(self):
+        self.users.clear()
+        self.doc_counts.clear()
+        self.cases.clear()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        for tid, kw in pending.items():
+            await _run_blocking(update_user, tid, **kw)
+
+
+def db_fetchall(query: str, params: tuple = ()) -> List:
+    """Run a read-only query and return all rows (for use with run_db)."""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(query, params)
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+
+def db_counts(queries: List[str]) -> List[int]:
+    """Run several single-value COUNT queries on one connection (for use with run_db)."""
+    conn = get_connection()
+    c = conn.cursor()
+    results = []
+    for query in queries:
+        c.execute(query)
+        results.append(c.fetchone()[0])
+    conn.close()
+    return results
+
+
+def db_execute(query: str, params: tuple = ()):
+    """Run a single write statement and commit (for use with run_db)."""
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute(query, params)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def db_fetchone(query: str, params: tuple = ()):
+    """Run a read-only query and return the first row (for use with run_db)."""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(query, params)
+    row = c.fetchone()
+    conn.close()
+    return row
+
+
+def _open_stream(query: str, params: tuple, chunk_size: int):
+    """Open a server-side (named) cursor on a dedicated connection. PostgreSQL only."""
+    conn = get_streaming_connection()
+    try:
+        c = conn.cursor(name=f"stream_{id(conn):x}_{time.monotonic_ns():x}")
+        c.itersize = chunk_size
+        c.execute(query, params)
+    except Exception:
+        conn.close()
+        raise
+    return conn, c
+
+
+def _close_stream(conn, c):
+    try:
+        c.close()
+    finally:
+        conn.close()
+
+
+async def stream_rows(
+    table: str,
+    columns: List[str],
+    key: str,
+    where: str = "",
+    params: tuple = (),
+    descending: bool = False,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+) -> AsyncIterator[tuple]:
+    """Yield `SELECT columns FROM table WHERE where ORDER BY key` row by row
+    without loading the result set.
+
+    PostgreSQL: one named (server-side) cursor, fetched chunk_size rows at a time.
+    SQLite: keyset pagination on `key` (must be unique), one short query per chunk.
+    Rows are tuples of `columns`.
+    """
+    order = "DESC" if descending else "ASC"
+    select = ", ".join([key] + list(columns))
+    where_sql = f"({where})" if where else "1=1"
+    if USE_POSTGRES:
+        conn, c = await _run_blocking(
+            _open_stream, f"SELECT {select} FROM {table} WHERE {where_sql} ORDER BY {key} {order}",
+            params, chunk_size)
+        try:
+            while True:
+                rows = await _run_blocking(c.fetchmany, chunk_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield tuple(row[1:])
+        finally:
+            await _run_blocking(_close_stream, conn, c)
+    else:
+        p = db_param()
+        op = "<" if descending else ">"
+        last = None
+        while True:
+            if last is None:
+                query = f"SELECT {select} FROM {table} WHERE {where_sql} ORDER BY {key} {order} LIMIT {p}"
+                args = params + (chunk_size,)
+            else:
+                query = (f"SELECT {select} FROM {table} WHERE {where_sql} AND {key} {op} {p} "
+                         f"ORDER BY {key} {order} LIMIT {p}")
+                args = params + (last, chunk_size)
+            rows = await run_db(db_fetchall, query, args)
+            for row in rows:
+                yield tuple(row[1:])
+            if len(rows) < chunk_size:
+                return
+            last = rows[-1][0]
+
+
+async def aget_user(tid: int) -> Optional[Dict]:
+    uow = _current_uow.get()
+    if uow is not None:
+        return await uow.get_user(tid)
+    return await run_db(get_user, tid)
+
+
+async def acreate_user(tid: int, first_name: str) -> Dict:
+    user = await run_db(create_user, tid, first_name)
+    uow = _current_uow.get()
+    if uow is not None:
+        uow.remember_user(tid, user)
+    return user
+
+
+async def aupdate_user(tid: int, **kw):
+    uow = _current_uow.get()
+    if uow is not None:
+        uow.update_user(tid, **kw)
+        if not _UOW_WRITE_THROUGH_FIELDS.isdisjoint(kw):
+            await uow.flush()
+        return
+    return await run_db(update_user, tid, **kw)
+
+
+async def aget_doc_count(tid: int) -> int:
+    uow = _current_uow.get()
+    if uow is not None:
+        return (await uow.doc_counts_for(tid))[0]
+    return await run_db(get_doc_count, tid)
+
+
+async def aget_approved_doc_count(tid: int) -> int:
+    uow = _current_uow.get()
+    if uow is not None:
+        return (await uow.doc_counts_for(tid))[1]
+    return await run_db(get_approved_doc_count, tid)
+
+
+async def aget_user_docs(tid: int) -> List[Dict]:
+    return await run_db(get_user_docs, tid)
+
+
+async def asave_document(tid: int, doc_type: str, file_id: str, **kw) -> int:
+    result = await aingest_document(tid, doc_type, file_id, **kw)
+    return result['doc_id'] if result else None
+
+
+async def aingest_document(tid: int, doc_type: str, file_id: str, **kw) -> Optional[Dict]:
+    result = await run_db(ingest_document, tid, doc_type, file_id, **kw)
+    uow = _current_uow.get()
+    if uow is not None and result:
+        uow.doc_counts[tid] = [result['doc_count'], result['approved_count']]
+    return result
+
+
+async def aingest_documents(tid: int, docs: List[Dict], enqueue_analysis: bool = False) -> Optional[Dict]:
+    result = await run_db(ingest_documents, tid, docs, enqueue_analysis)
+    uow = _current_uow.get()
+    if uow is not None and result:
+        uow.doc_counts[tid] = [result['doc_count'], result['approved_count']]
+    return result
+
+
+async def asave_message(tid: int, direction: str, content: str, intent: str = ""):
+    if message_log.running:
+        await message_log.put(tid, direction, content, intent)
+        return
+    return await run_db(save_message, tid, direction, content, intent)
+
+
+async def aget_or_create_case(tid: int) -> Dict:
+    uow = _current_uow.get()
+    if uow is None:
+        return await run_db(get_or_create_case, tid)
+    if tid not in uow.cases:
+        uow.cases[tid] = await run_db(get_or_create_case, tid)
+    return uow.cases[tid]
+
+
+class PHApplication(Application):
+    """Application that wraps each update in a UnitOfWork and flushes it at the end."""
+
+    async def process_update(self, update: object) -> None:
+        uow = UnitOfWork()
+        token = _current_uow.set(uow)
+        try:
+            await super().process_update(update)
+        finally:
+            _current_uow.reset(token)
+            try:
+                await uow.flush()
+            except Exception:
+                logger.exception("Failed to flush user updates")
+
+
+# =============================================================================
+# MESSAGE LOG BUFFER (write-behind)
+# =============================================================================
+
+class MessageLogBuffer:
+    """Write-behind buffer for the messages table.
+
+    asave_message() enqueues and returns immediately; a background task writes
+    batches with save_messages_batch() every MSG_LOG_BATCH_SIZE rows or
+    MSG_LOG_FLUSH_MS, whichever comes first. The queue is bounded: when it is
+    full, producers wait (backpressure) instead of growing memory. stop()
+    drains everything that was accepted.
+    """
+
+    def __init__(self, batch_size: int, flush_ms: int, max_queue: int):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(1, flush_ms) / 1000
+        self.max_queue = max(1, max_queue)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"queued": 0, "written": 0, "batches": 0, "failed": 0, "backpressure_waits": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="message-log-flusher")
+        logger.info(f"Message log buffer started (batch={self.batch_size}, every {self.flush_interval * 1000:.0f}ms)")
+
+    async def put(self, tid: int, direction: str, content: str, intent: str = ""):
+        if self._queue.full():
+            self.stats["backpressure_waits"] += 1
+        created_at = datetime.now(timezone.utc).replace(tzinfo=None).strftime("%Y-%m-%d %H:%M:%S")
+        await self._queue.put((tid, direction, (content or "")[:500], intent or "", created_at))
+        self.stats["queued"] += 1
+
+    async def stop(self):
+        """Flush everything buffered, then stop the background task."""
+        if not self.running:
+            return
+        await self._queue.put(None)  # sentinel: drain and exit
+        await self._task
+        logger.info(f"Message log buffer stopped ({self.stats['written']} rows written)")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = loop.time() + self.flush_interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+            if stopping:
+                # Drain anything accepted before the sentinel
+                rest = []
+                while not self._queue.empty():
+                    item = self._queue.get_nowait()
+                    if item is not None:
+                        rest.append(item)
+                for i in range(0, len(rest), self.batch_size):
+                    await self._write(rest[i:i + self.batch_size])
+                return
+
+    async def _write(self, batch: List[Tuple]):
+        try:
+            await _run_blocking(save_messages_batch, batch)
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+        except Exception as e:
+            self.stats["failed"] += len(batch)
+            logger.error(f"Message log: failed to write {len(batch)} rows: {e}")
+
+
+message_log = MessageLogBuffer(MSG_LOG_BATCH_SIZE, MSG_LOG_FLUSH_MS, MSG_LOG_QUEUE_MAX)
+
+
+async def _post_init(app: Application):
+    message_log.start()
+    admin_notifier.start(app.bot)
+    await resume_broadcast_jobs(app)
+    await document_analysis.start(app.bot)
+
+
+async def _post_stop(app: Application):
+    # Runs before Application.shutdown() closes the bot, so final sends still go out
+    await document_analysis.stop()
+    await stop_broadcast_jobs()
+    await admin_notifier.stop()
+
+
+async def _post_shutdown(app: Application):
+    await message_log.stop()
+    await close_claude_client()
+    ocr_pool.shutdown()
+
+
+# =============================================================================
+# OUTBOUND GATEWAY
+# =============================================================================
+#
+# Installed as the Application's rate limiter, so every Bot API request made
+# through ctx.bot / message.reply_text / edit_message_text passes through
+# process_request(). Message-sending endpoints wait for a global token (granted
+# in lane priority order) and a per-chat token; RetryAfter pauses everything.
+# This is the only retry layer. TimedOut is retried for edits only: a send that
+# timed out may still have been delivered, so retrying it could duplicate the
+# message. The lane comes from rate_limit_args (a lane name) or the
+# _outbound_lane context variable, which background senders set for their tasks.
+
+OUTBOUND_LANES = {"interactive": 0, "admin": 1, "reminders": 2, "broadcast": 3}
+
+_outbound_lane: contextvars.ContextVar = contextvars.ContextVar("outbound_lane", default="interactive")
+
+_RATE_LIMITED_ENDPOINT_PREFIXES = ("send", "edit", "copy", "forward")
+_IDEMPOTENT_ENDPOINT_PREFIXES = ("edit",)
+
+
+class OutboundGateway(BaseRateLimiter):
+    """Priority-lane rate limiter for all outgoing messages."""
+
+    def __init__(self, rate: float, per_chat_rate: float, max_retries: int, timeout_retries: int):
+        self.rate = max(0.1, rate)
+        self.burst = max(1.0, self.rate)
+        self.per_chat_rate = max(0.01, per_chat_rate)
+        self.per_chat_burst = 3.0
+        self.max_retries = max_retries
+        self.timeout_retries = timeout_retries
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []  # heap of (lane priority, seq, future)
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._chats: Dict[int, List[float]] = {}  # chat_id -> [tokens, updated]
+        self._started = time.monotonic()
+        self.stats = {lane: {"requests": 0, "errors": 0, "retry_after": 0, "timeouts": 0,
+                             "wait_ms_total": 0.0, "latency_ms_total": 0.0, "latency_ms_max": 0.0}
+                      for lane in OUTBOUND_LANES}
+
+    async def initialize(self) -> None:
+        self._started = time.monotonic()
+
+    async def shutdown(self) -> None:
+        if self._dispatcher and not self._dispatcher.done():
+            self._dispatcher.cancel()
+
+    def pause(self, seconds: float):
+        until = time.monotonic() + seconds
+        if until > self._blocked_until:
+            self._blocked_until = until
+            self._tokens = 0.0
+            self._updated = until
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    async def _acquire_global(self, priority: int):
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and now >= self._blocked_until and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.get_running_loop().create_task(
+                self._dispatch(), name="outbound-gateway", context=contextvars.Context())
+        await fut
+
+    async def _dispatch(self):
+        """Hand out tokens to waiters, highest-priority lane first."""
+        while self._waiters:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():  # waiter was cancelled
+                continue
+            self._tokens -= 1
+            fut.set_result(None)
+
+    async def _acquire_chat(self, chat_id: int):
+        # Groups/channels (negative ids) allow ~20 messages per minute
+        rate = self.per_chat_rate if chat_id > 0 else 20 / 60
+        now = time.monotonic()
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = [self.per_chat_burst, now]
+            if len(self._chats) > 10000:
+                self._chats = {k: v for k, v in self._chats.items() if now - v[1] < 60}
+                self._chats[chat_id] = bucket
+        tokens = min(self.per_chat_burst, bucket[0] + (now - bucket[1]) * rate)
+        # Reserve the token now (may go negative) so concurrent senders queue up behind it
+        bucket[0], bucket[1] = tokens - 1, now
+        if tokens < 1:
+            await asyncio.sleep((1 - tokens) / rate)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(_RATE_LIMITED_ENDPOINT_PREFIXES):
+            return await callback(*args, **kwargs)
+        lane = rate_limit_args if rate_limit_args in OUTBOUND_LANES else _outbound_lane.get()
+        stats = self.stats[lane]
+        stats["requests"] += 1
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            chat_id = None
+
+        started = time.monotonic()
+        retry_after_left = self.max_retries
+        timeouts_left = self.timeout_retries if endpoint.startswith(_IDEMPOTENT_ENDPOINT_PREFIXES) else 0
+        try:
+            while True:
+                if chat_id is not None:
+                    await self._acquire_chat(chat_id)
+                await self._acquire_global(OUTBOUND_LANES[lane])
+                stats["wait_ms_total"] += (time.monotonic() - started) * 1000
+                try:
+                    return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    stats["retry_after"] += 1
+                    if retry_after_left <= 0:
+                        raise
+                    retry_after_left -= 1
+                    delay = _retry_after_seconds(e)
+                    logger.warning(f"Flood control on {endpoint} ({lane}), pausing all sends {delay:.0f}s")
+                    self.pause(delay)
+                except TimedOut:
+                    stats["timeouts"] += 1
+                    if timeouts_left <= 0:
+                        raise
+                    timeouts_left -= 1
+        except Exception:
+            stats["errors"] += 1
+            raise
+        finally:
+            latency = (time.monotonic() - started) * 1000
+            stats["latency_ms_total"] += latency
+            stats["latency_ms_max"] = max(stats["latency_ms_max"], latency)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Per-lane counters plus average wait/latency (ms) and throughput (msgs/min)."""
+        minutes = max(1e-6, (time.monotonic() - self._started) / 60)
+        result = {}
+        for lane, st in self.stats.items():
+            data = dict(st)
+            n = st["requests"]
+            data["wait_ms_avg"] = st["wait_ms_total"] / n if n else 0.0
+            data["latency_ms_avg"] = st["latency_ms_total"] / n if n else 0.0
+            data["per_minute"] = n / minutes
+            result[lane] = data
+        return result
+
+
+outbound_gateway = OutboundGateway(OUTBOUND_RATE, OUTBOUND_PER_CHAT_RATE,
+                                   OUTBOUND_MAX_RETRIES, OUTBOUND_TIMEOUT_RETRIES)
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    delay = e.retry_after
+    if isinstance(delay, timedelta):
+        delay = delay.total_seconds()
+    return float(delay) + 1.0
+
+
+# =============================================================================
+# BROADCAST ENGINE
+# =============================================================================
+
+async def send_once(chat_id: int, send: Callable[[], Awaitable],
+                    plain: Optional[Callable[[], Awaitable]] = None) -> str:
+    """Call `send()` once and classify the outcome as "sent", "blocked" or "failed".
+    If Telegram cannot parse the message's entities, `plain()` (the same message
+    without parse_mode) is tried instead. Pacing and flood-control retries happen
+    in the outbound gateway, not here."""
+    try:
+        await send()
+        return "sent"
+    except Forbidden:
+        return "blocked"  # user blocked the bot or deleted the account
+    except BadRequest as e:
+        if plain is not None and "parse entities" in str(e).lower():
+            logger.warning(f"Send to {chat_id}: bad formatting ({e}), resending as plain text")
+            return await send_once(chat_id, plain)
+        logger.debug(f"Send to {chat_id} rejected: {e}")
+        return "failed"
+    except Exception as e:
+        logger.warning(f"Send to {chat_id} failed: {type(e).__name__}: {e}")
+        return "failed"
+
+
+async def _broadcast_send(bot, chat_id: int, text: str, parse_mode: Optional[str]) -> str:
+    """Send one broadcast message. Returns "sent", "blocked" or "failed"."""
+    return await send_once(chat_id, lambda: bot.send_message(chat_id, text, parse_mode=parse_mode))
+
+
+async def run_broadcast(
+    bot,
+    recipients,
+    text,
+    parse_mode: Optional[str] = ParseMode.MARKDOWN,
+    total: Optional[int] = None,
+    progress: Optional[Callable[[Dict], Awaitable]] = None,
+    progress_every: float = BROADCAST_PROGRESS_SECONDS,
+    on_result: Optional[Callable[[int, str], Awaitable]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    lane: str = "broadcast",
+) -> Dict:
+    """Send `text` to every recipient (an iterable or an async iterator such as
+    stream_rows()) with BROADCAST_CONCURRENCY concurrent senders. `text` may also
+    be a callable: chat_id -> text. `progress(stats)` is awaited every
+    `progress_every` seconds while the broadcast runs; `on_result(chat_id,
+    result)` after each recipient. Senders stop taking new recipients once
+    `should_stop()` is true. Sends go through the outbound gateway in `lane`.
+    If a sender or the producer fails, the others are cancelled and the error
+    is raised. Returns the final stats.
+    """
+    if total is None and hasattr(recipients, "__len__"):
+        total = len(recipients)
+    stats = {"total": total, "sent": 0, "failed": 0, "blocked": 0, "elapsed": 0.0}
+    started = time.monotonic()
+    workers = max(1, BROADCAST_CONCURRENCY)
+
+    async def deliver(chat_id: int):
+        body = text(chat_id) if callable(text) else text
+        result = await _broadcast_send(bot, chat_id, body, parse_mode)
+        stats[result] += 1
+        if on_result:
+            await on_result(chat_id, result)
+
+    producer = None
+    if hasattr(recipients, "__aiter__"):
+        # Streamed audience: a producer keeps a small queue ahead of the senders,
+        # so sending starts with the first chunk and memory stays flat.
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * workers)
+
+        async def produce():
+            try:
+                async for chat_id in recipients:
+                    if should_stop and should_stop():
+                        break
+                    await queue.put(chat_id)
+            finally:
+                if hasattr(recipients, "aclose"):
+                    await recipients.aclose()
+            for _ in range(workers):
+                await queue.put(None)
+
+        async def sender():
+            while True:
+                chat_id = await queue.get()
+                if chat_id is None:
+                    return
+                if should_stop and should_stop():
+                    continue
+                await deliver(chat_id)
+
+        producer = produce
+    else:
+        pending = iter(recipients)  # shared: each recipient is handed to exactly one sender
+
+        async def sender():
+            for chat_id in pending:
+                if should_stop and should_stop():
+                    return
+                await deliver(chat_id)
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(progress_every)
+            stats["elapsed"] = time.monotonic() - started
+            try:
+                await progress(dict(stats))
+            except Exception as e:
+                logger.debug(f"Broadcast progress update failed: {e}")
+
+    report_task = asyncio.create_task(reporter()) if progress else None
+    lane_token = _outbound_lane.set(lane)
+    try:
+        # A failing task cancels its siblings, so no sender keeps going after the job is marked paused
+        async with asyncio.TaskGroup() as group:
+            if producer:
+                group.create_task(producer())
+            for _ in range(workers):
+                group.create_task(sender())
+    except ExceptionGroup as eg:
+        raise eg.exceptions[0]
+    finally:
+        _outbound_lane.reset(lane_token)
+        if report_task:
+            report_task.cancel()
+    stats["elapsed"] = time.monotonic() - started
+    logger.info(f"Broadcast done: {stats['sent']} sent, {stats['failed']} failed, "
+                f"{stats['blocked']} blocked in {stats['elapsed']:.1f}s")
+    return stats
+
+
+# =============================================================================
+# BROADCAST JOBS (persistent, resumable)
+# =============================================================================
+#
+# A broadcast is a broadcast_jobs row plus one broadcast_deliveries row per
+# recipient, materialized with a single INSERT ... SELECT when the job is
+# created (the primary key dedupes recipients). The runner streams 'pending'
+# deliveries in telegram_id order and checkpoints each result after the send,
+# so a restart resumes where it stopped. Delivery is at-least-once: messages in
+# flight when the process died (up to BROADCAST_CONCURRENCY) are sent again.
+# A runner that crashes leaves its job 'paused', ready for /bcresume.
+
+BROADCAST_AUDIENCES = {
+    "all": ("", "usuarios"),
+    "eligible": ("eligible=1 AND phase2_paid=0", "elegibles sin pagar"),
+    "paid": ("phase2_paid=1 OR phase3_paid=1 OR phase4_paid=1", "usuarios que pagaron"),
+}
+
+def _broadcast_audience_filter(audience: str) -> Tuple[str, tuple, str]:
+    """(WHERE fragment, params, label) for an audience key ("all", "eligible", "paid", "country:<code>")."""
+    if audience.startswith("country:"):
+        code = audience.split(":", 1)[1]
+        country = COUNTRIES.get(code, {})
+        return f"country_code = {db_param()}", (code,), f"usuarios {country.get('flag', '')} {country.get('name', code)}"
+    where, label = BROADCAST_AUDIENCES[audience]
+    return where, (), label
+
+
+def create_broadcast_job(created_by: int, audience: str, message: str) -> Tuple[int, int]:
+    """Create a job and materialize its recipients. Returns (job_id, total)."""
+    where, params, _ = _broadcast_audience_filter(audience)
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    try:
+        c.execute(f"""INSERT INTO broadcast_jobs (created_by, audience, message, status)
+            VALUES ({p}, {p}, {p}, 'pending') RETURNING id""", (created_by, audience, message))
+        job_id = c.fetchone()[0]
+        c.execute(f"""INSERT INTO broadcast_deliveries (job_id, telegram_id)
+            SELECT DISTINCT {p}, telegram_id FROM users
+            WHERE telegram_id IS NOT NULL{f' AND ({where})' if where else ''}""",
+            (job_id,) + params)
+        total = c.rowcount
+        c.execute(f"UPDATE broadcast_jobs SET total = {p} WHERE id = {p}", (total, job_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return job_id, total
+
+
+def find_active_broadcast_job(audience: str, message: str) -> Optional[Dict]:
+    """An unfinished job with the same audience and text, if any (guards against re-runs)."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"""SELECT * FROM broadcast_jobs WHERE audience = {p} AND message = {p}
+        AND status IN ('pending', 'running', 'paused') ORDER BY id DESC LIMIT 1""", (audience, message))
+    row = c.fetchone()
+    result = _row_to_dict(row, c) if row else None
+    conn.close()
+    return result
+
+
+def get_broadcast_job(job_id: int) -> Optional[Dict]:
+    """Job row plus live delivery counts (pending/sent/failed/blocked)."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"SELECT * FROM broadcast_jobs WHERE id = {p}", (job_id,))
+    row = c.fetchone()
+    if not row:
+        conn.close()
+        return None
+    job = _row_to_dict(row, c)
+    c.execute(f"SELECT status, COUNT(*) FROM broadcast_deliveries WHERE job_id = {p} GROUP BY status", (job_id,))
+    counts = {"pending": 0, "sent": 0, "failed": 0, "blocked": 0}
+    counts.update({r[0]: r[1] for r in c.fetchall()})
+    conn.close()
+    job["counts"] = counts
+    return job
+
+
+def list_broadcast_jobs(limit: int = 10, statuses: Optional[List[str]] = None) -> List[Dict]:
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    if statuses:
+        placeholders = ", ".join([p] * len(statuses))
+        c.execute(f"SELECT * FROM broadcast_jobs WHERE status IN ({placeholders}) ORDER BY id DESC LIMIT {int(limit)}",
+                  tuple(statuses))
+    else:
+        c.execute(f"SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT {int(limit)}")
+    rows = [_row_to_dict(r, c) for r in c.fetchall()]
+    conn.close()
+    return rows
+
+
+def record_broadcast_delivery(job_id: int, telegram_id: int, status: str):
+    """Checkpoint one delivery result."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.execute(f"""UPDATE broadcast_deliveries SET status = {p}, delivered_at = CURRENT_TIMESTAMP
+        WHERE job_id = {p} AND telegram_id = {p}""", (status, job_id, telegram_id))
+    conn.commit()
+    conn.close()
+
+
+def set_broadcast_job_status(job_id: int, status: str):
+    """Set job status; terminal states also store the final delivery counts."""
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    if status in ("done", "cancelled"):
+        c.execute(f"""UPDATE broadcast_jobs SET status = {p}, finished_at = CURRENT_TIMESTAMP,
+            sent = (SELECT COUNT(*) FROM broadcast_deliveries WHERE job_id = {p} AND status = 'sent'),
+            failed = (SELECT COUNT(*) FROM broadcast_deliveries WHERE job_id = {p} AND status = 'failed'),
+            blocked = (SELECT COUNT(*) FROM broadcast_deliveries WHERE job_id = {p} AND status = 'blocked')
+            WHERE id = {p}""", (status, job_id, job_id, job_id, job_id))
+    else:
+        c.execute(f"UPDATE broadcast_jobs SET status = {p} WHERE id = {p}", (status, job_id))
+    conn.commit()
+    conn.close()
+
+
+_broadcast_runs: Dict[int, asyncio.Task] = {}
+_broadcast_stop: Dict[int, str] = {}  # job_id -> requested status ("paused" / "cancelled")
+
+
+def broadcast_job_running(job_id: int) -> bool:
+    task = _broadcast_runs.get(job_id)
+    return task is not None and not task.done()
+
+
+def start_broadcast_job(bot, job_id: int) -> bool:
+    """Run (or resume) a job in the background. False if it is already running."""
+    if broadcast_job_running(job_id):
+        return False
+    _broadcast_stop.pop(job_id, None)
+    task = asyncio.get_running_loop().create_task(
+        _run_broadcast_job(bot, job_id), name=f"broadcast-{job_id}", context=contextvars.Context())
+    task.add_done_callback(functools.partial(_broadcast_job_finished, job_id))
+    _broadcast_runs[job_id] = task
+    return True
+
+
+def _broadcast_job_finished(job_id: int, task: asyncio.Task):
+    """Done-callback: a runner that died with an error leaves its job 'paused' (resumable), not 'running'."""
+    if task.cancelled() or task.exception() is None:
+        return
+    exc = task.exception()
+    logger.error(f"Broadcast #{job_id} runner crashed: {type(exc).__name__}: {exc}", exc_info=exc)
+
+    def _logged(fut):
+        if fut.exception():
+            logger.error(f"Broadcast #{job_id}: could not mark job paused: {fut.exception()}")
+
+    _db_executor.submit(set_broadcast_job_status, job_id, "paused").add_done_callback(_logged)
+
+
+def _broadcast_job_summary(job_id: int, counts: Dict, total: int) -> str:
+    summary = f"Enviado: {counts['sent']} | Fallido: {counts['failed']}"
+    if counts.get("blocked"):
+        summary += f" | Bloqueado: {counts['blocked']}"
+    return f"{summary} (de {total})"
+
+
+async def _run_broadcast_job(bot, job_id: int):
+    job = await run_db(get_broadcast_job, job_id)
+    if not job or job["status"] in ("done", "cancelled"):
+        return
+    await run_db(set_broadcast_job_status, job_id, "running")
+    counts = job["counts"]
+    total = job["total"]
+    _, _, label = _broadcast_audience_filter(job["audience"])
+    started = time.monotonic()
+    done_before = total - counts["pending"]
+
+    status_msg = None
+    try:
+        verb = "Reanudando" if done_before else "Enviando"
+        status_msg = await bot.send_message(
+            job["created_by"], f"📣 Difusión #{job_id}: {verb}... {done_before}/{total} {label}")
+    except Exception as e:
+        logger.debug(f"Broadcast #{job_id}: no status message: {e}")
+
+    async def checkpoint(chat_id: int, result: str):
+        counts[result] += 1
+        counts["pending"] -= 1
+        await run_db(record_broadcast_delivery, job_id, chat_id, result)
+
+    async def report():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_SECONDS)
+            done = total - counts["pending"]
+            rate = (done - done_before) / max(0.001, time.monotonic() - started)
+            try:
+                await status_msg.edit_text(f"📣 Difusión #{job_id}: {done}/{total} ({rate:.1f} msg/s)")
+            except Exception as e:
+                logger.debug(f"Broadcast #{job_id} progress update failed: {e}")
+
+    def stopping() -> bool:
+        return job_id in _broadcast_stop
+
+    report_task = asyncio.create_task(report()) if status_msg else None
+    try:
+        p = db_param()
+        rows = stream_rows("broadcast_deliveries", ["telegram_id"], "telegram_id",
+                           f"job_id = {p} AND status = 'pending'", (job_id,))
+        try:
+            await run_broadcast(bot, (row[0] async for row in rows), job["message"],
+                                on_result=checkpoint, should_stop=stopping)
+        finally:
+            await rows.aclose()
+    finally:
+        if report_task:
+            report_task.cancel()
+
+    final = _broadcast_stop.pop(job_id, None) or "done"
+    await run_db(set_broadcast_job_status, job_id, final)
+    text = {"done": "✅ completada", "paused": "⏸ pausada", "cancelled": "🛑 cancelada"}[final]
+    summary = f"📣 Difusión #{job_id} {text}. {_broadcast_job_summary(job_id, counts, total)}"
+    logger.info(summary)
+    if status_msg:
+        try:
+            await status_msg.edit_text(summary)
+        except Exception:
+            pass
+
+
+async def resume_broadcast_jobs(app: Application):
+    """Restart jobs that were pending or running when the bot stopped."""
+    jobs = await run_db(list_broadcast_jobs, 100, ["pending", "running"])
+    for job in jobs:
+        logger.info(f"Resuming broadcast job #{job['id']}")
+        start_broadcast_job(app.bot, job["id"])
+
+
+async def stop_broadcast_jobs():
+    """Cancel runner tasks on shutdown; their jobs stay 'running' and resume on start."""
+    tasks = [t for t in _broadcast_runs.values() if not t.done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def queue_broadcast(update: Update, ctx: ContextTypes.DEFAULT_TYPE, audience: str, msg: str):
+    """Create and start a broadcast job for an admin command."""
+    existing = await run_db(find_active_broadcast_job, audience, msg)
+    if existing:
+        await update.message.reply_text(
+            f"Ya existe la difusión #{existing['id']} con ese mensaje ({existing['status']}). "
+            f"Use /bcstatus {existing['id']}")
+        return
+    job_id, total = await run_db(create_broadcast_job, update.effective_user.id, audience, msg)
+    _, _, label = _broadcast_audience_filter(audience)
+    if not total:
+        await run_db(set_broadcast_job_status, job_id, "done")
+        await update.message.reply_text(f"No hay {label} a quien enviar.")
+        return
+    start_broadcast_job(ctx.bot, job_id)
+    await update.message.reply_text(
+        f"📣 Difusión #{job_id} creada: {total} {label}.\n"
+        f"/bcstatus {job_id} · /bcpause {job_id} · /bccancel {job_id}")
+
+
+# =============================================================================
+# ADMIN NOTIFICATIONS (background fan-out)
+# =============================================================================
+
+class AdminNotifier:
+    """Queue + worker pool for messages to ADMIN_IDS.
+
+    notify() enqueues one item per admin and returns at once, so user-facing
+    handlers never wait on admin sends. Workers send concurrently in the
+    outbound gateway's admin lane, which paces them per admin chat and retries
+    flood control. stop() drains the queue, up to a timeout.
+
+    Digest mode (digest_seconds > 0): non-urgent notifications are collected
+    and, once per window, each admin gets one summary message plus albums of
+    the photos/documents (send_media_group, 10 per album).
+    """
+
+    def __init__(self, workers: int, max_queue: int, digest_seconds: int = 0):
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.digest_seconds = digest_seconds
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._digest: List[Tuple[str, Dict, str]] = []  # (method, kwargs, summary line)
+        self._bot = None
+        self.stats = {"queued": 0, "sent": 0, "failed": 0, "blocked": 0,
+                      "dropped": 0, "digested": 0, "digests": 0}
+
+    @property
+    def running(self) -> bool:
+        return any(not t.done() for t in self._tasks)
+
+    def start(self, bot):
+        self._bot = bot
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker(), name=f"admin-notify-{i}") for i in range(self.workers)]
+        if self.digest_seconds > 0:
+            self._tasks.append(loop.create_task(self._digest_loop(), name="admin-digest"))
+        digest = f", digest every {self.digest_seconds}s" if self.digest_seconds > 0 else ""
+        logger.info(f"Admin notifier started ({self.workers} workers, {len(ADMIN_IDS)} admins{digest})")
+
+    def notify(self, method: str, urgent: bool = False, summary: str = "", **kwargs):
+        """Queue bot.<method>(admin_id, **kwargs) for every admin. In digest mode
+        non-urgent items wait for the next digest, listed there as `summary`."""
+        if self.digest_seconds > 0 and not urgent:
+            self._digest.append((method, kwargs, summary or kwargs.get("text") or kwargs.get("caption") or ""))
+            self.stats["digested"] += 1
+            return
+        self._enqueue(method, **kwargs)
+
+    def _enqueue(self, method: str, **kwargs):
+        for aid in ADMIN_IDS:
+            try:
+                self._queue.put_nowait((aid, method, kwargs))
+                self.stats["queued"] += 1
+            except asyncio.QueueFull:
+                self.stats["dropped"] += 1
+                logger.warning(f"Admin notification queue full, dropped {method} for {aid}")
+
+    def flush_digest(self):
+        """Turn everything collected since the last digest into queued sends."""
+        items, self._digest = self._digest, []
+        if not items:
+            return
+        self.stats["digests"] += 1
+        window = f"{self.digest_seconds // 60} min" if self.digest_seconds >= 60 else f"{self.digest_seconds} s"
+        header = f"🗂 *Resumen de avisos* ({len(items)} en los últimos {window})\n\n"
+        chunk = header
+        for _, _, line in items:
+            entry = f"• {line}\n\n"
+            if len(chunk) + len(entry) > 4000:
+                self._enqueue("send_message", text=chunk, parse_mode=ParseMode.MARKDOWN)
+                chunk = ""
+            chunk += entry
+        if chunk:
+            self._enqueue("send_message", text=chunk, parse_mode=ParseMode.MARKDOWN)
+        # Albums: photos and documents cannot share one media group
+        for method, media_cls, arg in (("send_photo", InputMediaPhoto, "photo"),
+                                       ("send_document", InputMediaDocument, "document")):
+            media = [media_cls(kw[arg], caption=(kw.get("album_caption") or "")[:200])
+                     for m, kw, _ in items if m == method]
+            for i in range(0, len(media), 10):
+                group = media[i:i + 10]
+                if len(group) == 1:
+                    self._enqueue(method, **{arg: group[0].media, "caption": group[0].caption})
+                else:
+                    self._enqueue("send_media_group", media=group)
+
+    async def _digest_loop(self):
+        while True:
+            await asyncio.sleep(self.digest_seconds)
+            self.flush_digest()
+
+    async def stop(self, timeout: float = 10.0):
+        if not self.running:
+            return
+        self.flush_digest()
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Admin notifier: {self._queue.qsize()} notifications not sent at shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        logger.info(f"Admin notifier stopped ({self.stats['sent']} sent, {self.stats['failed']} failed)")
+
+    async def _worker(self):
+        _outbound_lane.set("admin")
+        while True:
+            aid, method, kwargs = await self._queue.get()
+            try:
+                send = functools.partial(getattr(self._bot, method), aid, **kwargs)
+                plain = None
+                if "parse_mode" in kwargs:
+                    plain = functools.partial(getattr(self._bot, method), aid,
+                                              **{k: v for k, v in kwargs.items() if k != "parse_mode"})
+                result = await send_once(aid, send, plain)
+                self.stats[result] += 1
+                if result != "sent":
+                    logger.error(f"Admin notification {method} to {aid} {result}")
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"Admin notification {method} to {aid} failed: {e}")
+            finally:
+                self._queue.task_done()
+
+
+admin_notifier = AdminNotifier(ADMIN_NOTIFY_WORKERS, ADMIN_NOTIFY_QUEUE_MAX, ADMIN_DIGEST_SECONDS)
+
+
+def pending_doc_link(doc_id) -> str:
+    """Tappable command that opens one document in /pendientes (escaped for Markdown)."""
+    return f"/pendientes\\_{doc_id}"
 
 
-def get_doc_count(tid: int) -> int:
-    conn = get_connection()
-    c = conn.cursor()
-    p = db_param()
-    c.execute(f"SELECT COUNT(*) FROM documents d JOIN users u ON d.user_id=u.id WHERE u.telegram_id={p}", (tid,))
-    n = c.fetchone()[0]
-    conn.close()
-    return n
+async def notify_admins_media(context, method: str, file_id: str, caption: str,
+                              summary: str = "", album_caption: str = ""):
+    """Send a photo/document (method "send_photo" / "send_document") to every admin.
+    In digest mode `summary` is its line in the digest, `album_caption` its album caption."""
+    media_arg = "photo" if method == "send_photo" else "document"
+    if admin_notifier.running:
+        if admin_notifier.digest_seconds > 0:
+            admin_notifier.notify(method, summary=summary or caption, **{media_arg: file_id},
+                                  album_caption=album_caption)
+        else:
+            admin_notifier.notify(method, **{media_arg: file_id}, caption=caption, parse_mode=ParseMode.MARKDOWN)
+        return
+    for aid in ADMIN_IDS:
+        try:
+            await getattr(context.bot, method)(aid, file_id, caption=caption, parse_mode=ParseMode.MARKDOWN)
+        except Exception as e:
+            logger.error(f"Failed to send admin {media_arg} notification to {aid}: {e}")
+
+
+async def notify_admins_album(context, items: List[Dict], caption: str):
+    """Send several uploads to every admin as albums (10 per media group, photos and
+    documents in separate groups). `items` carry method, file_id, summary, album_caption;
+    `caption` (Markdown) goes on the first item of each album."""
+    if admin_notifier.running and admin_notifier.digest_seconds > 0:
+        for item in items:
+            admin_notifier.notify(item["method"], summary=item.get("summary", ""),
+                                  **{"photo" if item["method"] == "send_photo" else "document": item["file_id"]},
+                                  album_caption=item.get("album_caption", ""))
+        return
+    groups = []
+    for method, media_cls in (("send_photo", InputMediaPhoto), ("send_document", InputMediaDocument)):
+        kind = [i for i in items if i["method"] == method]
+        for start in range(0, len(kind), 10):
+            chunk = kind[start:start + 10]
+            groups.append([
+                media_cls(i["file_id"], caption=caption if n == 0 else i.get("album_caption", "")[:200],
+                          parse_mode=ParseMode.MARKDOWN if n == 0 else None)
+                for n, i in enumerate(chunk)
+            ])
+    for media in groups:
+        if len(media) == 1:
+            only = next(i for i in items if i["file_id"] == media[0].media)
+            await notify_admins_media(context, only["method"], only["file_id"], caption)
+            continue
+        if admin_notifier.running:
+            admin_notifier.notify("send_media_group", media=media)
+            continue
+        for aid in ADMIN_IDS:
+            try:
+                await context.bot.send_media_group(aid, media)
+            except Exception as e:
+                logger.error(f"Failed to send admin album to {aid}: {e}")
 
 
-def get_approved_doc_count(tid: int) -> int:
-    """Count only approved documents for a user."""
+# =============================================================================
+# DOCUMENT ANALYSIS QUEUE
+# =============================================================================
+#
+# Uploads stay instant: the handler only inserts the document and an
+# analysis_jobs row (same transaction). Workers claim pending jobs one at a
+# time (FOR UPDATE SKIP LOCKED on PostgreSQL), run classify_document() and
+# write the results into the documents row, so a reviewer opening /pendientes
+# already sees type, confidence, extracted fields and issues. Failures are
+# retried with a growing delay up to ANALYSIS_MAX_ATTEMPTS; jobs left 'running'
+# by a crash are re-queued at startup.
+
+def claim_analysis_job() -> Optional[Tuple[int, int]]:
+    """Mark the oldest due pending job as running. Returns (doc_id, attempts) or None if nothing is due."""
     conn = get_connection()
     c = conn.cursor()
-    p = db_param()
-    c.execute(f"SELECT COUNT(*) FROM documents d JOIN users u ON d.user_id=u.id WHERE u.telegram_id={p} AND d.approved=1", (tid,))
-    n = c.fetchone()[0]
-    conn.close()
-    return n
+    lock = " FOR UPDATE SKIP LOCKED" if USE_POSTGRES else ""
+    try:
+        c.execute(f"""UPDATE analysis_jobs SET status = 'running', attempts = attempts + 1
+            WHERE doc_id = (
+                SELECT doc_id FROM analysis_jobs
+                WHERE status = 'pending' AND available_at <= CURRENT_TIMESTAMP
+                ORDER BY available_at, doc_id LIMIT 1{lock}
+            ) RETURNING doc_id, attempts""")
+        row = c.fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return (row[0], row[1]) if row else None
 
 
-def get_pending_documents(limit: int = 20) -> List[Dict]:
-    """Get documents pending admin review (approved=0)."""
+def requeue_running_analysis_jobs() -> int:
+    """Jobs a previous process left half-done go back to pending. Returns how many."""
     conn = get_connection()
     c = conn.cursor()
-    c.execute(f"""
-        SELECT d.*, u.telegram_id, u.first_name
-        FROM documents d
-        JOIN users u ON d.user_id = u.id
-        WHERE d.approved = 0
-        ORDER BY d.uploaded_at DESC
-        LIMIT {limit}
-    """)
-    rows = c.fetchall()
-    result = [_row_to_dict(r, c) for r in rows]
+    c.execute("UPDATE analysis_jobs SET status = 'pending' WHERE status = 'running'")
+    n = c.rowcount
+    conn.commit()
     conn.close()
-    return result
+    return n
 
 
-def update_document_approval(doc_id: int, approved: int) -> bool:
-    """Update document approval status. approved: 1=approved, -1=rejected"""
+def enqueue_analysis_backlog(limit: int) -> int:
+    """Queue up to `limit` pending, never-analysed documents that have no job yet (newest first).
+    Returns how many were queued."""
     conn = get_connection()
     c = conn.cursor()
     p = db_param()
-    c.execute(f"UPDATE documents SET approved={p} WHERE id={p}", (approved, doc_id))
-    affected = c.rowcount
+    c.execute(f"""INSERT INTO analysis_jobs (doc_id)
+        SELECT id FROM documents d
+        WHERE approved = 0 AND (ai_type IS NULL OR ai_type = '')
+          AND NOT EXISTS (SELECT 1 FROM analysis_jobs j WHERE j.doc_id = d.id)
+        ORDER BY id DESC LIMIT {p}""", (limit,))
+    n = c.rowcount
     conn.commit()
     conn.close()
-    return affected > 0
+    return n
 
 
-def get_document_by_id(doc_id: int) -> Optional[Dict]:
-    """Get a document by its ID."""
+def save_document_analysis(doc_id: int, fields: Dict):
+    """Write analysis results into the document and mark its job done, in one transaction."""
     conn = get_connection()
     c = conn.cursor()
     p = db_param()
-    c.execute(f"""
-        SELECT d.*, u.telegram_id, u.first_name
-        FROM documents d
-        JOIN users u ON d.user_id = u.id
-        WHERE d.id = {p}
-    """, (doc_id,))
-    row = c.fetchone()
-    result = _row_to_dict(row, c)
-    conn.close()
-    return result
+    try:
+        if fields:
+            assignments = ", ".join(f"{col} = {p}" for col in fields)
+            c.execute(f"UPDATE documents SET {assignments} WHERE id = {p}", tuple(fields.values()) + (doc_id,))
+        c.execute(f"""UPDATE analysis_jobs SET status = 'done', last_error = NULL, finished_at = CURRENT_TIMESTAMP
+            WHERE doc_id = {p}""", (doc_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
 
-def get_user_docs(tid: int) -> List[Dict]:
+def fail_analysis_job(doc_id: int, attempts: int, error: str) -> str:
+    """Record a failed attempt: back to pending after a delay, or 'failed' for good. Returns the new status."""
+    status = "failed" if attempts >= ANALYSIS_MAX_ATTEMPTS else "pending"
+    delay = 60 * attempts
+    retry_at = (f"CURRENT_TIMESTAMP + INTERVAL '{delay} seconds'" if USE_POSTGRES
+                else f"datetime('now', '+{delay} seconds')")
     conn = get_connection()
     c = conn.cursor()
     p = db_param()
-    c.execute(f"SELECT d.* FROM documents d JOIN users u ON d.user_id=u.id WHERE u.telegram_id={p} ORDER BY d.uploaded_at DESC", (tid,))
-    rows = c.fetchall()
-    result = [_row_to_dict(r, c) for r in rows]
+    c.execute(f"""UPDATE analysis_jobs SET status = {p}, last_error = {p}, available_at = {retry_at},
+            finished_at = CASE WHEN {p} = 'failed' THEN CURRENT_TIMESTAMP END WHERE doc_id = {p}""",
+        (status, error[:500], status, doc_id))
+    conn.commit()
     conn.close()
-    return result
+    return status
+
+
+def _analysis_fields(result: Dict) -> Dict:
+    """documents columns from a classify_document() result."""
+    vision = result.get("vision") or {}
+    issues = list(vision.get("issues") or []) + [n for n in result.get("notes", []) if n]
+    summary = {"stage": result.get("stage"), "detected_type": result.get("detected_type"),
+               "confidence": result.get("confidence"), "score": result.get("score"), "notes": result.get("notes")}
+    fields = {
+        "ai_type": result.get("detected_type") or "other",  # DOC_TYPES code; raw vision type stays in ai_analysis
+        "ai_confidence": float(result.get("confidence") or 0.0),
+        "ai_analysis": json.dumps(dict(vision, pipeline=summary) if vision else summary,
+                                  ensure_ascii=False, default=str),
+        "detected_type": result.get("detected_type") or "other",
+        "validation_score": int(result.get("score") or 0),
+        "issues": "; ".join(str(i) for i in issues),
+    }
+    if result.get("ocr_text"):
+        fields["ocr_text"] = result["ocr_text"]
+    for col in ("extracted_name", "extracted_address", "extracted_date", "document_country", "expiry_date"):
+        if vision.get(col):
+            fields[col] = str(vision[col])
+    return fields
 
 
-def get_user_doc_by_type(tid: int, doc_type: str) -> Optional[Dict]:
-    """Get a user's existing document of a specific type, if any."""
-    conn = get_connection()
-    c = conn.cursor()
-    p = db_param()
-    c.execute(
-        f"SELECT d.* FROM documents d JOIN users u ON d.user_id=u.id "
-        f"WHERE u.telegram_id={p} AND d.doc_type={p} ORDER BY d.uploaded_at DESC LIMIT 1",
-        (tid, doc_type))
-    row = c.fetchone()
-    result = _row_to_dict(row, c)
-    conn.close()
-    return result
+class DocumentAnalysisQueue:
+    """Worker pool draining analysis_jobs.
 
+    wake() is called after an upload commits; otherwise idle workers re-check
+    every poll_seconds (picks up retries whose delay has passed).
+    """
 
-def delete_document(doc_id: int):
-    """Delete a document by ID."""
-    conn = get_connection()
-    c = conn.cursor()
-    p = db_param()
-    c.execute(f"DELETE FROM documents WHERE id={p}", (doc_id,))
-    conn.commit()
-    conn.close()
+    def __init__(self, workers: int, poll_seconds: float):
+        self.workers = max(1, workers)
+        self.poll_seconds = poll_seconds
+        self._bot = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"done": 0, "retried": 0, "failed": 0, "in_progress": 0}
+
+    @property
+    def running(self) -> bool:
+        return any(not t.done() for t in self._tasks)
+
+    async def start(self, bot):
+        if not (OCR_AVAILABLE or (ANTHROPIC_AVAILABLE and ANTHROPIC_API_KEY)):
+            logger.info("Document analysis queue not started: neither OCR nor Claude Vision available")
+            return
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        requeued = await run_db(requeue_running_analysis_jobs)
+        if requeued:
+            logger.info(f"Document analysis: re-queued {requeued} interrupted job(s)")
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker(), name=f"doc-analysis-{i}") for i in range(self.workers)]
+        self._wakeup.set()
+        logger.info(f"Document analysis queue started ({self.workers} workers)")
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        """Cancel the workers; a job cut short stays 'running' and is re-queued on next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def snapshot(self) -> Dict:
+        return dict(self.stats)
+
+    async def _worker(self):
+        while True:
+            try:
+                claimed = await run_db(claim_analysis_job)
+                if claimed is None:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self.poll_seconds)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                # Others may be due too; let the next idle worker look
+                self._wakeup.set()
+                await self._process(*claimed)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Transient DB trouble must not end the worker; a job left 'running' is re-queued at startup
+                logger.error(f"Document analysis worker error: {type(e).__name__}: {e}")
+                await asyncio.sleep(self.poll_seconds)
 
+    async def _process(self, doc_id: int, attempts: int):
+        self.stats["in_progress"] += 1
+        try:
+            doc = await run_db(get_document_by_id, doc_id)
+            if not doc or not doc.get("file_id") or doc.get("approved") != 0:
+                # Gone, or already reviewed by an admin: nothing left to pre-analyse
+                await run_db(save_document_analysis, doc_id, {})
+                return
+            photo_file = await self._bot.get_file(doc["file_id"])
+            result = await classify_document(photo_file, doc.get("doc_type") or "other")
+            if result.get("error"):
+                raise RuntimeError(result["error"])
+            await run_db(save_document_analysis, doc_id, _analysis_fields(result))
+            self.stats["done"] += 1
+            logger.info(f"Document {doc_id} pre-analysed: stage={result.get('stage')} "
+                        f"type={result.get('detected_type')} confidence={result.get('confidence', 0):.2f}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            status = await run_db(fail_analysis_job, doc_id, attempts, f"{type(e).__name__}: {e}")
+            self.stats["failed" if status == "failed" else "retried"] += 1
+            logger.warning(f"Document {doc_id} analysis attempt {attempts} failed ({status}): {e}")
+        finally:
+            self.stats["in_progress"] -= 1
 
-def save_document(
-    tid: int,
-    doc_type: str,
-    file_id: str,
-    ocr_text: str = "",
-    detected_type: str = "",
-    score: int = 0,
-    notes: str = "",
-    ai_analysis: str = "",
-    ai_confidence: float = 0.0,
-    ai_type: str = "",
-    extracted_name: str = "",
-    extracted_address: str = "",
-    extracted_date: str = "",
-    approved: int = 0,
-    document_country: str = "",
-    expiry_date: str = "",
-    issues: str = "",
-) -> int:
-    """Save document and return the document ID."""
-    conn = get_connection()
-    c = conn.cursor()
-    p = db_param()
-    c.execute(f"""INSERT INTO documents (
-        user_id, doc_type, file_id, ocr_text, detected_type, validation_score, validation_notes,
-        ai_analysis, ai_confidence, ai_type, extracted_name, extracted_address, extracted_date,
-        approved, document_country, expiry_date, issues
-    ) SELECT id, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}
-    FROM users WHERE telegram_id = {p}""",
-        (doc_type, file_id, ocr_text, detected_type, score, notes,
-         ai_analysis, ai_confidence, ai_type, extracted_name, extracted_address, extracted_date,
-         approved, document_country, expiry_date, issues, tid))
-    conn.commit()
 
-    # Get the inserted document ID
-    if USE_POSTGRES:
-        c.execute("SELECT lastval()")
-    else:
-        c.execute("SELECT last_insert_rowid()")
-    doc_id = c.fetchone()[0]
-    conn.close()
-    return doc_id
+document_analysis = DocumentAnalysisQueue(ANALYSIS_WORKERS, ANALYSIS_POLL_SECONDS)
 
 
-def save_message(tid: int, direction: str, content: str, intent: str = ""):
-    conn = get_connection()
-    c = conn.cursor()
-    p = db_param()
-    c.execute(f"""INSERT INTO messages (user_id, direction, content, intent)
-        SELECT id, {p}, {p}, {p} FROM users WHERE telegram_id = {p}""",
-        (direction, content[:500], intent, tid))
-    conn.commit()
-    conn.close()
+# =============================================================================
+# ALBUM UPLOADS (media groups)
+# =============================================================================
 
+class AlbumCollector:
+    """Buffers uploads that share a media_group_id.
 
-def get_or_create_case(tid: int) -> Dict:
-    conn = get_connection()
-    c = conn.cursor()
-    p = db_param()
-    c.execute(f"SELECT c.* FROM cases c JOIN users u ON c.user_id=u.id WHERE u.telegram_id={p}", (tid,))
-    case = c.fetchone()
-    if not case:
-        import random
-        cn = f"PH-2026-{random.randint(1000, 9999)}"
-        c.execute(f"INSERT INTO cases (user_id, case_number) SELECT id, {p} FROM users WHERE telegram_id={p}", (cn, tid))
-        conn.commit()
-        c.execute(f"SELECT * FROM cases WHERE case_number={p}", (cn,))
-        case = c.fetchone()
-    result = _row_to_dict(case, c)
-    conn.close()
-    return result
+    Telegram delivers an album as one update per item. add() stores the item and
+    (re)arms a timer; once no new item has arrived for `window_ms`, the whole
+    album is handed to `on_album(update, ctx, items)` in one call.
+    """
+
+    def __init__(self, window_ms: int, on_album: Callable):
+        self.window = max(50, window_ms) / 1000
+        self.on_album = on_album
+        self._albums: Dict[str, Dict] = {}
+
+    def add(self, update: Update, ctx: ContextTypes.DEFAULT_TYPE, item: Dict):
+        key = update.message.media_group_id
+        album = self._albums.setdefault(key, {"items": [], "timer": None})
+        album["items"].append(item)
+        album["update"], album["ctx"] = update, ctx
+        if album["timer"] is not None:
+            album["timer"].cancel()
+        loop = asyncio.get_running_loop()
+        album["timer"] = loop.call_later(
+            self.window,
+            lambda: loop.create_task(self._flush(key), name=f"album-{key}", context=contextvars.Context()))
+
+    async def _flush(self, key: str):
+        album = self._albums.pop(key, None)
+        if not album:
+            return
+        try:
+            await self.on_album(album["update"], album["ctx"], album["items"])
+        except Exception as e:
+            logger.error(f"Album {key}: failed to process {len(album['items'])} uploads: {e}")
 
 
 # =============================================================================
@@ -2652,35 +5532,52 @@ import random
 import string
 
 
-def get_waitlist_count() -> int:
-    """Deterministic fake waitlist counter. Grows 50-200/day + 2-8/hour from base 3127."""
-    import hashlib
-    from datetime import datetime, date, timedelta
+WAITLIST_LAUNCH_DATE = date(2026, 2, 15)
+WAITLIST_BASE_COUNT = 3127
+
+# Prefix sums for get_waitlist_count: total of all completed days since launch,
+# and of the hours already counted today. Each call only hashes new days/hours.
+_waitlist_counter = {
+    "days": 0, "day_total": WAITLIST_BASE_COUNT,
+    "date": None, "hours": 0, "hour_total": 0,
+}
+
+
+def _waitlist_day_increment(day: date) -> int:
+    day_hash = int(hashlib.md5(f"waitlist-{day}".encode()).hexdigest(), 16)
+    return 50 + (day_hash % 151)
+
 
-    LAUNCH_DATE = date(2026, 2, 15)
-    BASE_COUNT = 3127
+def _waitlist_hour_increment(day: date, hour: int) -> int:
+    hour_hash = int(hashlib.md5(f"waitlist-{day}-{hour}".encode()).hexdigest(), 16)
+    return 2 + (hour_hash % 7)
 
-    now = datetime.now()
+
+def get_waitlist_count(now: Optional[datetime] = None) -> int:
+    """Deterministic fake waitlist counter. Grows 50-200/day + 2-8/hour from base 3127."""
+    now = now or datetime.now()
     today = now.date()
-    days = (today - LAUNCH_DATE).days
+    days = (today - WAITLIST_LAUNCH_DATE).days
 
     if days < 0:
-        return BASE_COUNT
+        return WAITLIST_BASE_COUNT
 
-    total = BASE_COUNT
+    memo = _waitlist_counter
+    if days < memo["days"]:
+        # Clock went backwards: rebuild from launch
+        memo.update(days=0, day_total=WAITLIST_BASE_COUNT)
+    while memo["days"] < days:
+        memo["day_total"] += _waitlist_day_increment(WAITLIST_LAUNCH_DATE + timedelta(days=memo["days"]))
+        memo["days"] += 1
 
-    for day in range(days):
-        seed = f"waitlist-{LAUNCH_DATE + timedelta(days=day)}"
-        day_hash = int(hashlib.md5(seed.encode()).hexdigest(), 16)
-        total += 50 + (day_hash % 151)
+    hours = now.hour + 1
+    if memo["date"] != today or hours < memo["hours"]:
+        memo.update(date=today, hours=0, hour_total=0)
+    while memo["hours"] < hours:
+        memo["hour_total"] += _waitlist_hour_increment(today, memo["hours"])
+        memo["hours"] += 1
 
-    current_hour = now.hour
-    for hour in range(current_hour + 1):
-        seed = f"waitlist-{today}-{hour}"
-        hour_hash = int(hashlib.md5(seed.encode()).hexdigest(), 16)
-        total += 2 + (hour_hash % 7)
-
-    return total
+    return memo["day_total"] + memo["hour_total"]
 
 
 def generate_referral_code(user_id: int) -> str:
@@ -3248,89 +6145,428 @@ def check_image_quality(image) -> Tuple[bool, str]:
     return True, "ok"
 
 
-def classify_document_ocr(text: str) -> str:
-    """Layer 2: Classify document from OCR text."""
-    upper = text.upper()
-    for dtype, config in DOC_TYPES.items():
-        if config["ocr_keywords"]:
-            matches = sum(1 for kw in config["ocr_keywords"] if kw in upper)
-            if matches >= 1:
-                return dtype
-    return "other"
+def normalize_ocr_text(text: str) -> str:
+    """Upper-case ASCII, accents stripped, whitespace collapsed (Padrón\nMunicipal -> PADRON MUNICIPAL)."""
+    return " ".join(unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii").upper().split())
+
+
+class KeywordMatcher:
+    """
+    Weighted keyword matcher over DOC_TYPES["ocr_keywords"], built once.
+    One tokenising pass over the normalized text: single-word keywords are
+    set lookups (plural -S/-ES accepted), multi-word keywords are checked only
+    when their first word occurs. A keyword inside a longer matched one
+    (UBER in UBER EATS) does not count on its own. Weights: multi-word 1.5,
+    short acronyms (ING, RIA, EMT) 0.5, others 1.0, split between types
+    sharing a keyword.
+    """
+
+    _WORD = re.compile(r"[A-Z0-9]+")
+
+    def __init__(self, keywords_by_type: Dict[str, List[str]]):
+        owners: Dict[str, List[str]] = {}
+        for dtype, keywords in keywords_by_type.items():
+            for kw in keywords:
+                owners.setdefault(normalize_ocr_text(kw), []).append(dtype)
+        self.weights: Dict[str, List[Tuple[str, float]]] = {}
+        for kw, types in owners.items():
+            base = 1.5 if " " in kw else (0.5 if len(kw) <= 3 else 1.0)
+            self.weights[kw] = [(dtype, base / len(types)) for dtype in types]
+        self._single = {kw for kw in owners if " " not in kw}
+        self._multi: Dict[str, List[Tuple[str, "re.Pattern"]]] = {}
+        for kw in owners:
+            if " " in kw:
+                self._multi.setdefault(kw.split(" ", 1)[0], []).append(
+                    (kw, re.compile(rf"\b{re.escape(kw)}(?:E?S)?\b")))
+
+    def matches(self, text: str) -> set:
+        """Normalized keywords present in `text`."""
+        norm = normalize_ocr_text(text)
+        words = set(self._WORD.findall(norm))
+        stems = {w[:-1] for w in words if w.endswith("S")} | {w[:-2] for w in words if w.endswith("ES")}
+        found = (words | stems) & self._single
+        for first in words & self._multi.keys():
+            found.update(kw for kw, pattern in self._multi[first] if pattern.search(norm))
+        for phrase in [kw for kw in found if " " in kw]:
+            found.difference_update(phrase.split(" "))
+        return found
+
+    def scores(self, text: str) -> Dict[str, float]:
+        """Weighted keyword score per doc type (types without a hit are absent)."""
+        totals: Dict[str, float] = {}
+        for kw in self.matches(text):
+            for dtype, weight in self.weights[kw]:
+                totals[dtype] = totals.get(dtype, 0.0) + weight
+        return totals
+
+
+doc_keyword_matcher = KeywordMatcher({dtype: cfg["ocr_keywords"] for dtype, cfg in DOC_TYPES.items()})
+OCR_CACHE_KIND = "ocr:2"  # bump when OCR scoring changes so cached facts are recomputed
+
+
+def score_document_ocr(text: str) -> Tuple[str, float]:
+    """
+    Layer 2: best-scoring doc type from OCR text and a 0..1 confidence.
+    Confidence grows with the weighted score (1 -> 0.4, 2 -> 0.7, 3+ -> 0.9)
+    and is halved when another type scores as high.
+    """
+    ranked = sorted(doc_keyword_matcher.scores(text).items(), key=lambda kv: kv[1], reverse=True)
+    if not ranked:
+        return "other", 0.0
+    best, score = ranked[0]
+    confidence = min(0.9, 0.1 + 0.3 * score)
+    if len(ranked) > 1 and ranked[1][1] >= score:
+        confidence /= 2
+    return best, confidence
+
+
+def classify_document_ocr(text: str) -> str:
+    """Layer 2: Classify document from OCR text."""
+    return score_document_ocr(text)[0]
+
+
+def extract_dates(text: str) -> List[str]:
+    """Extract dates from OCR text."""
+    return re.findall(r'\b\d{2}[/-]\d{2}[/-]\d{4}\b', text)
+
+
+def extract_passport_number(text: str) -> Optional[str]:
+    """Extract passport number."""
+    m = re.search(r'\b[A-Z]{1,3}\d{5,9}\b', text.upper())
+    return m.group() if m else None
+
+
+def extract_ocr_facts(photo_bytes: bytes, timeout: float = 0) -> Dict:
+    """
+    Layers 1, 2 and 4 on raw bytes: everything that does not depend on the expected type.
+    Runs in an OCR worker process; `timeout` kills tesseract if it runs longer (0 = no limit).
+    """
+    image = Image.open(BytesIO(photo_bytes))
+    ok, msg = check_image_quality(image)
+    if not ok:
+        return {"quality_ok": False, "quality_msg": msg}
+    try:
+        text = pytesseract.image_to_string(image, lang="spa+eng", timeout=timeout)
+    except RuntimeError as e:
+        if "timeout" in str(e).lower():
+            raise TimeoutError(f"tesseract exceeded {timeout:.0f}s") from None
+        raise
+    detected, confidence = score_document_ocr(text)
+    return {
+        "quality_ok": True,
+        "ocr_text": text[:2000],
+        "detected_type": detected,
+        "ocr_confidence": confidence,
+        "has_dates": bool(extract_dates(text)),
+        "passport_number": extract_passport_number(text),
+    }
+
+
+# --- OCR worker pool ---
+# Tesseract is CPU-bound and takes seconds per page, so extract_ocr_facts runs
+# in a process pool with one worker per usable core (up to 4). At most OCR_QUEUE_MAX jobs are
+# queued or running; a job that cannot get a slot in time, or runs too long,
+# fails like any other OCR error (the document goes to manual review). A
+# cancelled handler drops its job if no worker has picked it up yet.
+
+class OCRPoolBusy(Exception):
+    """The OCR queue stayed full for the whole timeout."""
+
+
+class OCRPool:
+    """Bounded ProcessPoolExecutor front for extract_ocr_facts."""
+
+    def __init__(self, workers: int, queue_max: int, timeout: float):
+        self.workers = max(1, workers)
+        self.queue_max = max(self.workers, queue_max)
+        self.timeout = timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._start_method = "fork"  # only safe before any thread starts; see run()
+        self._slots = asyncio.Semaphore(self.queue_max)
+        self._restart_lock = asyncio.Lock()
+        self.stats = {"done": 0, "failed": 0, "timeouts": 0, "rejected": 0, "pending": 0, "run_total": 0.0}
+
+    def start(self) -> ProcessPoolExecutor:
+        """Create the pool and wait for a worker to answer. Called from main() so workers
+        fork before any thread starts; from the event loop only via run_in_executor (see run())."""
+        if self._executor is None:
+            method = self._start_method
+            ctx = multiprocessing.get_context(method) if method in multiprocessing.get_all_start_methods() else None
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+            self._executor.submit(os.getpid).result()
+            logger.info(f"OCR pool: {self.workers} worker(s), queue {self.queue_max}")
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, photo_bytes: bytes) -> Dict:
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["rejected"] += 1
+            raise OCRPoolBusy(f"OCR queue full ({self.queue_max} jobs)") from None
+        self.stats["pending"] += 1
+        started = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            executor = self._executor
+            if executor is None:
+                # Rebuilding after a crash starts a fresh interpreter; keep that off the event loop
+                async with self._restart_lock:
+                    executor = self._executor or await loop.run_in_executor(None, self.start)
+            future = loop.run_in_executor(executor, extract_ocr_facts, photo_bytes, self.timeout)
+            # Slack for queueing behind other jobs; tesseract itself is killed at self.timeout
+            result = await asyncio.wait_for(future, self.timeout * 2)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise
+        except BrokenProcessPool:
+            self.stats["failed"] += 1
+            logger.error("OCR pool: worker died, restarting pool")
+            self.shutdown()
+            # The bot is multi-threaded by now; forking it could copy a held lock into the new workers
+            self._start_method = "forkserver"
+            raise
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            self.stats["pending"] -= 1
+            self._slots.release()
+        self.stats["done"] += 1
+        self.stats["run_total"] += time.monotonic() - started
+        return result
+
+    def snapshot(self) -> Dict:
+        done = self.stats["done"]
+        return dict(self.stats, workers=self.workers, queue_max=self.queue_max,
+                    avg_seconds=self.stats["run_total"] / done if done else 0.0)
+
+
+ocr_pool = OCRPool(OCR_WORKERS, OCR_QUEUE_MAX, OCR_TIMEOUT_SECONDS)
+
+
+async def _ocr_facts_for(photo_bytes: bytes, file_unique_id: Optional[str] = None) -> Dict:
+    """OCR facts from the analysis cache, or computed in the OCR pool and stored."""
+    digest = content_hash(photo_bytes)
+    facts = await analysis_cache.get(OCR_CACHE_KIND, sha256=digest, file_unique_id=file_unique_id)
+    if facts is None:
+        facts = await ocr_pool.run(photo_bytes)
+        await analysis_cache.put(OCR_CACHE_KIND, digest, file_unique_id, facts)
+    return facts
+
+
+def _score_ocr_facts(result: Dict, facts: Dict, expected_type: str) -> Dict:
+    """Layers 1-4 scoring of OCR facts into a process_document result."""
+    # Layer 1: Image quality
+    if not facts["quality_ok"]:
+        result["notes"].append(facts["quality_msg"])
+        result["score"] = 10
+        return result
+
+    result["score"] += 20  # Image quality passed
+
+    # Layer 2: OCR + classification
+    result["ocr_text"] = facts["ocr_text"]
+    detected = facts["detected_type"]
+    result["detected_type"] = detected
+
+    if detected != "other":
+        result["score"] += 20  # Document classified
+
+    # Layer 3: Type match
+    if detected == expected_type or expected_type == "other":
+        result["score"] += 20
+    else:
+        result["notes"].append(
+            f"Esperábamos «{DOC_TYPES.get(expected_type, {}).get('name', expected_type)}» "
+            f"pero parece ser «{DOC_TYPES.get(detected, {}).get('name', detected)}»."
+        )
+
+    # Layer 4: Data extraction
+    if facts["has_dates"]:
+        result["score"] += 10
+    if facts["passport_number"]:
+        result["score"] += 10
+
+    result["success"] = True
+    return result
+
+
+async def process_document(photo_file, expected_type: str) -> Dict:
+    """Full document processing pipeline (OCR facts cached per file content)."""
+    result = {
+        "success": False,
+        "detected_type": "other",
+        "ocr_text": "",
+        "score": 0,
+        "notes": [],
+    }
+
+    if not OCR_AVAILABLE:
+        result["success"] = True
+        result["score"] = 50
+        result["notes"].append("Documento guardado. Será revisado manualmente.")
+        return result
+
+    try:
+        # A re-sent or forwarded file is known by file_unique_id before downloading it
+        file_unique_id = getattr(photo_file, "file_unique_id", None)
+        facts = await analysis_cache.get(OCR_CACHE_KIND, file_unique_id=file_unique_id) if file_unique_id else None
+        if facts is None:
+            photo_bytes = bytes(await photo_file.download_as_bytearray())
+            facts = await _ocr_facts_for(photo_bytes, file_unique_id)
+        _score_ocr_facts(result, facts, expected_type)
+
+    except Exception as e:
+        logger.error(f"Document processing error: {e}")
+        result["success"] = True
+        result["score"] = 40
+        result["notes"].append("No pudimos analizar el documento automáticamente. Será revisado por nuestro equipo.")
+
+    return result
+
 
+# --- Classification cascade ---
+# Cheapest stage first: (1) check_image_quality on the image header rejects
+# unusable photos; (2) local OCR keyword scoring decides when it is confident
+# and the type needs no field extraction; (3) Claude Vision for the rest.
+# Each stage records how often it ran, how often it decided, and its latency.
 
-def extract_dates(text: str) -> List[str]:
-    """Extract dates from OCR text."""
-    return re.findall(r'\b\d{2}[/-]\d{2}[/-]\d{4}\b', text)
+CLASSIFY_STAGES = ("quality", "ocr", "vision")
+classifier_stats = {stage: {"runs": 0, "decided": 0, "seconds": 0.0} for stage in CLASSIFY_STAGES}
 
 
-def extract_passport_number(text: str) -> Optional[str]:
-    """Extract passport number."""
-    m = re.search(r'\b[A-Z]{1,3}\d{5,9}\b', text.upper())
-    return m.group() if m else None
+def _classifier_record(stage: str, started: float, decided: bool):
+    st = classifier_stats[stage]
+    st["runs"] += 1
+    st["decided"] += int(decided)
+    st["seconds"] += time.monotonic() - started
 
 
-async def process_document(photo_file, expected_type: str) -> Dict:
-    """Full document processing pipeline."""
+def classifier_snapshot() -> Dict:
+    return {
+        stage: {
+            "runs": st["runs"],
+            "decided": st["decided"],
+            "hit_rate": st["decided"] / st["runs"] if st["runs"] else 0.0,
+            "avg_ms": st["seconds"] * 1000 / st["runs"] if st["runs"] else 0.0,
+        }
+        for stage, st in classifier_stats.items()
+    }
+
+
+async def classify_document(photo_file, expected_type: str) -> Dict:
+    """
+    Tiered classification of an uploaded document.
+    Returns the process_document result plus `stage` (the stage that decided),
+    `confidence` and `vision` (the Claude analysis, when stage 3 ran). When no
+    stage could decide, `error` says why (the user-facing fallback is still set).
+    """
     result = {
         "success": False,
         "detected_type": "other",
         "ocr_text": "",
         "score": 0,
         "notes": [],
+        "stage": None,
+        "confidence": 0.0,
+        "vision": None,
     }
+    file_unique_id = getattr(photo_file, "file_unique_id", None)
+    photo_bytes: Optional[bytes] = None
 
-    if not OCR_AVAILABLE:
-        result["success"] = True
-        result["score"] = 50
-        result["notes"].append("Documento guardado. Será revisado manualmente.")
-        return result
+    async def download() -> bytes:
+        nonlocal photo_bytes
+        if photo_bytes is None:
+            photo_bytes = bytes(await photo_file.download_as_bytearray())
+        return photo_bytes
 
     try:
-        photo_bytes = await photo_file.download_as_bytearray()
-        image = Image.open(BytesIO(photo_bytes))
-
-        # Layer 1: Image quality
-        ok, msg = check_image_quality(image)
+        # Stage 1: image quality (header only; a cached OCR result already knows the answer)
+        started = time.monotonic()
+        facts = None
+        readable = True
+        if OCR_AVAILABLE and file_unique_id:
+            facts = await analysis_cache.get(OCR_CACHE_KIND, file_unique_id=file_unique_id)
+        if facts is not None:
+            ok, msg = facts["quality_ok"], facts.get("quality_msg", "")
+        elif IMAGE_PREPROCESS:
+            data = await download()
+            ok, msg = True, "ok"
+            if sniff_media_type(data) != "application/pdf":
+                try:
+                    ok, msg = check_image_quality(Image.open(BytesIO(data)))
+                except OSError as e:  # UnidentifiedImageError, truncated file
+                    logger.info(f"Quality check skipped, Pillow cannot read the file: {e}")
+                    readable = False
+        else:
+            ok, msg = True, "ok"
+        _classifier_record("quality", started, decided=not ok)
         if not ok:
+            result.update(success=True, stage="quality", score=10)
             result["notes"].append(msg)
-            result["score"] = 10
+            return result
+        if not readable and sniff_media_type(await download()) is None:
+            # Neither Pillow nor vision can read it (HEIC, docx, zip...): leave it to the reviewer
+            result.update(success=True, stage="quality", score=40)
+            result["notes"].append("Formato de archivo no reconocido. Será revisado por nuestro equipo.")
             return result
 
-        result["score"] += 20  # Image quality passed
-
-        # Layer 2: OCR + classification
-        text = pytesseract.image_to_string(image, lang="spa+eng")
-        result["ocr_text"] = text[:2000]
-        detected = classify_document_ocr(text)
-        result["detected_type"] = detected
-
-        if detected != "other":
-            result["score"] += 20  # Document classified
-
-        # Layer 3: Type match
-        if detected == expected_type or expected_type == "other":
-            result["score"] += 20
-        else:
-            result["notes"].append(
-                f"Esperábamos «{DOC_TYPES.get(expected_type, {}).get('name', expected_type)}» "
-                f"pero parece ser «{DOC_TYPES.get(detected, {}).get('name', detected)}»."
-            )
-
-        # Layer 4: Data extraction
-        dates = extract_dates(text)
-        if dates:
-            result["score"] += 10
-        passport_num = extract_passport_number(text)
-        if passport_num:
-            result["score"] += 10
+        # Stage 2: local OCR + keyword scoring (not for PDFs or unreadable images;
+        # an OCR failure falls through to vision)
+        if OCR_AVAILABLE and readable and (
+                facts is not None or sniff_media_type(await download()) != "application/pdf"):
+            started = time.monotonic()
+            try:
+                if facts is None:
+                    facts = await _ocr_facts_for(await download(), file_unique_id)
+            except Exception as e:
+                logger.warning(f"OCR stage failed, trying vision: {type(e).__name__}: {e}")
+                _classifier_record("ocr", started, decided=False)
+            else:
+                _score_ocr_facts(result, facts, expected_type)
+                result["confidence"] = facts.get("ocr_confidence", 0.0)
+                decided = (result["confidence"] >= CLASSIFY_OCR_MIN_CONFIDENCE
+                           and result["detected_type"] not in CLASSIFY_VISION_TYPES
+                           and expected_type not in CLASSIFY_VISION_TYPES)
+                _classifier_record("ocr", started, decided)
+                if decided:
+                    result["stage"] = "ocr"
+                    return result
+
+        # Stage 3: Claude Vision
+        started = time.monotonic()
+        vision = await analyze_document_with_claude(await download(), file_unique_id)
+        _classifier_record("vision", started, decided=vision.get("success", False))
+        if vision.get("success"):
+            detected = get_doc_type_from_ai(vision.get("type", "other"))
+            ocr_scored = result["success"]
+            result.update(success=True, stage="vision", vision=vision,
+                          detected_type=detected, confidence=vision.get("confidence", 0.0))
+            if not ocr_scored:
+                result["score"] = 40 + (20 if detected != "other" else 0)
+            result["notes"] = [n for n in result["notes"] if not n.startswith("Esperábamos")]
+            if detected != expected_type and expected_type != "other":
+                result["notes"].append(
+                    f"Esperábamos «{DOC_TYPES.get(expected_type, {}).get('name', expected_type)}» "
+                    f"pero parece ser «{DOC_TYPES.get(detected, {}).get('name', detected)}»."
+                )
+            return result
 
-        result["success"] = True
+        # Vision unavailable or failed: keep the OCR answer, if any
+        if result["success"]:
+            result["stage"] = "ocr"
+            return result
+        result.update(success=True, score=50, error=vision.get("error", "vision failed"))
+        result["notes"].append("Documento guardado. Será revisado manualmente.")
 
     except Exception as e:
-        logger.error(f"Document processing error: {e}")
-        result["success"] = True
-        result["score"] = 40
+        logger.error(f"Document classification error: {e}")
+        result.update(success=True, score=40, error=f"{type(e).__name__}: {e}")
         result["notes"].append("No pudimos analizar el documento automáticamente. Será revisado por nuestro equipo.")
 
     return result
@@ -3539,8 +6775,9 @@ def doc_type_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(buttons)
 
 
-def main_menu_kb(user: Dict) -> InlineKeyboardMarkup:
-    dc = get_doc_count(user["telegram_id"])
+def main_menu_kb(user: Dict, dc: Optional[int] = None) -> InlineKeyboardMarkup:
+    if dc is None:
+        dc = get_doc_count(user["telegram_id"])
     btns = [
         [InlineKeyboardButton("Continuar con mi proceso", callback_data="continue_process")],
         [InlineKeyboardButton("Mi checklist de documentos", callback_data="m_checklist")],
@@ -3577,7 +6814,10 @@ def faq_category_kb(cat_key: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(btns)
 
 
-async def notify_admins(context, msg: str):
+async def notify_admins(context, msg: str, urgent: bool = False):
+    if admin_notifier.running:
+        admin_notifier.notify("send_message", urgent=urgent, text=msg, parse_mode=ParseMode.MARKDOWN)
+        return
     for aid in ADMIN_IDS:
         try:
             await context.bot.send_message(aid, msg, parse_mode=ParseMode.MARKDOWN)
@@ -4159,7 +7399,7 @@ def _user_doc_summary(tid: int) -> str:
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle /start, including referral codes from deep links."""
     tid = update.effective_user.id
-    user = get_user(tid)
+    user = await aget_user(tid)
 
     # Existing user with eligibility → main menu
     if user and user.get("eligible"):
@@ -4167,7 +7407,7 @@ async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     # Create user if new
     if not user:
-        create_user(tid, update.effective_user.first_name or "Usuario")
+        await acreate_user(tid, update.effective_user.first_name or "Usuario")
 
     # Check for referral code in start param (deep link: t.me/bot?start=CODE)
     if ctx.args and len(ctx.args) > 0:
@@ -4178,7 +7418,7 @@ async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         if code.startswith("INST_"):
             code = "INST-" + code[5:].replace("_", "-")
 
-        result = validate_referral_code(code)
+        result = await run_db(validate_referral_code, code)
 
         if result['valid']:
             code_type = result.get('code_type', 'friend')
@@ -4186,11 +7426,11 @@ async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
             if code_type == 'institutional':
                 # Institutional code — store relationship
-                apply_institutional_referral(tid, result['code'])
+                await run_db(apply_institutional_referral, tid, result['code'])
                 source_name = result['referrer_name']
             elif result['referrer_id'] != tid:
                 # Friend code — existing logic
-                apply_referral_code_to_user(tid, result['code'], result['referrer_id'])
+                await run_db(apply_referral_code_to_user, tid, result['code'], result['referrer_id'])
                 source_name = result['referrer_name']
 
             if source_name:
@@ -4269,7 +7509,7 @@ async def cmd_reset(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     logger.info(f"RESET requested by admin {tid} for user {target_tid}")
 
     # Delete from database
-    delete_user(target_tid)
+    await run_db(delete_user, target_tid)
 
     # Clear context data if resetting own account
     if target_tid == tid:
@@ -4311,7 +7551,7 @@ async def handle_referral_code_text(update: Update, ctx: ContextTypes.DEFAULT_TY
     code = update.message.text.upper().strip()
 
     # Validate
-    result = validate_referral_code(code)
+    result = await run_db(validate_referral_code, code)
 
     if not result['valid']:
         await update.message.reply_text(
@@ -4326,7 +7566,7 @@ async def handle_referral_code_text(update: Update, ctx: ContextTypes.DEFAULT_TY
     # Handle by code type
     if result.get('code_type') == 'institutional':
         # Institutional code — apply directly
-        apply_institutional_referral(tid, result['code'])
+        await run_db(apply_institutional_referral, tid, result['code'])
     elif result['referrer_id'] == tid:
         # Can't use own code
         await update.message.reply_text(
@@ -4338,7 +7578,7 @@ async def handle_referral_code_text(update: Update, ctx: ContextTypes.DEFAULT_TY
         return ST_ENTER_REFERRAL_CODE
     else:
         # Friend code — existing logic
-        apply_referral_code_to_user(tid, result['code'], result['referrer_id'])
+        await run_db(apply_referral_code_to_user, tid, result['code'], result['referrer_id'])
 
     await update.message.reply_text(
         f"Código aplicado. Tienes €{PRICING['referral_discount']} de descuento en tu Fase 4.\n\n"
@@ -4373,7 +7613,7 @@ async def handle_referral_callbacks(update: Update, ctx: ContextTypes.DEFAULT_TY
         return ST_ENTER_REFERRAL_CODE
 
     elif q.data == "ref_copy":
-        user = get_user(update.effective_user.id)
+        user = await aget_user(update.effective_user.id)
         code = user.get('referral_code', '')
         await q.answer(f"Tu código: {code}", show_alert=True)
         return ST_MAIN_MENU
@@ -4415,7 +7655,7 @@ async def handle_country(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     await q.answer()
     code = q.data.replace("c_", "")
     country = COUNTRIES.get(code, COUNTRIES["other"])
-    update_user(update.effective_user.id, country_code=code)
+    await aupdate_user(update.effective_user.id, country_code=code)
 
     # Info only — no upsell at this stage
     antec_info = COUNTRIES_ANTECEDENTES_INFO.get(code, {})
@@ -4443,7 +7683,7 @@ async def handle_full_name(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> in
         await update.message.reply_text("Por favor, escribe tu nombre completo:")
         return ST_FULL_NAME
 
-    update_user(update.effective_user.id, full_name=name)
+    await aupdate_user(update.effective_user.id, full_name=name)
 
     await update.message.reply_text(
         f"Gracias, {name.split()[0]}.\n\n"
@@ -4558,11 +7798,11 @@ async def handle_q2(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 async def handle_q3(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     q = update.callback_query
     await q.answer()
-    user = get_user(update.effective_user.id)
+    user = await aget_user(update.effective_user.id)
     name = user.get("first_name", "")
 
     if q.data == "r_yes":
-        update_user(update.effective_user.id, has_criminal_record=1)
+        await aupdate_user(update.effective_user.id, has_criminal_record=1)
         await q.edit_message_text(
             "Tener antecedentes no supone automáticamente una exclusión. "
             "Depende del tipo de delito y las circunstancias.\n\n"
@@ -4589,14 +7829,14 @@ async def handle_q3(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     # r_clean — ELIGIBLE
     tid = update.effective_user.id
-    update_user(tid, eligible=1, has_criminal_record=0)
-    case = get_or_create_case(tid)
+    await aupdate_user(tid, eligible=1, has_criminal_record=0)
+    case = await aget_or_create_case(tid)
 
     # Generate referral code for user
-    user = get_user(tid)
+    user = await aget_user(tid)
     if not user.get('referral_code'):
-        code = generate_referral_code(tid)
-        update_user(tid, referral_code=code)
+        code = await run_db(generate_referral_code, tid)
+        await aupdate_user(tid, referral_code=code)
     else:
         code = user['referral_code']
 
@@ -4627,8 +7867,8 @@ async def handle_q3(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 async def show_eligible_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     """Show the standard post-eligibility menu with upload/waitlist/FAQ options."""
     tid = update.effective_user.id
-    user = get_user(tid)
-    case = get_or_create_case(tid)
+    user = await aget_user(tid)
+    case = await aget_or_create_case(tid)
     counter = get_waitlist_count()
     name = user.get('full_name') or user.get('first_name', '')
 
@@ -4663,10 +7903,10 @@ async def handle_collect_whatsapp(update: Update, ctx: ContextTypes.DEFAULT_TYPE
 
         if d == "wa_same":
             # Try to get phone from Telegram contact (may not be available)
-            user = get_user(tid)
+            user = await aget_user(tid)
             phone = user.get('phone')
             if phone:
-                update_user(tid, whatsapp_phone=phone)
+                await aupdate_user(tid, whatsapp_phone=phone)
                 await q.edit_message_text(
                     f"Perfecto, te avisaremos al {phone}.\n\n"
                     "¿Y por email? Te enviamos un resumen mensual "
@@ -4714,7 +7954,7 @@ async def handle_collect_whatsapp(update: Update, ctx: ContextTypes.DEFAULT_TYPE
             tid = update.effective_user.id
             if not phone.startswith('+'):
                 phone = '+' + phone
-            update_user(tid, whatsapp_phone=phone)
+            await aupdate_user(tid, whatsapp_phone=phone)
             await update.message.reply_text(
                 f"Guardado: {phone}\n\n"
                 "¿Y por email? Te enviamos un resumen mensual.",
@@ -4754,7 +7994,7 @@ async def handle_collect_email(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -
         email = update.message.text.strip().lower()
         if '@' in email and '.' in email.split('@')[-1]:
             tid = update.effective_user.id
-            update_user(tid, email=email)
+            await aupdate_user(tid, email=email)
             await update.message.reply_text(f"Guardado: {email}")
             return await show_community_invite(update, ctx, edit=False)
         else:
@@ -4805,7 +8045,7 @@ async def handle_community_invite(update: Update, ctx: ContextTypes.DEFAULT_TYPE
     tid = update.effective_user.id
 
     if q.data == "community_joined":
-        update_user(tid, joined_community_group=1, joined_channel=1)
+        await aupdate_user(tid, joined_community_group=1, joined_channel=1)
 
     # Now offer demographics questionnaire
     await q.edit_message_text(
@@ -4836,7 +8076,7 @@ async def handle_demo_intro(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> i
     tid = update.effective_user.id
 
     if q.data == "demo_skip":
-        update_user(tid, demographics_skipped=1)
+        await aupdate_user(tid, demographics_skipped=1)
         return await show_eligible_menu(update, ctx)
 
     # demo_start — begin questionnaire
@@ -5134,7 +8374,7 @@ async def handle_demo_marketing_consent(update: Update, ctx: ContextTypes.DEFAUL
     research_consent = demo_data.pop('research_consent', 0)
 
     # Save everything
-    update_user(
+    await aupdate_user(
         tid,
         demographics_completed=1,
         demographics_data=json.dumps(demo_data, ensure_ascii=False),
@@ -5165,8 +8405,8 @@ async def handle_waitlist(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int
         await q.answer()
 
     tid = update.effective_user.id
-    user = get_user(tid)
-    doc_count = get_doc_count(tid)
+    user = await aget_user(tid)
+    doc_count = await aget_doc_count(tid)
     counter = get_waitlist_count()
 
     text = (
@@ -5207,7 +8447,7 @@ async def handle_waitlist(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int
 # --- Main menu ---
 
 async def show_main_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
-    user = get_user(update.effective_user.id)
+    user = await aget_user(update.effective_user.id)
     if not user or not user.get("eligible"):
         # User doesn't exist or hasn't completed eligibility - redirect to start
         msg = "Escriba /start para comenzar el proceso de regularización."
@@ -5218,10 +8458,10 @@ async def show_main_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
 
     name = user.get("full_name") or user.get("first_name", "Usuario")
-    case = get_or_create_case(update.effective_user.id)
+    case = await aget_or_create_case(update.effective_user.id)
     tid = update.effective_user.id
-    dc_total = get_doc_count(tid)
-    dc_approved = get_approved_doc_count(tid)
+    dc_total = await aget_doc_count(tid)
+    dc_approved = await aget_approved_doc_count(tid)
 
     # Dynamic progress bar (shared calculation)
     progress = calculate_progress(user, dc_approved)
@@ -5242,7 +8482,7 @@ async def show_main_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         f"Quedan {days_left()} días para el cierre del plazo."
     )
 
-    kb = main_menu_kb(user)
+    kb = main_menu_kb(user, dc_total)
     if update.callback_query:
         await update.callback_query.edit_message_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=kb)
     else:
@@ -5256,7 +8496,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     q = update.callback_query
     await q.answer()
     d = q.data
-    user = get_user(update.effective_user.id)
+    user = await aget_user(update.effective_user.id)
 
     # If user was deleted (via /reset), redirect to start
     if not user:
@@ -5401,7 +8641,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         country_code = user.get("country_code", "other") if user else "other"
         country = COUNTRIES.get(country_code, COUNTRIES["other"])
 
-        checklist = get_personalized_checklist(tid, country_code)
+        checklist = await run_db(get_personalized_checklist, tid, country_code)
 
         await q.edit_message_text(
             f"📋 *Tu checklist — {country['flag']} {country['name']}*\n\n"
@@ -5415,7 +8655,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         return ST_MAIN_MENU
 
     if d == "m_docs":
-        docs = get_user_docs(update.effective_user.id)
+        docs = await aget_user_docs(update.effective_user.id)
         if not docs:
             text = "*Tus documentos*\n\nAún no has subido ningún documento."
         else:
@@ -5453,7 +8693,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         ctx.user_data["doc_type"] = dtype
         # Check for duplicate document (passport, nie, dni, antecedentes)
         if dtype in ("passport", "nie", "dni", "antecedentes"):
-            existing = get_user_doc_by_type(update.effective_user.id, dtype)
+            existing = await run_db(get_user_doc_by_type, update.effective_user.id, dtype)
             if existing:
                 ctx.user_data["replace_doc_id"] = existing["id"]
                 await q.edit_message_text(
@@ -5483,7 +8723,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         info = DOC_TYPES.get(dtype, DOC_TYPES["other"])
         old_id = ctx.user_data.pop("replace_doc_id", None)
         if old_id:
-            delete_document(old_id)
+            await run_db(delete_document, old_id)
         ctx.user_data["doc_type"] = dtype
         tip = f"\n\n💡 {info['tip']}" if info.get("tip") else ""
         await q.edit_message_text(
@@ -5511,7 +8751,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     if d == "m_referidos":
         tid = update.effective_user.id
-        stats = get_referral_stats(tid)
+        stats = await run_db(get_referral_stats, tid)
 
         if not stats or not stats['code']:
             await q.edit_message_text(
@@ -5551,7 +8791,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     if d == "m_contact":
         tid = update.effective_user.id
-        u = get_user(tid)
+        u = await aget_user(tid)
         if not u or not u.get("phase2_paid"):
             await q.edit_message_text(
                 "*Consulta con abogado*\n\n"
@@ -5588,11 +8828,11 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     if d == "m_pay2":
         tid = update.effective_user.id
-        dc = get_doc_count(tid)
+        dc = await aget_doc_count(tid)
         base_price = PRICING['phase2']
 
         # Check friend discount
-        friend_disc = get_friend_discount(tid)
+        friend_disc = await run_db(get_friend_discount, tid)
         discount = friend_disc['amount'] if friend_disc['has_discount'] else 0
 
         # Check referral credits
@@ -5649,13 +8889,13 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         credits_used = ctx.user_data.get('payment_credits', 0)
 
         if discount > 0:
-            apply_friend_discount(tid)
+            await run_db(apply_friend_discount, tid)
 
         if credits_used > 0:
             mark_credits_used(tid, credits_used)
 
         # Update user status
-        update_user(tid, phase2_paid=1, current_phase=2, state="phase2_active")
+        await aupdate_user(tid, phase2_paid=1, current_phase=2, state="phase2_active")
 
         # Notify admins (referrer credit moved to Phase 3)
         await notify_admins(ctx,
@@ -5663,7 +8903,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
             f"Descuento: €{discount} | Créditos: €{credits_used}")
 
         # Get user's referral code for activation message
-        user = get_user(tid)
+        user = await aget_user(tid)
         code = user.get('referral_code', '')
         share_btns = get_share_buttons(code)
 
@@ -5683,7 +8923,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         return ST_MAIN_MENU
 
     if d == "m_pay3":
-        u = get_user(update.effective_user.id)
+        u = await aget_user(update.effective_user.id)
         code = u.get("referral_code", "") if u else ""
         text = (
             f"*Preparación del expediente — €{PRICING['phase3']}*\n\n"
@@ -5712,12 +8952,12 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     if d == "paid3":
         tid = update.effective_user.id
-        update_user(tid, state="phase3_pending", phase3_paid=1, current_phase=3)
-        u = get_user(tid)
+        await aupdate_user(tid, state="phase3_pending", phase3_paid=1, current_phase=3)
+        u = await aget_user(tid)
         code = u.get("referral_code", "") if u else ""
 
         # Update referrer tier progress on Phase 2 payment
-        result = update_referrer_progress(tid, 'phase2')
+        result = await run_db(update_referrer_progress, tid, 'phase2')
         if result.get('updated') and result.get('tier_changed'):
             try:
                 tier_name = "EMBAJADOR" if result['new_tier'] == 'embajador' else "CÓNSUL"
@@ -5759,10 +8999,10 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     if d == "m_pay4":
         dl = days_left()
-        u = get_user(update.effective_user.id)
+        u = await aget_user(update.effective_user.id)
         code = u.get("referral_code", "") if u else ""
 
-        friend_disc = get_friend_discount(update.effective_user.id)
+        friend_disc = await run_db(get_friend_discount, update.effective_user.id)
         if friend_disc['has_discount'] and friend_disc['phase'] == 4:
             base_price = PRICING['phase4'] - friend_disc['amount']
             discount_msg = f"\n🎁 Descuento de amigo: -€{friend_disc['amount']}"
@@ -5806,15 +9046,15 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     if d == "paid4":
         tid = update.effective_user.id
-        update_user(tid, state="phase4_pending")
+        await aupdate_user(tid, state="phase4_pending")
 
         # Unlock tier when user completes full payment
-        unlock_referrer_tier(tid, instant_consul=False)
+        await run_db(unlock_referrer_tier, tid, instant_consul=False)
 
         # Credit institutional partner if applicable
-        credit_institutional_partner(tid, 'full_phases')
+        await run_db(credit_institutional_partner, tid, 'full_phases')
 
-        u = get_user(tid)
+        u = await aget_user(tid)
         code = u.get("referral_code", "") if u else ""
         await notify_admins(ctx,
             f"💳 *Pago Fase 4 pendiente*\n"
@@ -5845,7 +9085,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     if d == "pay_full":
         tid = update.effective_user.id
-        u = get_user(tid)
+        u = await aget_user(tid)
         has_referral = u.get("used_referral_code") is not None
         price = PRICING["prepay_total"] - PRICING["referral_discount"] if has_referral else PRICING["prepay_total"]
         referral_line = f"\n🎁 _Descuento de €{PRICING['referral_discount']} aplicado por usar código de amigo._\n" if has_referral else ""
@@ -5857,10 +9097,10 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         btns.append([InlineKeyboardButton("Volver", callback_data="back")])
 
         # €199 prepay = instant Cónsul
-        unlock_referrer_tier(tid, instant_consul=True)
+        await run_db(unlock_referrer_tier, tid, instant_consul=True)
 
         # Credit institutional partner if applicable
-        credit_institutional_partner(tid, 'prepay')
+        await run_db(credit_institutional_partner, tid, 'prepay')
 
         await q.edit_message_text(
             f"💳 *Pago Único — €{price}*\n\n"
@@ -5917,7 +9157,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     if d == "confirm_antecedentes_request":
         tid = update.effective_user.id
-        u = get_user(tid)
+        u = await aget_user(tid)
         country_code = u.get("country_code", "other") if u else "other"
         uname = update.effective_user.username or "N/A"
         admin_msg = (
@@ -5947,7 +9187,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     if d == "buy_antecedentes":
         tid = update.effective_user.id
-        u = get_user(tid)
+        u = await aget_user(tid)
         country_code = u.get("country_code", "other") if u else "other"
         # Show country-specific upsell message
         upsell_msg = get_antecedentes_upsell_message(country_code)
@@ -6072,7 +9312,7 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     # --- Bundle offers ---
     if d == "buy_vip_bundle":
-        u = get_user(update.effective_user.id)
+        u = await aget_user(update.effective_user.id)
         has_referral = u.get("used_referral_code") is not None if u else False
         price = PRICING['vip_bundle'] - PRICING['referral_discount'] if has_referral else PRICING['vip_bundle']
         btns = []
@@ -6175,15 +9415,15 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 
     # --- Phase 2 pitch (after 3+ docs) — capacity check ---
     if d == "request_phase2":
-        dc = get_doc_count(update.effective_user.id)
-        u = get_user(update.effective_user.id)
+        dc = await aget_doc_count(update.effective_user.id)
+        u = await aget_user(update.effective_user.id)
 
-        if is_capacity_full():
+        if await run_db(is_capacity_full):
             # CAPACITY FULL — redirect to waitlist
             return await handle_waitlist(update, ctx)
 
         # SLOTS AVAILABLE — normal Phase 2 pitch
-        available = get_available_slots()
+        available = await run_db(get_available_slots)
         has_referral = u.get("used_referral_code") is not None if u else False
         phase2_price = PRICING["phase2"] - PRICING["referral_discount"] if has_referral else PRICING["phase2"]
         prepay_price = PRICING["prepay_total"] - PRICING["referral_discount"] if has_referral else PRICING["prepay_total"]
@@ -6212,12 +9452,12 @@ async def handle_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     # --- Waitlist ---
     if d == "join_waitlist":
         tid = update.effective_user.id
-        u = get_user(tid)
-        dc = get_doc_count(tid)
+        u = await aget_user(tid)
+        dc = await aget_doc_count(tid)
         name = u.get("full_name") or u.get("first_name", "") if u else ""
         country = u.get("country_code", "") if u else ""
-        add_to_waitlist(tid, name, country, dc)
-        position = get_waitlist_position(tid)
+        await run_db(add_to_waitlist, tid, name, country, dc)
+        position = await run_db(get_waitlist_position, tid)
         await notify_admins(ctx, f"⏳ *Nuevo en lista de espera*\nUsuario: {name} ({tid})\nPosición: #{position}\nDocs: {dc}")
         await q.edit_message_text(
             f"*Estás en la lista de espera*\n\n"
@@ -6298,9 +9538,9 @@ async def handle_phase2_questionnaire(update: Update, ctx: ContextTypes.DEFAULT_
 
     if next_idx < 0:
         # Questionnaire complete — generate report
-        user = get_user(update.effective_user.id)
-        update_user(update.effective_user.id, phase2_answers=json.dumps(answers))
-        report = generate_phase2_report(user, answers)
+        user = await aget_user(update.effective_user.id)
+        await aupdate_user(update.effective_user.id, phase2_answers=json.dumps(answers))
+        report = await run_db(generate_phase2_report, user, answers)
 
         # Check for upsell opportunities based on answers
         upsell_btns = []
@@ -6368,9 +9608,9 @@ async def handle_phase2_text_answer(update: Update, ctx: ContextTypes.DEFAULT_TY
 
     if next_idx < 0:
         # Questionnaire complete
-        user = get_user(update.effective_user.id)
-        update_user(update.effective_user.id, phase2_answers=json.dumps(answers))
-        report = generate_phase2_report(user, answers)
+        user = await aget_user(update.effective_user.id)
+        await aupdate_user(update.effective_user.id, phase2_answers=json.dumps(answers))
+        report = await run_db(generate_phase2_report, user, answers)
 
         upsell_btns = []
         if answers.get("antecedentes_foreign_status") in ("antec_none", "antec_partial", "antec_difficult"):
@@ -6444,7 +9684,7 @@ async def handle_phase3_questionnaire(update: Update, ctx: ContextTypes.DEFAULT_
     if next_idx < 0:
         # Questionnaire complete — save and notify
         tid = update.effective_user.id
-        update_user(tid, phase3_answers=json.dumps(answers))
+        await aupdate_user(tid, phase3_answers=json.dumps(answers))
 
         await q.edit_message_text(
             PHASE3_COMPLETION,
@@ -6453,7 +9693,7 @@ async def handle_phase3_questionnaire(update: Update, ctx: ContextTypes.DEFAULT_
                 [InlineKeyboardButton("Menu principal", callback_data="back")],
             ]))
 
-        user = get_user(tid)
+        user = await aget_user(tid)
         name = user.get("full_name") or user.get("first_name", "?") if user else "?"
         await notify_admins(ctx,
             f"📝 *Cuestionario Fase 3 completado*\n"
@@ -6501,7 +9741,7 @@ async def handle_phase3_text_answer(update: Update, ctx: ContextTypes.DEFAULT_TY
     if next_idx < 0:
         # Questionnaire complete
         tid = update.effective_user.id
-        update_user(tid, phase3_answers=json.dumps(answers))
+        await aupdate_user(tid, phase3_answers=json.dumps(answers))
 
         await update.message.reply_text(
             PHASE3_COMPLETION,
@@ -6510,7 +9750,7 @@ async def handle_phase3_text_answer(update: Update, ctx: ContextTypes.DEFAULT_TY
                 [InlineKeyboardButton("Menu principal", callback_data="back")],
             ]))
 
-        user = get_user(tid)
+        user = await aget_user(tid)
         name = user.get("full_name") or user.get("first_name", "?") if user else "?"
         await notify_admins(ctx,
             f"📝 *Cuestionario Fase 3 completado*\n"
@@ -6608,20 +9848,27 @@ async def handle_photo_upload(update: Update, ctx: ContextTypes.DEFAULT_TYPE) ->
     info = DOC_TYPES.get(dtype, DOC_TYPES["other"])
     tid = update.effective_user.id
 
-    # Save document immediately — always accept, admin reviews later
-    doc_id = save_document(
-        tid=tid,
-        doc_type=dtype,
-        file_id=file_id,
+    if update.message.media_group_id:
+        album_uploads.add(update, ctx, {"method": "send_photo", "file_id": file_id, "doc_type": dtype,
+                                        "ocr_text": "", "label": info['name']})
+        return ST_MAIN_MENU
+
+    # Save document immediately — always accept, admin reviews later.
+    # One round trip returns the new id, the doc count and the user's name.
+    saved = await aingest_document(
+        tid,
+        dtype,
+        file_id,
         ocr_text="",
         detected_type=dtype,
         score=50,
         notes="pending_review",
         approved=0,
-    )
-
-    dc = get_doc_count(tid)
-    user = get_user(tid)
+        enqueue_analysis=True,
+    ) or {}
+    doc_id = saved.get('doc_id')
+    dc = saved.get('doc_count', 0)
+    document_analysis.wake()
 
     # Post-upload response — direct to waitlist
     response_btns = [
@@ -6638,25 +9885,19 @@ async def handle_photo_upload(update: Update, ctx: ContextTypes.DEFAULT_TYPE) ->
     )
 
     # Notify admins with photo for review
-    user_name = user.get('full_name') or user.get('first_name') or update.effective_user.first_name or f"Usuario {tid}"
-
-    for aid in ADMIN_IDS:
-        try:
-            await ctx.bot.send_photo(
-                aid,
-                file_id,
-                caption=(
-                    f"📄 *Nuevo documento para revisar*\n"
-                    f"Usuario: {user_name} (TID: {tid})\n"
-                    f"Tipo: {info['name']}\n"
-                    f"DocID: {doc_id}\n"
-                    f"Total docs: {dc}\n\n"
-                    f"Use /pendientes para revisar"
-                ),
-                parse_mode=ParseMode.MARKDOWN,
-            )
-        except Exception as e:
-            logger.error(f"Failed to send admin photo notification to {aid}: {e}")
+    user_name = saved.get('full_name') or saved.get('first_name') or update.effective_user.first_name or f"Usuario {tid}"
+    md_name = escape_markdown(user_name)
+
+    await notify_admins_media(
+        ctx, "send_photo", file_id,
+        f"📄 *Nuevo documento para revisar*\n"
+        f"Usuario: {md_name} (TID: {tid})\n"
+        f"Tipo: {info['name']}\n"
+        f"DocID: {doc_id}\n"
+        f"Total docs: {dc}\n\n"
+        f"Revisar: {pending_doc_link(doc_id)}",
+        summary=f"📄 {info['name']} — {md_name} ({tid}), {dc} docs → {pending_doc_link(doc_id)}",
+        album_caption=f"Doc #{doc_id} — {info['name']} — {user_name}")
 
     return ST_MAIN_MENU
 
@@ -6676,18 +9917,25 @@ async def handle_file_upload(update: Update, ctx: ContextTypes.DEFAULT_TYPE) ->
     dtype = ctx.user_data.get("doc_type", "other")
     info = DOC_TYPES.get(dtype, DOC_TYPES["other"])
 
+    if update.message.media_group_id:
+        album_uploads.add(update, ctx, {"method": "send_document", "file_id": file_id, "doc_type": dtype,
+                                        "ocr_text": f"[PDF/File: {file_name}]",
+                                        "label": f"{info['name']} ({file_name})"})
+        return ST_MAIN_MENU
+
     # Save document immediately — always accept, admin reviews later
-    doc_id = save_document(
+    saved = await aingest_document(
         tid, dtype, file_id,
         ocr_text=f"[PDF/File: {file_name}]",
         detected_type=dtype,
         score=50,
         notes="pending_review",
         approved=0,
-    )
-
-    dc = get_doc_count(tid)
-    user = get_user(tid)
+        enqueue_analysis=True,
+    ) or {}
+    doc_id = saved.get('doc_id')
+    dc = saved.get('doc_count', 0)
+    document_analysis.wake()
 
     # Post-upload response — direct to waitlist
     response_btns2 = [
@@ -6704,30 +9952,70 @@ async def handle_file_upload(update: Update, ctx: ContextTypes.DEFAULT_TYPE) ->
     )
 
     # Notify admins
-    user_name = user.get('full_name') or user.get('first_name') or update.effective_user.first_name or f"Usuario {tid}"
-
-    for aid in ADMIN_IDS:
-        try:
-            await ctx.bot.send_document(
-                aid,
-                file_id,
-                caption=(
-                    f"📎 *Nuevo documento para revisar*\n"
-                    f"Usuario: {user_name} (TID: {tid})\n"
-                    f"Tipo: {info['name']}\n"
-                    f"Archivo: {file_name}\n"
-                    f"DocID: {doc_id}\n"
-                    f"Total docs: {dc}\n\n"
-                    f"Use /pendientes para revisar"
-                ),
-                parse_mode=ParseMode.MARKDOWN,
-            )
-        except Exception as e:
-            logger.error(f"Failed to send admin file notification to {aid}: {e}")
+    user_name = saved.get('full_name') or saved.get('first_name') or update.effective_user.first_name or f"Usuario {tid}"
+    md_name = escape_markdown(user_name)
+
+    await notify_admins_media(
+        ctx, "send_document", file_id,
+        f"📎 *Nuevo documento para revisar*\n"
+        f"Usuario: {md_name} (TID: {tid})\n"
+        f"Tipo: {info['name']}\n"
+        f"Archivo: {escape_markdown(file_name)}\n"
+        f"DocID: {doc_id}\n"
+        f"Total docs: {dc}\n\n"
+        f"Revisar: {pending_doc_link(doc_id)}",
+        summary=f"📎 {info['name']} — {md_name} ({tid}), {dc} docs → {pending_doc_link(doc_id)}",
+        album_caption=f"Doc #{doc_id} — {info['name']} — {user_name}")
 
     return ST_MAIN_MENU
 
 
+async def handle_album_upload(update: Update, ctx: ContextTypes.DEFAULT_TYPE, items: List[Dict]) -> None:
+    """Save a whole album at once: one batch insert, one reply, one admin album."""
+    tid = update.effective_user.id
+    saved = await aingest_documents(tid, [
+        {"doc_type": i["doc_type"], "file_id": i["file_id"], "ocr_text": i["ocr_text"],
+         "detected_type": i["doc_type"], "score": 50, "notes": "pending_review"}
+        for i in items
+    ], enqueue_analysis=True) or {}
+    doc_ids = saved.get('doc_ids', [])
+    if not doc_ids:
+        # No users row (e.g. deleted mid-upload): nothing was stored
+        logger.warning(f"Album from {tid}: {len(items)} uploads not saved (no user row)")
+        await update.message.reply_text("No se pudieron guardar los documentos. Escribe /start para comenzar.")
+        return
+    dc = saved.get('doc_count', 0)
+    document_analysis.wake()
+
+    response_btns = [
+        [InlineKeyboardButton("Subir otro documento", callback_data="m_upload")],
+        [InlineKeyboardButton("Ver lista de espera", callback_data="waitlist")],
+    ]
+    await update.message.reply_text(
+        f"*{len(doc_ids)} documentos guardados.*\n\n"
+        f"Documentos aportados: {dc}\n\n"
+        "Puedes seguir subiendo documentos o ver la lista de espera.",
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=InlineKeyboardMarkup(response_btns),
+    )
+
+    user_name = saved.get('full_name') or saved.get('first_name') or update.effective_user.first_name or f"Usuario {tid}"
+    md_name = escape_markdown(user_name)
+    for item, doc_id in zip(items, doc_ids):
+        item["summary"] = f"📄 {escape_markdown(item['label'])} — {md_name} ({tid}), {dc} docs → {pending_doc_link(doc_id)}"
+        item["album_caption"] = f"Doc #{doc_id} — {item['label']} — {user_name}"
+    links = " ".join(pending_doc_link(d) for d in doc_ids)
+    await notify_admins_album(
+        ctx, items,
+        f"🗂 *{len(doc_ids)} documentos nuevos para revisar*\n"
+        f"Usuario: {md_name} (TID: {tid})\n"
+        f"Total docs: {dc}\n\n"
+        f"Revisar: {links}")
+
+
+album_uploads = AlbumCollector(ALBUM_WINDOW_MS, handle_album_upload)
+
+
 # --- Free-text handler (NLU) ---
 
 async def handle_free_text(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
@@ -6747,13 +10035,13 @@ async def handle_free_text(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> in
         # Unknown command - ignore
         return ST_MAIN_MENU
 
-    user = get_user(update.effective_user.id)
+    user = await aget_user(update.effective_user.id)
     if not user:
-        user = create_user(update.effective_user.id, update.effective_user.first_name or "Usuario")
+        user = await acreate_user(update.effective_user.id, update.effective_user.first_name or "Usuario")
 
     # Log message
     intent = detect_intent(text)
-    save_message(update.effective_user.id, "in", text, intent or "")
+    await asave_message(update.effective_user.id, "in", text, intent or "")
 
     # If in human-message mode, forward to admins
     if ctx.user_data.get("awaiting_human_msg"):
@@ -6762,7 +10050,7 @@ async def handle_free_text(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> in
             f"💬 *Consulta de usuario*\n"
             f"De: {user.get('first_name')} ({update.effective_user.id})\n"
             f"País: {COUNTRIES.get(user.get('country_code', ''), {}).get('name', '?')}\n\n"
-            f"Mensaje:\n{text[:800]}")
+            f"Mensaje:\n{text[:800]}", urgent=True)
         await update.message.reply_text(
             "✓ Tu consulta ha sido enviada. Te responderemos pronto.",
             reply_markup=InlineKeyboardMarkup([
@@ -6905,7 +10193,7 @@ async def cmd_approve2(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uso: /approve2 <telegram_id>"); return
     try:
         tid = int(ctx.args[0])
-        update_user(tid, phase2_paid=1, current_phase=2, state="phase2_active")
+        await aupdate_user(tid, phase2_paid=1, current_phase=2, state="phase2_active")
         await ctx.bot.send_message(tid,
             "Su pago ha sido confirmado.\n\n"
             "Nuestro equipo legal iniciará la revisión completa de su documentación. "
@@ -6922,7 +10210,7 @@ async def cmd_approve3(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uso: /approve3 <telegram_id>"); return
     try:
         tid = int(ctx.args[0])
-        update_user(tid, phase3_paid=1, current_phase=3, state="phase3_active")
+        await aupdate_user(tid, phase3_paid=1, current_phase=3, state="phase3_active")
         await ctx.bot.send_message(tid,
             "Pago de la Fase 3 confirmado.\n\n"
             "Estamos preparando su expediente legal completo. "
@@ -6938,7 +10226,7 @@ async def cmd_approve4(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uso: /approve4 <telegram_id>"); return
     try:
         tid = int(ctx.args[0])
-        update_user(tid, phase4_paid=1, current_phase=4, state="phase4_active")
+        await aupdate_user(tid, phase4_paid=1, current_phase=4, state="phase4_active")
         await ctx.bot.send_message(tid,
             "Pago de la Fase 4 confirmado.\n\n"
             "Procederemos a presentar su solicitud ante Extranjería. "
@@ -6955,7 +10243,7 @@ async def cmd_ready(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uso: /ready <telegram_id>"); return
     try:
         tid = int(ctx.args[0])
-        update_user(tid, expediente_ready=1)
+        await aupdate_user(tid, expediente_ready=1)
         await ctx.bot.send_message(tid,
             "Su expediente está completo y listo para presentar.\n\n"
             "Cuando desee proceder con la presentación oficial, "
@@ -6983,20 +10271,22 @@ async def cmd_reply(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS: return
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM users"); total = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM users WHERE eligible=1"); eligible = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM users WHERE phase2_paid=1"); p2 = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM users WHERE phase3_paid=1"); p3 = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM users WHERE phase4_paid=1"); p4 = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM documents"); docs = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM messages WHERE direction='in'"); msgs = c.fetchone()[0]
-    conn.close()
+    stats = await run_db(get_admin_stats)
+    total, eligible, docs, msgs = stats['total_users'], stats['eligible'], stats['docs'], stats['messages_in']
+    p2, p3, p4 = stats['paid_p2'], stats['paid_p3'], stats['paid_p4']
     rev = (p2 * PRICING['phase2']) + (p3 * PRICING['phase3']) + (p4 * PRICING['phase4'])
     db_type = "PostgreSQL" if USE_POSTGRES else "SQLite"
-    available = get_available_slots()
-    wl_stats = get_waitlist_stats()
+    pool = get_db_pool().snapshot()
+    lanes = " · ".join(
+        f"{lane} {st['requests']} ({st['latency_ms_avg']:.0f}ms, {st['per_minute']:.1f}/min)"
+        for lane, st in outbound_gateway.snapshot().items() if st['requests']) or "—"
+    vision = claude_snapshot()
+    acache = analysis_cache.snapshot()
+    ocr = ocr_pool.snapshot()
+    analysis = document_analysis.snapshot()
+    cascade = " · ".join(f"{stage} {st['decided']}/{st['runs']} ({st['avg_ms']:.0f}ms)"
+                         for stage, st in classifier_snapshot().items())
+    available = stats['available_slots']
     await update.message.reply_text(
         f"*Estadísticas*\n\n"
         f"Usuarios: {total}\n"
@@ -7008,17 +10298,50 @@ async def cmd_stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         f"Fase 4 pagados: {p4} (€{p4*PRICING['phase4']})\n"
         f"*Ingresos: €{rev}*\n\n"
         f"📊 *Capacidad:* {TOTAL_CAPACITY - available}/{TOTAL_CAPACITY} ({available} libres)\n"
-        f"⏳ *Lista espera:* {wl_stats['total']}\n\n"
-        f"DB: {db_type}\n"
+        f"⏳ *Lista espera:* {stats['waitlist_total']}\n\n"
+        f"Datos de las {stats['computed_at']:%H:%M:%S}\n"
+        f"DB: {db_type} (pool {pool['in_use']}/{pool['size']}, espera media {pool['wait_ms_avg']:.1f}ms, máx {pool['wait_ms_max']:.0f}ms)\n"
+        f"Envíos: {lanes}\n"
+        f"Visión IA: {vision['calls']} ok, {vision['failures']} fallos, {vision['rejected']} rechazadas, "
+        f"{vision['in_flight']} en curso, media {vision['latency_avg']:.1f}s, circuito {vision['circuit']}, "
+        f"{vision['bytes_sent'] // 1024}/{vision['bytes_received'] // 1024} KB enviados\n"
+        f"Caché análisis: {acache['memory_hits']} memoria + {acache['db_hits']} DB aciertos, "
+        f"{acache['misses']} fallos ({acache['hit_rate']:.0%})\n"
+        f"OCR: {ocr['done']} ok ({ocr['avg_seconds']:.1f}s), {ocr['failed']} errores, {ocr['timeouts']} timeouts, "
+        f"{ocr['rejected']} rechazados, cola {ocr['pending']}/{ocr['queue_max']}\n"
+        f"Clasificación (decididos/ejecutados): {cascade}\n"
+        f"Pre-análisis: {analysis['done']} hechos, {analysis['retried']} reintentos, {analysis['failed']} fallidos, "
+        f"{analysis['in_progress']} en curso\n"
         f"Días restantes: {days_left()}", parse_mode=ParseMode.MARKDOWN)
 
 
 async def cmd_waitlist(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    """Admin: /waitlist — view capacity and waitlist stats."""
+    """Admin: /waitlist [page] — view capacity and waitlist stats, or one page of the queue."""
     if update.effective_user.id not in ADMIN_IDS:
         return
-    available = get_available_slots()
-    stats = get_waitlist_stats()
+    if ctx.args:
+        try:
+            page = max(1, int(ctx.args[0]))
+        except ValueError:
+            await update.message.reply_text("Uso: /waitlist [página]")
+            return
+        per_page = 20
+        rows, total = await run_db(get_waitlist_page, page, per_page)
+        total_pages = max(1, (total + per_page - 1) // per_page)
+        if not rows:
+            await update.message.reply_text(f"No hay usuarios en la página {page} de la lista de espera.")
+            return
+        lines = [f"⏳ *Lista de espera* (pág. {page}/{total_pages}, total: {total})\n"]
+        for r in rows:
+            mark = "✓" if r['notified'] else "○"
+            joined = str(r['joined_at'])[:10] if r['joined_at'] else "?"
+            lines.append(f"{r['position']}. {mark} {r['name'] or 'N/A'} (`{r['telegram_id']}`) | {r['country'] or '?'} | {r['docs_uploaded']} docs | {joined}")
+        if page < total_pages:
+            lines.append(f"\n/waitlist {page + 1} para siguiente")
+        await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+        return
+    available = await run_db(get_available_slots)
+    stats = await run_db(get_waitlist_stats)
     text = (
         f"📊 *CAPACITY & WAITLIST*\n\n"
         f"*Capacidad:*\n"
@@ -7046,8 +10369,8 @@ async def cmd_release(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     except (ValueError, IndexError):
         count = 10
 
-    users = get_waitlist_users(limit=count, notified=False)
-    sent = 0
+    users = await run_db(get_waitlist_users, limit=count, notified=False)
+    notified_ids = []
     for wl_user in users:
         try:
             await ctx.bot.send_message(
@@ -7062,11 +10385,11 @@ async def cmd_release(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("Continuar ahora", callback_data="request_phase2")]
                 ]))
-            mark_waitlist_notified(wl_user['telegram_id'])
-            sent += 1
+            notified_ids.append(wl_user['telegram_id'])
         except Exception as e:
             logger.warning(f"Failed to notify waitlist {wl_user['telegram_id']}: {e}")
-    await update.message.reply_text(f"✅ Notificados: {sent}/{len(users)}")
+    await run_db(mark_waitlist_notified_bulk, notified_ids)
+    await update.message.reply_text(f"✅ Notificados: {len(notified_ids)}/{len(users)}")
 
 
 async def cmd_broadcast(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -7075,19 +10398,92 @@ async def cmd_broadcast(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not ctx.args:
         await update.message.reply_text("Uso: /broadcast <mensaje>"); return
     msg = " ".join(ctx.args)
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT telegram_id FROM users")
-    users = [r[0] for r in c.fetchall()]
-    conn.close()
-    sent, failed = 0, 0
-    for tid in users:
-        try:
-            await ctx.bot.send_message(tid, msg, parse_mode=ParseMode.MARKDOWN)
-            sent += 1
-        except Exception:
-            failed += 1
-    await update.message.reply_text(f"Enviado: {sent} | Fallido: {failed}")
+    await queue_broadcast(update, ctx, "all", msg)
+
+
+async def _broadcast_job_arg(update: Update, ctx: ContextTypes.DEFAULT_TYPE, usage: str) -> Optional[Dict]:
+    if update.effective_user.id not in ADMIN_IDS:
+        return None
+    if not ctx.args or not ctx.args[0].isdigit():
+        await update.message.reply_text(usage)
+        return None
+    job = await run_db(get_broadcast_job, int(ctx.args[0]))
+    if not job:
+        await update.message.reply_text(f"Difusión #{ctx.args[0]} no encontrada.")
+    return job
+
+
+async def cmd_bcstatus(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Admin: /bcstatus [id] — recent broadcast jobs, or one job in detail."""
+    if update.effective_user.id not in ADMIN_IDS: return
+    if ctx.args:
+        job = await _broadcast_job_arg(update, ctx, "Uso: /bcstatus [id]")
+        if not job:
+            return
+        n = job["counts"]
+        _, _, label = _broadcast_audience_filter(job["audience"])
+        running = " (en curso)" if broadcast_job_running(job["id"]) else ""
+        await update.message.reply_text(
+            f"📣 Difusión #{job['id']} — {job['status']}{running}\n"
+            f"Audiencia: {label} ({job['total']})\n"
+            f"Enviado: {n['sent']} | Fallido: {n['failed']} | Bloqueado: {n['blocked']} | Pendiente: {n['pending']}\n"
+            f"Creada: {str(job['created_at'])[:16]}\n\n"
+            f"Mensaje: {job['message'][:200]}")
+        return
+    jobs = await run_db(list_broadcast_jobs, 10)
+    if not jobs:
+        await update.message.reply_text("No hay difusiones.")
+        return
+    lines = ["📣 Difusiones recientes:\n"]
+    for job in jobs:
+        lines.append(f"#{job['id']} {job['status']} — {job['audience']} ({job['total']}) "
+                     f"{str(job['created_at'])[:16]} — {job['message'][:40]}")
+    lines.append("\n/bcstatus <id> para detalle")
+    await update.message.reply_text("\n".join(lines))
+
+
+async def cmd_bcpause(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Admin: /bcpause <id> — stop sending; /bcresume continues where it stopped."""
+    job = await _broadcast_job_arg(update, ctx, "Uso: /bcpause <id>")
+    if not job:
+        return
+    if job["status"] not in ("pending", "running"):
+        await update.message.reply_text(f"La difusión #{job['id']} está {job['status']}.")
+        return
+    if broadcast_job_running(job["id"]):
+        _broadcast_stop[job["id"]] = "paused"
+    else:
+        await run_db(set_broadcast_job_status, job["id"], "paused")
+    await update.message.reply_text(f"⏸ Difusión #{job['id']} pausada. /bcresume {job['id']} para continuar.")
+
+
+async def cmd_bcresume(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Admin: /bcresume <id> — continue a paused (or interrupted) broadcast."""
+    job = await _broadcast_job_arg(update, ctx, "Uso: /bcresume <id>")
+    if not job:
+        return
+    if job["status"] in ("done", "cancelled"):
+        await update.message.reply_text(f"La difusión #{job['id']} ya está {job['status']}.")
+        return
+    if not start_broadcast_job(ctx.bot, job["id"]):
+        await update.message.reply_text(f"La difusión #{job['id']} ya está en curso.")
+        return
+    await update.message.reply_text(f"▶️ Difusión #{job['id']} reanudada ({job['counts']['pending']} pendientes).")
+
+
+async def cmd_bccancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Admin: /bccancel <id> — stop a broadcast for good."""
+    job = await _broadcast_job_arg(update, ctx, "Uso: /bccancel <id>")
+    if not job:
+        return
+    if job["status"] in ("done", "cancelled"):
+        await update.message.reply_text(f"La difusión #{job['id']} ya está {job['status']}.")
+        return
+    if broadcast_job_running(job["id"]):
+        _broadcast_stop[job["id"]] = "cancelled"
+    else:
+        await run_db(set_broadcast_job_status, job["id"], "cancelled")
+    await update.message.reply_text(f"🛑 Difusión #{job['id']} cancelada.")
 
 
 # =============================================================================
@@ -7117,7 +10513,8 @@ async def cmd_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         "/docs <tid> — Ver documentos de usuario\n"
         "/doc <file\\_id> — Ver archivo\n"
         "/ver <doc\\_id> — Detalle de documento\n"
-        "/pendientes — Cola de docs pendientes\n"
+        "/pendientes [id] — Cola de docs pendientes (o un doc concreto)\n"
+        "/analizar [N] — Pre-analizar N docs pendientes antiguos (máx. 500)\n"
         "/aprobar <doc\\_id> — Aprobar documento\n"
         "/rechazar <doc\\_id> [motivo] — Rechazar documento\n\n"
         "*Comunicación:*\n"
@@ -7125,14 +10522,16 @@ async def cmd_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         "/broadcast <msg> — Enviar a todos\n"
         "/broadcasteligible <msg> — Solo elegibles sin pagar\n"
         "/broadcastpaid <msg> — Solo usuarios que pagaron\n"
-        "/broadcastcountry <código> <msg> — Por nacionalidad\n\n"
+        "/broadcastcountry <código> <msg> — Por nacionalidad\n"
+        "/bcstatus [id] — Estado de difusiones\n"
+        "/bcpause <id> · /bcresume <id> · /bccancel <id>\n\n"
         "*Analítica:*\n"
         "/stats — Estadísticas generales\n"
         "/funnel — Embudo de conversión\n"
         "/recent [N] — Actividad reciente\n"
         "/revenue — Ingresos detallados\n"
         "/countries — Desglose por país\n"
-        "/waitlist — Capacidad y lista de espera\n"
+        "/waitlist [página] — Capacidad y lista de espera (con página: listado)\n"
         "/export — Exportar CSV de usuarios\n\n"
         "*Partners B2B:*\n"
         "/addpartner <name> <location> [phone] — Crear partner B2B\n"
@@ -7155,7 +10554,7 @@ async def cmd_deleteuser(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     try:
         tid = int(ctx.args[0])
-        user = get_user(tid)
+        user = await aget_user(tid)
         if not user:
             await update.message.reply_text(f"Usuario {tid} no encontrado.")
             return
@@ -7163,7 +10562,7 @@ async def cmd_deleteuser(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if len(ctx.args) < 2 or ctx.args[1].upper() != "CONFIRM":
             name = user.get('first_name', 'N/A')
             phase = user.get('current_phase', 1)
-            dc = get_doc_count(tid)
+            dc = await aget_doc_count(tid)
             await update.message.reply_text(
                 f"⚠️ *¿Eliminar usuario?*\n\n"
                 f"Nombre: {name}\n"
@@ -7175,7 +10574,7 @@ async def cmd_deleteuser(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.MARKDOWN)
             return
 
-        delete_user(tid)
+        await run_db(delete_user, tid)
         await update.message.reply_text(f"✅ Usuario {tid} eliminado. Todos sus datos han sido borrados.")
     except Exception as e:
         await update.message.reply_text(f"Error: {e}")
@@ -7189,28 +10588,18 @@ async def cmd_resetuser(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     try:
         tid = int(ctx.args[0])
-        user = get_user(tid)
+        user = await aget_user(tid)
         if not user:
             await update.message.reply_text(f"Usuario {tid} no encontrado.")
             return
 
-        update_user(tid, eligible=0, current_phase=1, phase2_paid=0, phase3_paid=0,
+        await aupdate_user(tid, eligible=0, current_phase=1, phase2_paid=0, phase3_paid=0,
             phase4_paid=0, has_criminal_record=0, preliminary_review_sent=0,
             docs_verified=0, state='new', country_code=None, expediente_ready=0,
             phase2_answers=None, phase3_answers=None)
 
         # Delete docs and cases but keep messages
-        conn = get_connection()
-        c = conn.cursor()
-        p = db_param()
-        c.execute(f"SELECT id FROM users WHERE telegram_id = {p}", (tid,))
-        row = c.fetchone()
-        if row:
-            uid = row[0]
-            c.execute(f"DELETE FROM documents WHERE user_id = {p}", (uid,))
-            c.execute(f"DELETE FROM cases WHERE user_id = {p}", (uid,))
-        conn.commit()
-        conn.close()
+        await run_db(delete_user_docs_and_cases, tid)
 
         try:
             await ctx.bot.send_message(tid, "Su cuenta ha sido reiniciada. Escriba /start para comenzar.")
@@ -7229,21 +10618,18 @@ async def cmd_search(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     try:
         query = " ".join(ctx.args).lower()
-        conn = get_connection()
-        c = conn.cursor()
         p = db_param()
         if USE_POSTGRES:
-            c.execute(f"""SELECT telegram_id, first_name, full_name, country_code,
+            sql = f"""SELECT telegram_id, first_name, full_name, country_code,
                 eligible, current_phase, phase2_paid, phase3_paid, phase4_paid
                 FROM users WHERE first_name ILIKE {p} OR full_name ILIKE {p}
-                LIMIT 20""", (f"%{query}%", f"%{query}%"))
+                LIMIT 20"""
         else:
-            c.execute(f"""SELECT telegram_id, first_name, full_name, country_code,
+            sql = f"""SELECT telegram_id, first_name, full_name, country_code,
                 eligible, current_phase, phase2_paid, phase3_paid, phase4_paid
                 FROM users WHERE LOWER(first_name) LIKE {p} OR LOWER(COALESCE(full_name,'')) LIKE {p}
-                LIMIT 20""", (f"%{query}%", f"%{query}%"))
-        rows = c.fetchall()
-        conn.close()
+                LIMIT 20"""
+        rows = await run_db(db_fetchall, sql, (f"%{query}%", f"%{query}%"))
 
         if not rows:
             await update.message.reply_text("No se encontraron usuarios con ese nombre.")
@@ -7271,17 +10657,12 @@ async def cmd_users(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         per_page = 20
         offset = (page - 1) * per_page
 
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM users")
-        total = c.fetchone()[0]
+        total, = await run_db(db_counts, ["SELECT COUNT(*) FROM users"])
         total_pages = max(1, (total + per_page - 1) // per_page)
 
-        c.execute(f"""SELECT telegram_id, first_name, country_code, eligible,
+        rows = await run_db(db_fetchall, f"""SELECT telegram_id, first_name, country_code, eligible,
             current_phase, phase2_paid, created_at
             FROM users ORDER BY created_at DESC LIMIT {per_page} OFFSET {offset}""")
-        rows = c.fetchall()
-        conn.close()
 
         if not rows:
             await update.message.reply_text(f"No hay usuarios en página {page}.")
@@ -7306,13 +10687,9 @@ async def cmd_pending_payments(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Show users with unconfirmed payments: /pending"""
     if update.effective_user.id not in ADMIN_IDS: return
     try:
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("""SELECT telegram_id, first_name, full_name, state, updated_at
+        rows = await run_db(db_fetchall, """SELECT telegram_id, first_name, full_name, state, updated_at
             FROM users WHERE state IN ('phase2_pending', 'phase3_pending', 'phase4_pending')
             ORDER BY updated_at ASC""")
-        rows = c.fetchall()
-        conn.close()
 
         if not rows:
             await update.message.reply_text("✅ No hay pagos pendientes de confirmar.")
@@ -7348,19 +10725,19 @@ async def cmd_setphase(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("La fase debe ser 1, 2, 3 o 4.")
             return
 
-        user = get_user(tid)
+        user = await aget_user(tid)
         if not user:
             await update.message.reply_text(f"Usuario {tid} no encontrado.")
             return
 
         if phase == 1:
-            update_user(tid, current_phase=1, phase2_paid=0, phase3_paid=0, phase4_paid=0, state="new")
+            await aupdate_user(tid, current_phase=1, phase2_paid=0, phase3_paid=0, phase4_paid=0, state="new")
         elif phase == 2:
-            update_user(tid, current_phase=2, phase2_paid=1, phase3_paid=0, phase4_paid=0, state="phase2_active")
+            await aupdate_user(tid, current_phase=2, phase2_paid=1, phase3_paid=0, phase4_paid=0, state="phase2_active")
         elif phase == 3:
-            update_user(tid, current_phase=3, phase2_paid=1, phase3_paid=1, phase4_paid=0, state="phase3_active")
+            await aupdate_user(tid, current_phase=3, phase2_paid=1, phase3_paid=1, phase4_paid=0, state="phase3_active")
         elif phase == 4:
-            update_user(tid, current_phase=4, phase2_paid=1, phase3_paid=1, phase4_paid=1, state="phase4_active")
+            await aupdate_user(tid, current_phase=4, phase2_paid=1, phase3_paid=1, phase4_paid=1, state="phase4_active")
 
         await update.message.reply_text(f"✅ Usuario {tid} movido a Fase {phase}.")
     except Exception as e:
@@ -7376,7 +10753,7 @@ async def cmd_note(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try:
         tid = int(ctx.args[0])
         note_text = " ".join(ctx.args[1:])
-        save_message(tid, "admin_note", note_text, intent="admin_note")
+        await asave_message(tid, "admin_note", note_text, intent="admin_note")
         await update.message.reply_text(f"📝 Nota guardada para {tid}: {note_text[:100]}")
     except Exception as e:
         await update.message.reply_text(f"Error: {e}")
@@ -7386,22 +10763,10 @@ async def cmd_funnel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Conversion funnel breakdown: /funnel"""
     if update.effective_user.id not in ADMIN_IDS: return
     try:
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM users"); total = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM users WHERE eligible=1"); eligible = c.fetchone()[0]
-        c.execute("SELECT COUNT(DISTINCT u.telegram_id) FROM documents d JOIN users u ON d.user_id=u.id")
-        has_docs = c.fetchone()[0]
-        # Users with 3+ docs
-        c.execute("""SELECT COUNT(*) FROM (
-            SELECT u.telegram_id FROM documents d JOIN users u ON d.user_id=u.id
-            GROUP BY u.telegram_id HAVING COUNT(*) >= 3
-        ) sub""")
-        docs_3plus = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM users WHERE phase2_paid=1"); p2 = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM users WHERE phase3_paid=1"); p3 = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM users WHERE phase4_paid=1"); p4 = c.fetchone()[0]
-        conn.close()
+        stats = await run_db(get_admin_stats)
+        total, eligible = stats['total_users'], stats['eligible']
+        has_docs, docs_3plus = stats['users_with_docs'], stats['users_3plus_docs']
+        p2, p3, p4 = stats['paid_p2'], stats['paid_p3'], stats['paid_p4']
 
         def pct(n):
             return f"{n/total*100:.1f}" if total > 0 else "0"
@@ -7427,33 +10792,29 @@ async def cmd_recent(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS: return
     try:
         n = min(int(ctx.args[0]), 30) if ctx.args else 10
-        conn = get_connection()
-        c = conn.cursor()
 
         events = []
 
         # Recent signups
-        c.execute(f"SELECT telegram_id, first_name, created_at FROM users ORDER BY created_at DESC LIMIT {n}")
-        for row in c.fetchall():
+        rows = await run_db(db_fetchall, f"SELECT telegram_id, first_name, created_at FROM users ORDER BY created_at DESC LIMIT {n}")
+        for row in rows:
             events.append(('signup', str(row[2])[:16] if row[2] else '?', row[1] or 'N/A', row[0]))
 
         # Recent docs
-        c.execute(f"""SELECT d.doc_type, d.uploaded_at, u.first_name, u.telegram_id
+        rows = await run_db(db_fetchall, f"""SELECT d.doc_type, d.uploaded_at, u.first_name, u.telegram_id
             FROM documents d JOIN users u ON d.user_id=u.id
             ORDER BY d.uploaded_at DESC LIMIT {n}""")
-        for row in c.fetchall():
+        for row in rows:
             doc_name = DOC_TYPES.get(row[0], {}).get('name', row[0])
             events.append(('doc', str(row[1])[:16] if row[1] else '?', row[2] or 'N/A', doc_name))
 
         # Recent payment state changes
-        c.execute(f"""SELECT telegram_id, first_name, state, updated_at FROM users
+        rows = await run_db(db_fetchall, f"""SELECT telegram_id, first_name, state, updated_at FROM users
             WHERE state LIKE '%\\_pending' OR state LIKE '%\\_active'
             ORDER BY updated_at DESC LIMIT {n}""")
-        for row in c.fetchall():
+        for row in rows:
             events.append(('payment', str(row[3])[:16] if row[3] else '?', row[1] or 'N/A', row[2]))
 
-        conn.close()
-
         # Sort by timestamp desc
         events.sort(key=lambda x: x[1], reverse=True)
         events = events[:n]
@@ -7479,17 +10840,12 @@ async def cmd_countries(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """User breakdown by nationality: /countries"""
     if update.effective_user.id not in ADMIN_IDS: return
     try:
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("""SELECT country_code, COUNT(*) as cnt,
+        rows = await run_db(db_fetchall, """SELECT country_code, COUNT(*) as cnt,
             SUM(CASE WHEN eligible=1 THEN 1 ELSE 0 END) as elig,
             SUM(CASE WHEN phase2_paid=1 OR phase3_paid=1 OR phase4_paid=1 THEN 1 ELSE 0 END) as paid
             FROM users WHERE country_code IS NOT NULL
             GROUP BY country_code ORDER BY cnt DESC""")
-        rows = c.fetchall()
-        c.execute("SELECT COUNT(*) FROM users")
-        total = c.fetchone()[0]
-        conn.close()
+        total, = await run_db(db_counts, ["SELECT COUNT(*) FROM users"])
 
         if not rows:
             await update.message.reply_text("No hay datos de países.")
@@ -7512,12 +10868,8 @@ async def cmd_revenue(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Detailed revenue with projections: /revenue"""
     if update.effective_user.id not in ADMIN_IDS: return
     try:
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM users WHERE phase2_paid=1"); p2 = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM users WHERE phase3_paid=1"); p3 = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM users WHERE phase4_paid=1"); p4 = c.fetchone()[0]
-        conn.close()
+        stats = await run_db(get_admin_stats)
+        p2, p3, p4 = stats['paid_p2'], stats['paid_p3'], stats['paid_p4']
 
         rev_p2 = p2 * PRICING['phase2']
         rev_p3 = p3 * PRICING['phase3']
@@ -7558,20 +10910,7 @@ async def cmd_broadcasteligible(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     try:
         msg = " ".join(ctx.args)
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("SELECT telegram_id FROM users WHERE eligible=1 AND phase2_paid=0")
-        users = [r[0] for r in c.fetchall()]
-        conn.close()
-
-        sent, failed = 0, 0
-        for tid in users:
-            try:
-                await ctx.bot.send_message(tid, msg, parse_mode=ParseMode.MARKDOWN)
-                sent += 1
-            except Exception:
-                failed += 1
-        await update.message.reply_text(f"Enviado: {sent} | Fallido: {failed} (de {len(users)} elegibles sin pagar)")
+        await queue_broadcast(update, ctx, "eligible", msg)
     except Exception as e:
         await update.message.reply_text(f"Error: {e}")
 
@@ -7584,20 +10923,7 @@ async def cmd_broadcastpaid(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     try:
         msg = " ".join(ctx.args)
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("SELECT telegram_id FROM users WHERE phase2_paid=1 OR phase3_paid=1 OR phase4_paid=1")
-        users = [r[0] for r in c.fetchall()]
-        conn.close()
-
-        sent, failed = 0, 0
-        for tid in users:
-            try:
-                await ctx.bot.send_message(tid, msg, parse_mode=ParseMode.MARKDOWN)
-                sent += 1
-            except Exception:
-                failed += 1
-        await update.message.reply_text(f"Enviado: {sent} | Fallido: {failed} (de {len(users)} usuarios que pagaron)")
+        await queue_broadcast(update, ctx, "paid", msg)
     except Exception as e:
         await update.message.reply_text(f"Error: {e}")
 
@@ -7617,23 +10943,7 @@ async def cmd_broadcastcountry(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             return
 
         msg = " ".join(ctx.args[1:])
-        p = db_param()
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute(f"SELECT telegram_id FROM users WHERE country_code = {p}", (country_code,))
-        users = [r[0] for r in c.fetchall()]
-        conn.close()
-
-        country = COUNTRIES[country_code]
-        sent, failed = 0, 0
-        for tid in users:
-            try:
-                await ctx.bot.send_message(tid, msg, parse_mode=ParseMode.MARKDOWN)
-                sent += 1
-            except Exception:
-                failed += 1
-        await update.message.reply_text(
-            f"Enviado: {sent} | Fallido: {failed} (de {len(users)} usuarios {country['flag']} {country['name']})")
+        await queue_broadcast(update, ctx, f"country:{country_code}", msg)
     except Exception as e:
         await update.message.reply_text(f"Error: {e}")
 
@@ -7644,34 +10954,33 @@ async def cmd_export(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try:
         import csv
         import io
+        import tempfile
         from datetime import date as date_type
 
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("""SELECT telegram_id, first_name, full_name, country_code, eligible,
-            current_phase, phase2_paid, phase3_paid, phase4_paid, state,
-            referral_code, referred_by_code, referral_count, created_at, updated_at
-            FROM users ORDER BY created_at DESC""")
-        rows = c.fetchall()
         headers = ['telegram_id', 'first_name', 'full_name', 'country_code', 'eligible',
             'current_phase', 'phase2_paid', 'phase3_paid', 'phase4_paid', 'state',
             'referral_code', 'referred_by_code', 'referral_count', 'created_at', 'updated_at']
-        conn.close()
-
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(headers)
-        for row in rows:
-            writer.writerow(row)
-
-        csv_bytes = output.getvalue().encode('utf-8')
-        bytes_io = io.BytesIO(csv_bytes)
-        bytes_io.name = f"usuarios_{date_type.today().isoformat()}.csv"
 
-        await ctx.bot.send_document(
-            update.effective_chat.id,
-            document=bytes_io,
-            caption=f"📊 {len(rows)} usuarios exportados")
+        # Newest first (id order == creation order); rows are streamed straight into
+        # one encoded buffer that moves to a temp file on disk once it gets large
+        with tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024) as spool:
+            output = io.TextIOWrapper(spool, encoding='utf-8', newline='')
+            writer = csv.writer(output)
+            writer.writerow(headers)
+            exported = 0
+            async for row in stream_rows("users", headers, "id", descending=True):
+                writer.writerow(row)
+                exported += 1
+            output.flush()
+            output.detach()
+            spool.seek(0)
+
+            # The Bot API client reads uploads whole; spool.name is not a path it could use
+            await ctx.bot.send_document(
+                update.effective_chat.id,
+                document=spool.read(),
+                filename=f"usuarios_{date_type.today().isoformat()}.csv",
+                caption=f"📊 {exported} usuarios exportados")
     except Exception as e:
         await update.message.reply_text(f"Error: {e}")
 
@@ -7810,26 +11119,19 @@ async def cmd_addpartner(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     code = f"INST-{clean_name}-{clean_loc}"
 
-    conn = get_connection()
-    c = conn.cursor()
     p = db_param()
 
     try:
-        c.execute(f"""
+        await run_db(db_execute, f"""
             INSERT INTO institutional_partners (code, business_name, location, contact_phone, created_by)
             VALUES ({p}, {p}, {p}, {p}, {p})
         """, (code, name.title(), location.title(), phone, update.effective_user.id))
-        conn.commit()
     except Exception as e:
-        conn.rollback()
-        conn.close()
         await update.message.reply_text(f"Error: código `{code}` ya existe o error DB: {e}", parse_mode=ParseMode.MARKDOWN)
         return
-    finally:
-        conn.close()
 
-    # Generate sharing card image
-    card_path = generate_partner_card(code, name.title(), location.title())
+    # Generate sharing card image (Pillow work stays off the event loop too)
+    card_path = await asyncio.to_thread(generate_partner_card, code, name.title(), location.title())
 
     # Build the deep link (Telegram doesn't allow hyphens in start params)
     deep_link_param = code.replace("-", "_")
@@ -7864,11 +11166,7 @@ async def cmd_partners(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS and update.effective_user.id not in FIELD_AGENT_IDS:
         return
 
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT code, business_name, location, total_referrals, total_paid_full, total_paid_prepay, balance, active FROM institutional_partners ORDER BY created_at DESC")
-    rows = c.fetchall()
-    conn.close()
+    rows = await run_db(db_fetchall, "SELECT code, business_name, location, total_referrals, total_paid_full, total_paid_prepay, balance, active FROM institutional_partners ORDER BY created_at DESC")
 
     if not rows:
         await update.message.reply_text("No hay partners institucionales.")
@@ -7900,18 +11198,14 @@ async def cmd_partnercard(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     code = ctx.args[0].upper().strip()
 
-    conn = get_connection()
-    c = conn.cursor()
     p = db_param()
-    c.execute(f"SELECT business_name, location FROM institutional_partners WHERE code = {p}", (code,))
-    row = c.fetchone()
-    conn.close()
+    row = await run_db(db_fetchone, f"SELECT business_name, location FROM institutional_partners WHERE code = {p}", (code,))
 
     if not row:
         await update.message.reply_text(f"Partner `{code}` no encontrado.", parse_mode=ParseMode.MARKDOWN)
         return
 
-    card_path = generate_partner_card(code, row[0], row[1])
+    card_path = await asyncio.to_thread(generate_partner_card, code, row[0], row[1])
     if card_path and os.path.exists(card_path):
         with open(card_path, 'rb') as f:
             await update.message.reply_photo(photo=f, caption=f"Tarjeta para {row[0]}")
@@ -7925,7 +11219,7 @@ async def cmd_partnercard(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_privacidad(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Let users manage their data and consent."""
     tid = update.effective_user.id
-    user = get_user(tid)
+    user = await aget_user(tid)
 
     if not user:
         await update.message.reply_text("No tienes cuenta activa. Escribe /start para comenzar.")
@@ -7963,15 +11257,15 @@ async def handle_privacidad_callback(update: Update, ctx: ContextTypes.DEFAULT_T
     tid = update.effective_user.id
 
     if q.data == "priv_no_marketing":
-        update_user(tid, marketing_consent=0)
+        await aupdate_user(tid, marketing_consent=0)
         await q.edit_message_text("Marketing desactivado. Ya no recibirás ofertas comerciales.")
 
     elif q.data == "priv_no_research":
-        update_user(tid, research_consent=0)
+        await aupdate_user(tid, research_consent=0)
         await q.edit_message_text("Investigación desactivada. Tus datos no se usarán en informes.")
 
     elif q.data == "priv_delete_demo":
-        update_user(tid, demographics_data=None, demographics_completed=0, discovery_source=None)
+        await aupdate_user(tid, demographics_data=None, demographics_completed=0, discovery_source=None)
         await q.edit_message_text("Datos del cuestionario eliminados.")
 
     elif q.data == "priv_close":
@@ -7987,29 +11281,19 @@ async def cmd_demographics(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
 
-    conn = get_connection()
-    c = conn.cursor()
-
     # Total counts
-    c.execute("SELECT COUNT(*) FROM users WHERE demographics_completed = 1")
-    completed = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM users WHERE demographics_skipped = 1")
-    skipped = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM users WHERE marketing_consent = 1")
-    mktg = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM users WHERE research_consent = 1")
-    research = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM users WHERE email IS NOT NULL AND email != ''")
-    emails = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM users WHERE whatsapp_phone IS NOT NULL AND whatsapp_phone != ''")
-    phones = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM users WHERE joined_community_group = 1")
-    group_joined = c.fetchone()[0]
+    completed, skipped, mktg, research, emails, phones, group_joined = await run_db(db_counts, [
+        "SELECT COUNT(*) FROM users WHERE demographics_completed = 1",
+        "SELECT COUNT(*) FROM users WHERE demographics_skipped = 1",
+        "SELECT COUNT(*) FROM users WHERE marketing_consent = 1",
+        "SELECT COUNT(*) FROM users WHERE research_consent = 1",
+        "SELECT COUNT(*) FROM users WHERE email IS NOT NULL AND email != ''",
+        "SELECT COUNT(*) FROM users WHERE whatsapp_phone IS NOT NULL AND whatsapp_phone != ''",
+        "SELECT COUNT(*) FROM users WHERE joined_community_group = 1",
+    ])
 
     # Discovery source breakdown
-    c.execute("SELECT discovery_source, COUNT(*) FROM users WHERE discovery_source IS NOT NULL AND discovery_source != '' GROUP BY discovery_source ORDER BY COUNT(*) DESC")
-    sources = c.fetchall()
-    conn.close()
+    sources = await run_db(db_fetchall, "SELECT discovery_source, COUNT(*) FROM users WHERE discovery_source IS NOT NULL AND discovery_source != '' GROUP BY discovery_source ORDER BY COUNT(*) DESC")
 
     source_text = "\n".join([f"  {s[0]}: {s[1]}" for s in sources]) if sources else "  Sin datos"
 
@@ -8041,14 +11325,14 @@ async def cmd_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     try:
         tid = int(ctx.args[0])
-        user = get_user(tid)
+        user = await aget_user(tid)
         if not user:
             await update.message.reply_text(f"Usuario {tid} no encontrado.")
             return
 
         # Get case info
-        case = get_or_create_case(tid)
-        docs = get_user_docs(tid)
+        case = await aget_or_create_case(tid)
+        docs = await aget_user_docs(tid)
 
         # Get country name
         country_code = user.get('country_code', '')
@@ -8107,12 +11391,12 @@ async def cmd_docs(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     try:
         tid = int(ctx.args[0])
-        user = get_user(tid)
+        user = await aget_user(tid)
         if not user:
             await update.message.reply_text(f"Usuario {tid} no encontrado.")
             return
 
-        docs = get_user_docs(tid)
+        docs = await aget_user_docs(tid)
         if not docs:
             await update.message.reply_text(f"Usuario {tid} no tiene documentos.")
             return
@@ -8198,7 +11482,7 @@ async def handle_admin_doc_callback(update: Update, ctx: ContextTypes.DEFAULT_TY
         if 'admin_docs' in ctx.user_data and tid in ctx.user_data['admin_docs']:
             docs = ctx.user_data['admin_docs'][tid]
         else:
-            docs = get_user_docs(tid)
+            docs = await aget_user_docs(tid)
 
         if not docs or idx >= len(docs):
             await q.message.reply_text("Documento no encontrado. Use /docs de nuevo.")
@@ -8233,14 +11517,40 @@ async def handle_admin_doc_callback(update: Update, ctx: ContextTypes.DEFAULT_TY
         logger.error(f"Error in handle_admin_doc_callback: {e}")
 
 
+async def cmd_analizar(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Admin: /analizar [N] — queue up to N (default 50, max 500) older pending documents for pre-analysis."""
+    if update.effective_user.id not in ADMIN_IDS: return
+    limit = int(ctx.args[0]) if ctx.args and ctx.args[0].isdigit() else 50
+    limit = max(1, min(limit, 500))
+    queued = await run_db(enqueue_analysis_backlog, limit)
+    document_analysis.wake()
+    await update.message.reply_text(
+        f"🔎 {queued} documentos pendientes en cola de análisis."
+        + (" Repite /analizar para el siguiente lote." if queued == limit else ""))
+
+
 async def cmd_pendientes(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    """Admin command to view pending documents: /pendientes"""
+    """Admin command to view pending documents: /pendientes, /pendientes <id>, /pendientes_<id>"""
     caller_id = update.effective_user.id
     if caller_id not in ADMIN_IDS:
         await update.message.reply_text(f"No autorizado. Tu ID: {caller_id}")
         return
 
-    pending = get_pending_documents(limit=20)
+    # Deep link from a notification: open that document directly
+    m = re.match(r"^/pendientes_(\d+)", update.message.text or "")
+    doc_arg = m.group(1) if m else (ctx.args[0] if ctx.args and ctx.args[0].isdigit() else None)
+    if doc_arg:
+        doc = await run_db(get_pending_document, int(doc_arg))
+        if not doc:
+            await update.message.reply_text(f"Documento #{doc_arg} no encontrado.")
+        elif doc.get('approved') != 0:
+            estado = "aprobado" if doc.get('approved') == 1 else "rechazado"
+            await update.message.reply_text(f"El documento #{doc_arg} ya fue {estado}. /pendientes para ver la cola.")
+        else:
+            await show_pending_document(update, ctx, doc)
+        return
+
+    pending = await run_db(get_pending_documents, limit=20)
 
     if not pending:
         await update.message.reply_text("✅ No hay documentos pendientes de revisión.")
@@ -8269,7 +11579,9 @@ async def show_pending_document(update: Update, ctx: ContextTypes.DEFAULT_TYPE,
     type_name = DOC_TYPES.get(doc_type, {}).get('name', doc_type)
 
     # Confidence indicator
-    if confidence >= 0.6:
+    if confidence >= 0.85:
+        conf_icon = "🟢 Alta"
+    elif confidence >= 0.6:
         conf_icon = "🟡 Media"
     else:
         conf_icon = "🔴 Baja"
@@ -8278,13 +11590,18 @@ async def show_pending_document(update: Update, ctx: ContextTypes.DEFAULT_TYPE,
     msg = f"*📄 Documento #{doc_id}*\n\n"
     msg += f"*Usuario:* {first_name} (TID: {tid})\n"
     msg += f"*Tipo esperado:* {type_name}\n"
-    msg += f"*Tipo detectado:* {ai_type or 'N/A'}\n"
-    msg += f"*Confianza:* {conf_icon} ({int(confidence * 100)}%)\n"
+    if ai_type:
+        msg += f"*Tipo detectado:* {DOC_TYPES.get(ai_type, {}).get('name', ai_type)}\n"
+        msg += f"*Confianza:* {conf_icon} ({int(confidence * 100)}%)\n"
+    else:
+        msg += "*Tipo detectado:* ⏳ análisis automático pendiente\n"
 
     if extracted_name:
         msg += f"*Nombre extraído:* {extracted_name}\n"
     if extracted_date:
         msg += f"*Fecha:* {extracted_date}\n"
+    if doc.get('expiry_date'):
+        msg += f"*Caduca:* {doc['expiry_date']}\n"
     if issues:
         msg += f"\n⚠️ *Problemas:* {issues}\n"
 
@@ -8347,7 +11664,7 @@ async def handle_pending_doc_callback(update: Update, ctx: ContextTypes.DEFAULT_
     data = q.data
 
     if data == "pdoc_next":
-        pending = get_pending_documents(limit=1)
+        pending = await run_db(get_pending_documents, limit=1)
         if pending:
             await show_pending_document(update, ctx, pending[0])
         else:
@@ -8362,7 +11679,7 @@ async def handle_pending_doc_callback(update: Update, ctx: ContextTypes.DEFAULT_
     action = parts[1]  # approve, reject, resubmit
     doc_id = int(parts[2])
 
-    doc = get_document_by_id(doc_id)
+    doc = await run_db(get_document_by_id, doc_id)
     if not doc:
         await q.message.reply_text(f"Documento {doc_id} no encontrado.")
         return
@@ -8372,7 +11689,7 @@ async def handle_pending_doc_callback(update: Update, ctx: ContextTypes.DEFAULT_
     type_name = DOC_TYPES.get(doc_type, {}).get('name', doc_type)
 
     if action == "approve":
-        success = update_document_approval(doc_id, 1)
+        success = await run_db(update_document_approval, doc_id, 1)
         if success:
             await q.message.reply_text(f"✅ Documento #{doc_id} aprobado.")
             try:
@@ -8386,7 +11703,7 @@ async def handle_pending_doc_callback(update: Update, ctx: ContextTypes.DEFAULT_
                 logger.error(f"Failed to notify user {tid}: {e}")
 
         # Auto-advance to next
-        pending = get_pending_documents(limit=1)
+        pending = await run_db(get_pending_documents, limit=1)
         if pending:
             await show_pending_document(update, ctx, pending[0])
         else:
@@ -8458,7 +11775,7 @@ async def handle_rejection_reason_callback(update: Update, ctx: ContextTypes.DEF
 
     reason = reasons.get(reason_code, reasons["other"])
 
-    doc = get_document_by_id(doc_id)
+    doc = await run_db(get_document_by_id, doc_id)
     if not doc:
         await q.message.reply_text(f"Documento {doc_id} no encontrado.")
         return
@@ -8467,7 +11784,7 @@ async def handle_rejection_reason_callback(update: Update, ctx: ContextTypes.DEF
     doc_type = doc.get('doc_type', 'unknown')
     type_name = DOC_TYPES.get(doc_type, {}).get('name', doc_type)
 
-    success = update_document_approval(doc_id, -1)  # -1 = rejected
+    success = await run_db(update_document_approval, doc_id, -1)  # -1 = rejected
     if success:
         await q.message.reply_text(f"❌ Documento #{doc_id} rechazado: {reason_code}")
         try:
@@ -8483,7 +11800,7 @@ async def handle_rejection_reason_callback(update: Update, ctx: ContextTypes.DEF
             logger.error(f"Failed to notify user {tid}: {e}")
 
     # Auto-advance to next
-    pending = get_pending_documents(limit=1)
+    pending = await run_db(get_pending_documents, limit=1)
     if pending:
         await show_pending_document(update, ctx, pending[0])
     else:
@@ -8506,7 +11823,7 @@ async def handle_resubmit_reason_callback(update: Update, ctx: ContextTypes.DEFA
     reason_code = parts[1]
     doc_id = int(parts[2])
 
-    doc = get_document_by_id(doc_id)
+    doc = await run_db(get_document_by_id, doc_id)
     if not doc:
         await q.message.reply_text(f"Documento {doc_id} no encontrado.")
         return
@@ -8538,7 +11855,7 @@ async def handle_resubmit_reason_callback(update: Update, ctx: ContextTypes.DEFA
 
     message = templates.get(reason_code, "Por favor, envía una nueva foto de este documento.")
 
-    success = update_document_approval(doc_id, -2)  # -2 = needs resubmission
+    success = await run_db(update_document_approval, doc_id, -2)  # -2 = needs resubmission
     if success:
         await q.message.reply_text(f"🔄 Pedida nueva foto para documento #{doc_id}: {reason_code}")
         try:
@@ -8553,7 +11870,7 @@ async def handle_resubmit_reason_callback(update: Update, ctx: ContextTypes.DEFA
             logger.error(f"Failed to notify user {tid}: {e}")
 
     # Auto-advance to next
-    pending = get_pending_documents(limit=1)
+    pending = await run_db(get_pending_documents, limit=1)
     if pending:
         await show_pending_document(update, ctx, pending[0])
     else:
@@ -8574,7 +11891,7 @@ async def handle_admin_custom_message(update: Update, ctx: ContextTypes.DEFAULT_
 
     custom_msg = update.message.text.strip()
 
-    success = update_document_approval(doc_id, -2)  # -2 = needs resubmission
+    success = await run_db(update_document_approval, doc_id, -2)  # -2 = needs resubmission
     if success:
         await update.message.reply_text(f"🔄 Mensaje personalizado enviado para documento #{doc_id}.")
         try:
@@ -8587,7 +11904,7 @@ async def handle_admin_custom_message(update: Update, ctx: ContextTypes.DEFAULT_
             logger.error(f"Failed to send custom message to user {tid}: {e}")
 
     # Auto-advance to next
-    pending = get_pending_documents(limit=1)
+    pending = await run_db(get_pending_documents, limit=1)
     if pending:
         await show_pending_document(update, ctx, pending[0])
     else:
@@ -8607,7 +11924,7 @@ async def cmd_aprobar(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     try:
         doc_id = int(ctx.args[0])
-        doc = get_document_by_id(doc_id)
+        doc = await run_db(get_document_by_id, doc_id)
 
         if not doc:
             await update.message.reply_text(f"Documento {doc_id} no encontrado.")
@@ -8617,7 +11934,7 @@ async def cmd_aprobar(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"Documento {doc_id} ya está aprobado.")
             return
 
-        success = update_document_approval(doc_id, 1)
+        success = await run_db(update_document_approval, doc_id, 1)
         if success:
             tid = doc.get('telegram_id')
             doc_type = doc.get('doc_type', 'unknown')
@@ -8659,7 +11976,7 @@ async def cmd_rechazar(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         doc_id = int(ctx.args[0])
         reason = " ".join(ctx.args[1:]) if len(ctx.args) > 1 else "Documento no válido o ilegible"
 
-        doc = get_document_by_id(doc_id)
+        doc = await run_db(get_document_by_id, doc_id)
 
         if not doc:
             await update.message.reply_text(f"Documento {doc_id} no encontrado.")
@@ -8669,7 +11986,7 @@ async def cmd_rechazar(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"Documento {doc_id} ya está rechazado.")
             return
 
-        success = update_document_approval(doc_id, -1)
+        success = await run_db(update_document_approval, doc_id, -1)
         if success:
             tid = doc.get('telegram_id')
             doc_type = doc.get('doc_type', 'unknown')
@@ -8711,7 +12028,7 @@ async def cmd_ver(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     try:
         doc_id = int(ctx.args[0])
-        doc = get_document_by_id(doc_id)
+        doc = await run_db(get_document_by_id, doc_id)
 
         if not doc:
             await update.message.reply_text(f"Documento {doc_id} no encontrado.")
@@ -8778,7 +12095,7 @@ async def cmd_ver(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_referidos(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     """Show referral stats for user."""
     tid = update.effective_user.id
-    stats = get_referral_stats(tid)
+    stats = await run_db(get_referral_stats, tid)
 
     if not stats or not stats['code']:
         await update.message.reply_text(
@@ -8802,7 +12119,7 @@ async def cmd_referidos(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 async def cmd_estado(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     """Show user's case status: /estado"""
     tid = update.effective_user.id
-    user = get_user(tid)
+    user = await aget_user(tid)
 
     if not user:
         await update.message.reply_text(
@@ -8812,8 +12129,8 @@ async def cmd_estado(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
 
     # Get case and docs info
-    case = get_or_create_case(tid)
-    docs = get_user_docs(tid)
+    case = await aget_or_create_case(tid)
+    docs = await aget_user_docs(tid)
 
     # Determine phase status
     phase = user.get('current_phase', 1)
@@ -8836,7 +12153,7 @@ async def cmd_estado(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     payment_status = " | ".join(payments) if payments else "Sin pagos realizados"
 
     # Progress bar (shared calculation)
-    dc_approved = get_approved_doc_count(tid)
+    dc_approved = await aget_approved_doc_count(tid)
     progress = calculate_progress(user, dc_approved)
     filled = progress // 10
     bar = "█" * filled + "░" * (10 - filled)
@@ -8871,7 +12188,7 @@ async def cmd_estado(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 async def cmd_documentos(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     """Show user's uploaded documents: /documentos"""
     tid = update.effective_user.id
-    user = get_user(tid)
+    user = await aget_user(tid)
 
     if not user:
         await update.message.reply_text(
@@ -8880,7 +12197,7 @@ async def cmd_documentos(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return ConversationHandler.END
 
-    docs = get_user_docs(tid)
+    docs = await aget_user_docs(tid)
 
     if not docs:
         await update.message.reply_text(
@@ -8929,7 +12246,7 @@ async def cmd_ayuda(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 async def cmd_antecedentes(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     """Show generic antecedentes help + service offer: /antecedentes"""
     tid = update.effective_user.id
-    user = get_user(tid)
+    user = await aget_user(tid)
 
     if not user:
         await update.message.reply_text(
@@ -8964,109 +12281,191 @@ async def cmd_contacto(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
 # RE-ENGAGEMENT REMINDERS (Job Queue)
 # =============================================================================
 
-def get_users_for_reminder(hours_since_update: int, phase_filter: str = None) -> List[Dict]:
-    """Get users who haven't interacted in X hours and haven't paid phase2 yet."""
+# Stages of the reminder ladder: (name, hours since last activity, only if docs < minimum).
+# users.next_reminder_at holds the next stage boundary, so a run only reads due rows;
+# reminder_log (primary key telegram_id + stage) guarantees each stage is sent once.
+
+REMINDER_STAGES = [
+    ("24h", 24, True),
+    ("72h", 72, True),
+    ("1week", 168, False),
+]
+
+
+def _reminder_text(stage: str, first_name: str, dc: int, dl: int) -> str:
+    if stage == "24h":
+        return (
+            f"Hola {first_name},\n\n"
+            f"Vimos que comenzó su proceso de regularización pero aún no ha subido todos sus documentos.\n\n"
+            f"📄 Documentos subidos: {dc}\n"
+            f"📋 Mínimo recomendado: {MIN_DOCS_FOR_PHASE2}\n"
+            f"⏰ Días restantes: {dl}\n\n"
+            "Cuanto antes suba su documentación, antes podremos revisarla y asegurar que todo esté correcto.\n\n"
+            "Escriba /menu para continuar."
+        )
+    if stage == "72h":
+        return (
+            f"Hola {first_name},\n\n"
+            f"Han pasado 3 días desde que inició su proceso. El plazo de regularización cierra en *{dl} días*.\n\n"
+            "No pierda esta oportunidad única de regularizar su situación. "
+            "Más de 500 personas ya han completado su documentación con nosotros.\n\n"
+            "Recuerde: todo lo que haga en esta fase es *gratuito*. "
+            "Solo le pediremos un pago cuando hayamos revisado su caso.\n\n"
+            "Escriba /menu para retomar su proceso."
+        )
+    return (
+        f"Hola {first_name},\n\n"
+        f"Ha pasado una semana desde que comenzó su proceso de regularización.\n\n"
+        f"⚠️ *Solo quedan {dl} días* para presentar su solicitud.\n\n"
+        "Entendemos que puede tener dudas o dificultades. "
+        "Nuestro equipo está disponible para ayudarle en cada paso.\n\n"
+        "Si necesita hablar con alguien, escriba /menu y pulse *Hablar con nuestro equipo*.\n\n"
+        "No deje pasar esta oportunidad histórica."
+    )
+
+
+def get_due_reminders(limit: int) -> List[Dict]:
+    """Users whose next_reminder_at has passed, with idle hours, doc count and whether
+    they are still eligible-unpaid, in one query."""
     conn = get_connection()
     c = conn.cursor()
     p = db_param()
-
     if USE_POSTGRES:
-        query = f"""
-            SELECT telegram_id, first_name, country_code
-            FROM users
-            WHERE phase2_paid = 0
-            AND eligible = 1
-            AND updated_at < NOW() - INTERVAL '{hours_since_update} hours'
-            AND updated_at > NOW() - INTERVAL '{hours_since_update + 24} hours'
-        """
+        idle = "EXTRACT(EPOCH FROM (NOW() - u.updated_at)) / 3600.0"
+        now = "NOW()"
     else:
-        query = f"""
-            SELECT telegram_id, first_name, country_code
-            FROM users
-            WHERE phase2_paid = 0
-            AND eligible = 1
-            AND updated_at < datetime('now', '-{hours_since_update} hours')
-            AND updated_at > datetime('now', '-{hours_since_update + 24} hours')
-        """
+        idle = "(julianday('now') - julianday(u.updated_at)) * 24.0"
+        now = "datetime('now')"
+    c.execute(f"""SELECT u.telegram_id, u.first_name, {idle}, COALESCE(d.doc_count, 0),
+            u.eligible = 1 AND u.phase2_paid = 0
+        FROM users u
+        LEFT JOIN (
+            SELECT user_id, COUNT(*) AS doc_count FROM documents
+            WHERE user_id IN (SELECT id FROM users WHERE next_reminder_at <= {now})
+            GROUP BY user_id
+        ) d ON d.user_id = u.id
+        WHERE u.next_reminder_at <= {now}
+        ORDER BY u.next_reminder_at
+        LIMIT {p}""", (limit,))
+    rows = [
+        {"telegram_id": r[0], "first_name": r[1], "idle_hours": float(r[2] or 0), "doc_count": r[3],
+         "in_funnel": bool(r[4])}
+        for r in c.fetchall()
+    ]
+    conn.close()
+    return rows
 
-    c.execute(query)
-    rows = c.fetchall()
-    result = [{"telegram_id": r[0], "first_name": r[1], "country_code": r[2]} for r in rows]
+
+def claim_reminders(run_id: str, claims: List[Tuple[int, str]]) -> set:
+    """Insert (telegram_id, stage) into reminder_log; returns the telegram_ids this run claimed."""
+    if not claims:
+        return set()
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.executemany(f"""INSERT INTO reminder_log (telegram_id, stage, run_id) VALUES ({p}, {p}, {p})
+        ON CONFLICT (telegram_id, stage) DO NOTHING""", [(tid, stage, run_id) for tid, stage in claims])
+    c.execute(f"SELECT telegram_id FROM reminder_log WHERE run_id = {p}", (run_id,))
+    claimed = {r[0] for r in c.fetchall()}
+    conn.commit()
     conn.close()
-    return result
+    return claimed
 
 
-async def send_reminder_24h(context: ContextTypes.DEFAULT_TYPE):
-    """Send 24h reminder to users who started but haven't uploaded enough docs."""
-    users = get_users_for_reminder(24)
-    dl = days_left()
+def finish_reminders(run_id: str, results: Dict[int, str]):
+    """Record delivery results for a run's claims ('sent' / 'failed' / 'blocked')."""
+    if not results:
+        return
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    c.executemany(f"UPDATE reminder_log SET status = {p}, sent_at = CURRENT_TIMESTAMP WHERE run_id = {p} AND telegram_id = {p}",
+                  [(status, run_id, tid) for tid, status in results.items()])
+    conn.commit()
+    conn.close()
 
-    for user in users:
-        try:
-            dc = get_doc_count(user["telegram_id"])
-            if dc < MIN_DOCS_FOR_PHASE2:
-                await context.bot.send_message(
-                    user["telegram_id"],
-                    f"Hola {user['first_name']},\n\n"
-                    f"Vimos que comenzó su proceso de regularización pero aún no ha subido todos sus documentos.\n\n"
-                    f"📄 Documentos subidos: {dc}\n"
-                    f"📋 Mínimo recomendado: {MIN_DOCS_FOR_PHASE2}\n"
-                    f"⏰ Días restantes: {dl}\n\n"
-                    "Cuanto antes suba su documentación, antes podremos revisarla y asegurar que todo esté correcto.\n\n"
-                    "Escriba /menu para continuar.",
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                logger.info(f"24h reminder sent to {user['telegram_id']}")
-        except Exception as e:
-            logger.warning(f"Failed to send 24h reminder to {user['telegram_id']}: {e}")
 
+def reschedule_reminders(next_hours: Dict[Optional[int], List[int]]):
+    """Move processed users to their next stage boundary (None = ladder finished).
 
-async def send_reminder_72h(context: ContextTypes.DEFAULT_TYPE):
-    """Send 72h reminder with urgency."""
-    users = get_users_for_reminder(72)
-    dl = days_left()
+    Only rows that are still due are touched, so activity in the meantime
+    (update_user resets next_reminder_at) wins.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    p = db_param()
+    now = "NOW()" if USE_POSTGRES else "datetime('now')"
+    for hours, tids in next_hours.items():
+        if not tids:
+            continue
+        value = "NULL" if hours is None else _sql_hours_after("updated_at", hours)
+        placeholders = ", ".join([p] * len(tids))
+        c.execute(f"""UPDATE users SET next_reminder_at = {value}
+            WHERE telegram_id IN ({placeholders}) AND next_reminder_at <= {now}""", tuple(tids))
+    conn.commit()
+    conn.close()
 
-    for user in users:
-        try:
-            dc = get_doc_count(user["telegram_id"])
-            if dc < MIN_DOCS_FOR_PHASE2:
-                await context.bot.send_message(
-                    user["telegram_id"],
-                    f"Hola {user['first_name']},\n\n"
-                    f"Han pasado 3 días desde que inició su proceso. El plazo de regularización cierra en *{dl} días*.\n\n"
-                    "No pierda esta oportunidad única de regularizar su situación. "
-                    "Más de 500 personas ya han completado su documentación con nosotros.\n\n"
-                    "Recuerde: todo lo que haga en esta fase es *gratuito*. "
-                    "Solo le pediremos un pago cuando hayamos revisado su caso.\n\n"
-                    "Escriba /menu para retomar su proceso.",
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                logger.info(f"72h reminder sent to {user['telegram_id']}")
-        except Exception as e:
-            logger.warning(f"Failed to send 72h reminder to {user['telegram_id']}: {e}")
+
+def _reminder_stage(idle_hours: float) -> Tuple[Optional[int], Optional[int]]:
+    """(index of the stage to send now or None, hours of the next stage boundary or None)."""
+    current = None
+    for i, (_, hours, _) in enumerate(REMINDER_STAGES):
+        if idle_hours >= hours:
+            current = i
+    if current is None:
+        return None, REMINDER_STAGES[0][1]
+    nxt = REMINDER_STAGES[current + 1][1] if current + 1 < len(REMINDER_STAGES) else None
+    # Same 24h window as before: a stage whose window passed (e.g. bot was down) is skipped
+    if idle_hours >= REMINDER_STAGES[current][1] + 24:
+        return None, nxt
+    return current, nxt
 
 
-async def send_reminder_1week(context: ContextTypes.DEFAULT_TYPE):
-    """Send 1 week reminder - last chance."""
-    users = get_users_for_reminder(168)  # 7 days * 24 hours
+async def send_due_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Job: send every due re-engagement reminder, batch by batch."""
     dl = days_left()
+    totals = {"sent": 0, "failed": 0, "blocked": 0, "skipped": 0}
+    while True:
+        due = await run_db(get_due_reminders, REMINDER_BATCH_SIZE)
+        if not due:
+            break
+        run_id = f"{time.time_ns():x}"
+        claims, texts = [], {}
+        next_hours: Dict[Optional[int], List[int]] = {}
+        for user in due:
+            tid = user["telegram_id"]
+            if not user["in_funnel"]:
+                next_hours.setdefault(None, []).append(tid)  # paid or not eligible: off the ladder
+                continue
+            idx, nxt = _reminder_stage(user["idle_hours"])
+            next_hours.setdefault(nxt, []).append(tid)
+            if idx is None:
+                continue
+            stage, _, needs_docs = REMINDER_STAGES[idx]
+            if needs_docs and user["doc_count"] >= MIN_DOCS_FOR_PHASE2:
+                totals["skipped"] += 1
+                continue
+            claims.append((tid, stage))
+            texts[tid] = _reminder_text(stage, user["first_name"], user["doc_count"], dl)
 
-    for user in users:
-        try:
-            await context.bot.send_message(
-                user["telegram_id"],
-                f"Hola {user['first_name']},\n\n"
-                f"Ha pasado una semana desde que comenzó su proceso de regularización.\n\n"
-                f"⚠️ *Solo quedan {dl} días* para presentar su solicitud.\n\n"
-                "Entendemos que puede tener dudas o dificultades. "
-                "Nuestro equipo está disponible para ayudarle en cada paso.\n\n"
-                "Si necesita hablar con alguien, escriba /menu y pulse *Hablar con nuestro equipo*.\n\n"
-                "No deje pasar esta oportunidad histórica.",
-                parse_mode=ParseMode.MARKDOWN
-            )
-            logger.info(f"1week reminder sent to {user['telegram_id']}")
-        except Exception as e:
-            logger.warning(f"Failed to send 1week reminder to {user['telegram_id']}: {e}")
+        claimed = await run_db(claim_reminders, run_id, claims)
+        results: Dict[int, str] = {}
+
+        async def record(chat_id: int, result: str):
+            results[chat_id] = result
+
+        recipients = [tid for tid, _ in claims if tid in claimed]
+        if recipients:
+            await run_broadcast(context.bot, recipients, texts.__getitem__, on_result=record, lane="reminders")
+        await run_db(finish_reminders, run_id, results)
+        await run_db(reschedule_reminders, next_hours)
+        for result in results.values():
+            totals[result] += 1
+        if len(due) < REMINDER_BATCH_SIZE:
+            break
+    if totals["sent"] or totals["failed"] or totals["blocked"]:
+        logger.info(f"Reminders: {totals['sent']} sent, {totals['failed']} failed, "
+                    f"{totals['blocked']} blocked, {totals['skipped']} skipped (enough docs)")
 
 
 # =============================================================================
@@ -9078,8 +12477,21 @@ def main():
         logger.error("TELEGRAM_BOT_TOKEN not set.")
         return
 
+    if OCR_AVAILABLE:
+        ocr_pool.start()
     init_db()
-    app = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .application_class(PHApplication)
+        .post_init(_post_init)
+        .post_stop(_post_stop)
+        .post_shutdown(_post_shutdown)
+    )
+    builder = builder.rate_limiter(outbound_gateway)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    app = builder.build()
 
     conv = ConversationHandler(
         entry_points=[
@@ -9284,6 +12696,8 @@ def main():
     app.add_handler(CommandHandler("docs", cmd_docs), group=-1)
     app.add_handler(CommandHandler("doc", cmd_doc), group=-1)
     app.add_handler(CommandHandler("pendientes", cmd_pendientes), group=-1)
+    app.add_handler(CommandHandler("analizar", cmd_analizar), group=-1)
+    app.add_handler(MessageHandler(filters.Regex(r"^/pendientes_\d+"), cmd_pendientes), group=-1)
     app.add_handler(CommandHandler("aprobar", cmd_aprobar), group=-1)
     app.add_handler(CommandHandler("rechazar", cmd_rechazar), group=-1)
     app.add_handler(CommandHandler("ver", cmd_ver), group=-1)
@@ -9304,6 +12718,10 @@ def main():
     app.add_handler(CommandHandler("broadcasteligible", cmd_broadcasteligible), group=-1)
     app.add_handler(CommandHandler("broadcastpaid", cmd_broadcastpaid), group=-1)
     app.add_handler(CommandHandler("broadcastcountry", cmd_broadcastcountry), group=-1)
+    app.add_handler(CommandHandler("bcstatus", cmd_bcstatus), group=-1)
+    app.add_handler(CommandHandler("bcpause", cmd_bcpause), group=-1)
+    app.add_handler(CommandHandler("bcresume", cmd_bcresume), group=-1)
+    app.add_handler(CommandHandler("bccancel", cmd_bccancel), group=-1)
     app.add_handler(CommandHandler("export", cmd_export), group=-1)
     app.add_handler(CommandHandler("addpartner", cmd_addpartner), group=-1)
     app.add_handler(CommandHandler("partners", cmd_partners), group=-1)
@@ -9315,19 +12733,23 @@ def main():
     app.add_handler(CallbackQueryHandler(handle_resubmit_reason_callback, pattern="^pres_"), group=-1)
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_custom_message), group=-2)
 
-    # Schedule re-engagement reminders (runs every 6 hours)
+    # Schedule re-engagement reminders (only users whose next_reminder_at is due)
     job_queue = app.job_queue
     if job_queue:
-        job_queue.run_repeating(send_reminder_24h, interval=timedelta(hours=6), first=timedelta(minutes=5))
-        job_queue.run_repeating(send_reminder_72h, interval=timedelta(hours=6), first=timedelta(minutes=10))
-        job_queue.run_repeating(send_reminder_1week, interval=timedelta(hours=6), first=timedelta(minutes=15))
+        job_queue.run_repeating(send_due_reminders, interval=timedelta(minutes=REMINDER_INTERVAL_MINUTES),
+                                first=timedelta(minutes=5))
         logger.info("Re-engagement reminders scheduled (24h, 72h, 1week)")
+        job_queue.run_repeating(db_pool_watchdog, interval=timedelta(minutes=5), first=timedelta(minutes=1))
+        job_queue.run_repeating(capacity_reconcile_job, interval=timedelta(minutes=30), first=timedelta(minutes=2))
+        job_queue.run_repeating(analysis_cache_prune_job, interval=timedelta(hours=6), first=timedelta(minutes=10))
 
-    logger.info("PH-Bot v6.4.0 starting")
+    logger.info("PH-Bot v6.5.0 starting")
     logger.info(f"ADMIN_IDS: {ADMIN_IDS}")
     logger.info(f"Payment: FREE > €{PRICING['phase2']} > €{PRICING['phase3']} > €{PRICING['phase4']} | Days left: {days_left()} | BOE: {BOE_PUBLISHED}")
     logger.info(f"Database: {'PostgreSQL' if USE_POSTGRES else 'SQLite'}")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
+    _db_executor.shutdown(wait=True)
+    close_db_pool()
 
 
 if __name__ == "__main__":